@@ -0,0 +1,135 @@
+import json
+from collections import OrderedDict
+
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, succeed, DeferredList)
+
+
+class MemoryDedupCache(object):
+    """
+    Remembers outcomes in memory for `ttl` seconds. Once the cache holds
+    `max_size` outcomes, the least recently used outcome is forgotten to make
+    space for a new one.
+    """
+
+    def __init__(self, clock, ttl, max_size):
+        self.clock = clock
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.pop(key, None)
+
+        if entry is None:
+            return succeed(None)
+
+        expires_at, outcome = entry
+
+        if expires_at <= self.clock.seconds():
+            return succeed(None)
+
+        self.entries[key] = entry
+        return succeed(outcome)
+
+    def set(self, key, outcome):
+        self.entries.pop(key, None)
+        self.evict_expired()
+
+        while len(self.entries) >= self.max_size:
+            self.entries.popitem(last=False)
+
+        self.entries[key] = (self.clock.seconds() + self.ttl, outcome)
+        return succeed(None)
+
+    def add(self, key, outcome):
+        """
+        Remembers `outcome` if nothing is remembered for `key` yet. Returns
+        true if the outcome was remembered, and false otherwise.
+        """
+        entry = self.entries.get(key)
+
+        if entry is not None and entry[0] > self.clock.seconds():
+            return succeed(False)
+
+        self.set(key, outcome)
+        return succeed(True)
+
+    def delete(self, key):
+        self.entries.pop(key, None)
+        return succeed(None)
+
+    def evict_expired(self):
+        # Entries are kept in order of use rather than expiry, so this only
+        # evicts the expired entries that have not been used since they were
+        # set. The rest are evicted when they are next looked up or when they
+        # become the least recently used.
+        now = self.clock.seconds()
+
+        while self.entries:
+            key, (expires_at, _) = next(self.entries.iteritems())
+
+            if expires_at > now:
+                break
+
+            del self.entries[key]
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class RedisDedupCache(object):
+    """
+    Remembers outcomes in Redis for `ttl` seconds. Redis is left to limit the
+    memory used by the cache, according to its configured eviction policy.
+    """
+
+    def __init__(self, redis, ttl, prefix):
+        self.redis = redis
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get_key(self, key):
+        return '%s:%s' % (self.prefix, key)
+
+    def get(self, key):
+        d = self.redis.get(self.get_key(key))
+        d.addCallback(lambda v: json.loads(v) if v is not None else None)
+        return d
+
+    def set(self, key, outcome):
+        return self.redis.setex(
+            self.get_key(key), self.ttl, json.dumps(outcome))
+
+    @inlineCallbacks
+    def add(self, key, outcome):
+        """
+        Remembers `outcome` if nothing is remembered for `key` yet. Returns
+        true if the outcome was remembered, and false otherwise.
+
+        Both commands are sent without waiting for the first reply, so this
+        takes one round trip. The expiry time is set whether or not the key
+        already existed, so that a key left without one still expires. If
+        setting it fails, a newly added key is deleted again rather than
+        being remembered forever.
+        """
+        key = self.get_key(key)
+
+        [(added_ok, added), (expired_ok, expired)] = yield DeferredList([
+            self.redis.setnx(key, json.dumps(outcome)),
+            self.redis.expire(key, self.ttl),
+        ], consumeErrors=True)
+
+        if not added_ok:
+            added.raiseException()
+
+        if not expired_ok:
+            if added:
+                yield self.redis.delete(key)
+
+            expired.raiseException()
+
+        returnValue(bool(added))
+
+    def delete(self, key):
+        return self.redis.delete(self.get_key(key))
@@ -0,0 +1,276 @@
+import math
+from bisect import bisect_left
+from collections import deque
+
+from twisted.internet.defer import Deferred, inlineCallbacks
+from twisted.web import http
+from twisted.web.resource import Resource
+
+from vumi.blinkenlights.metrics import (
+    MetricManager, Metric, Count, AVG, MAX)
+from vumi.config import Config, ConfigText
+
+
+class InstrumentationConfig(Config):
+    """Config for exposing a transport's instrumentation."""
+
+    metrics_path = ConfigText(
+        "If set, the path on the web port to serve stage latency histograms "
+        "and event counters on, in the Prometheus text format",
+        default=None, static=True)
+
+
+class LatencyHistogram(object):
+    """
+    Counts latencies into fixed buckets. Each bucket counts the latencies up
+    to and including its upper bound that didn't fit in an earlier bucket.
+    """
+
+    BUCKETS = (
+        0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+        5.0, 10.0)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, latency):
+        self.counts[bisect_left(self.buckets, latency)] += 1
+        self.count += 1
+        self.sum += latency
+
+    def cumulative_counts(self):
+        total = 0
+
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+
+    def percentile(self, p):
+        """
+        Returns the upper bound of the bucket holding the nearest-rank `p`th
+        percentile, or None if nothing has been observed.
+        """
+        if self.count == 0:
+            return None
+
+        rank = percentile_rank(self.count, p)
+
+        for bound, total in self.cumulative_counts():
+            if total >= rank:
+                return bound
+
+
+class LatencyHistogramWindow(object):
+    """
+    Counts the latencies seen over the last `window` seconds into fixed
+    buckets. Latencies are counted in a histogram for each `interval`
+    seconds, so that the window can move by dropping its oldest histogram.
+    """
+
+    def __init__(self, clock, window, interval=1,
+                 buckets=LatencyHistogram.BUCKETS):
+        self.clock = clock
+        self.interval = interval
+        self.size = int(math.ceil(window / float(interval)))
+        self.buckets = buckets
+        self.slices = deque()
+
+    def get_index(self):
+        return int(math.floor(self.clock.seconds() / self.interval))
+
+    def expire(self, index):
+        while self.slices and self.slices[0][0] <= index - self.size:
+            self.slices.popleft()
+
+    def observe(self, latency):
+        index = self.get_index()
+        self.expire(index)
+
+        if not self.slices or self.slices[-1][0] != index:
+            self.slices.append((index, LatencyHistogram(self.buckets)))
+
+        self.slices[-1][1].observe(latency)
+
+    def histogram(self):
+        """Returns a histogram of the latencies seen in the window."""
+        self.expire(self.get_index())
+        histogram = LatencyHistogram(self.buckets)
+
+        for _, other in self.slices:
+            histogram.merge(other)
+
+        return histogram
+
+
+class Instrumentation(object):
+    """
+    Records how long each stage of handling a message takes and counts
+    events, such as each type of send failure. Stage latencies and counts
+    are published through `metrics` and can be rendered in the Prometheus
+    text format.
+    """
+
+    def __init__(self, clock, metrics, name):
+        self.clock = clock
+        self.metrics = metrics
+        self.name = name
+        self.histograms = {}
+        self.stage_metrics = {}
+        self.counts = {}
+        self.count_metrics = {}
+
+    def add_stage(self, stage):
+        self.histograms[stage] = LatencyHistogram()
+        self.stage_metrics[stage] = self.metrics.register(Metric(
+            'stages.%s.latency' % (stage,), [AVG, MAX]))
+
+    def add_counter(self, name):
+        self.counts[name] = 0
+        self.count_metrics[name] = self.metrics.register(Count(
+            'events.%s' % (name,)))
+
+    def record(self, stage, latency):
+        if stage not in self.histograms:
+            self.add_stage(stage)
+
+        self.histograms[stage].observe(latency)
+        self.stage_metrics[stage].set(latency)
+
+    def count(self, name):
+        if name not in self.counts:
+            self.add_counter(name)
+
+        self.counts[name] += 1
+        self.count_metrics[name].inc()
+
+    def measure(self, stage, f, *args, **kw):
+        """
+        Calls `f` with the given arguments, recording how long it takes as
+        the latency for `stage`. If `f` returns a deferred, the latency is
+        recorded once the deferred fires.
+        """
+        started = self.clock.seconds()
+
+        try:
+            result = f(*args, **kw)
+        except Exception:
+            self.record_since(None, stage, started)
+            raise
+
+        if isinstance(result, Deferred):
+            return result.addBoth(self.record_since, stage, started)
+
+        self.record_since(None, stage, started)
+        return result
+
+    def record_since(self, result, stage, started):
+        self.record(stage, self.clock.seconds() - started)
+        return result
+
+    def render(self):
+        lines = [
+            '# TYPE %s_stage_seconds histogram' % (self.name,),
+        ]
+
+        for stage, histogram in sorted(self.histograms.iteritems()):
+            for bound, count in histogram.cumulative_counts():
+                lines.append(
+                    '%s_stage_seconds_bucket{stage="%s",le="%s"} %d' % (
+                        self.name, stage, format_bound(bound), count))
+
+            lines.append('%s_stage_seconds_sum{stage="%s"} %r' % (
+                self.name, stage, histogram.sum))
+            lines.append('%s_stage_seconds_count{stage="%s"} %d' % (
+                self.name, stage, histogram.count))
+
+        lines.append('# TYPE %s_events_total counter' % (self.name,))
+
+        for name, count in sorted(self.counts.iteritems()):
+            lines.append('%s_events_total{event="%s"} %d' % (
+                self.name, name, count))
+
+        return '\n'.join(lines) + '\n'
+
+
+class InstrumentationMixin(object):
+    """
+    Mixin for transports that publish metrics and record their
+    instrumentation. The instrumentation is served on the web port at
+    `metrics_path`, and status events are measured as the 'status' stage.
+    """
+
+    @inlineCallbacks
+    def setup_instrumentation(self, name):
+        # The instrumentation is served on the web port, so it needs to exist
+        # before the web resources are started
+        self.metrics = yield self.start_publisher(
+            MetricManager,
+            "vumi.transports.%s.%s." % (name, self.transport_name))
+
+        self.instrumentation = Instrumentation(
+            self.get_clock(), self.metrics, name)
+
+    def teardown_instrumentation(self):
+        self.metrics.stop()
+
+    def start_web_resources(self, resources, port, site_class=None):
+        path = self.get_static_config().metrics_path
+
+        if path is not None:
+            resources = resources + [
+                (InstrumentationResource(self), path.lstrip('/'))]
+
+        return super(InstrumentationMixin, self).start_web_resources(
+            resources, port, site_class=site_class)
+
+    def add_status(self, **kw):
+        return self.instrumentation.measure(
+            'status', super(InstrumentationMixin, self).add_status, **kw)
+
+
+class InstrumentationResource(Resource):
+    isLeaf = True
+
+    def __init__(self, transport):
+        self.transport = transport
+        Resource.__init__(self)
+
+    def render_GET(self, request):
+        request.setResponseCode(http.OK)
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        request.do_not_log = True
+        return self.transport.instrumentation.render()
+
+
+def percentile_rank(n, p):
+    """
+    Returns the 1-based rank of the nearest-rank `p`th percentile of `n`
+    values.
+    """
+    return max(int(math.ceil(p / 100.0 * n)), 1)
+
+
+def percentile(values, p):
+    """
+    Returns the nearest-rank `p`th percentile of `values`, or None if there
+    are no values.
+    """
+    if not values:
+        return None
+
+    return sorted(values)[percentile_rank(len(values), p) - 1]
+
+
+def format_bound(bound):
+    if bound == float('inf'):
+        return '+Inf'
+    else:
+        return repr(bound)
@@ -0,0 +1,181 @@
+import os
+import json
+from collections import OrderedDict
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+
+from vumi import log
+
+
+class Journal(object):
+    """
+    An append-only log of records kept on disk in a directory of segment
+    files. Each record is added with an id and stays pending until it is
+    marked as done. A segment file is deleted once every record added to it
+    is done (along with every segment before it, since a segment can hold the
+    records marking earlier segments' records as done). Pending records are
+    read back from the segments when the journal is opened again.
+
+    Records added while the reactor is busy are written to disk together,
+    with a single fsync (a group commit). Pending records are also kept in
+    memory.
+    """
+
+    SEGMENT_SUFFIX = '.log'
+
+    def __init__(self, path, segment_size=1024 * 1024, clock=reactor):
+        self.path = path
+        self.segment_size = segment_size
+        self.clock = clock
+        self.records = OrderedDict()
+        self.segment_pending = {}
+        self.segment_sizes = {}
+        self.segment = None
+        self.segment_file = None
+        self.waiting = []
+        self.commit_call = None
+
+    def open(self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        segments = sorted(self.get_segments())
+
+        for segment in segments:
+            self.read_segment(segment)
+
+        self.delete_done_segments()
+
+        # Always start a new segment, rather than appending to one that may
+        # end with a partly written record
+        self.open_segment((segments[-1] + 1) if segments else 0)
+
+    def close(self):
+        if self.commit_call is not None:
+            self.commit_call.cancel()
+
+        self.commit()
+        self.segment_file.close()
+        self.segment_file = None
+
+    def get_segments(self):
+        for filename in os.listdir(self.path):
+            name, suffix = os.path.splitext(filename)
+
+            if suffix == self.SEGMENT_SUFFIX and name.isdigit():
+                yield int(name)
+
+    def get_segment_path(self, segment):
+        return os.path.join(
+            self.path, '%020d%s' % (segment, self.SEGMENT_SUFFIX))
+
+    def read_segment(self, segment):
+        path = self.get_segment_path(segment)
+        self.segment_pending[segment] = set()
+        self.segment_sizes[segment] = os.path.getsize(path)
+
+        with open(path, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A record that was being written when we stopped
+                    log.warning(
+                        'Ignoring partial journal record in %s' % (path,))
+                    continue
+
+                if record['type'] == 'add':
+                    self.records[record['id']] = (segment, record['data'])
+                    self.segment_pending[segment].add(record['id'])
+                else:
+                    self.remove_record(record['id'])
+
+    def open_segment(self, segment):
+        if self.segment is not None:
+            self.segment_file.close()
+
+        self.segment = segment
+        self.segment_pending[segment] = set()
+        self.segment_sizes[segment] = 0
+        self.segment_file = open(self.get_segment_path(segment), 'ab')
+
+    def delete_done_segments(self):
+        for segment in sorted(self.segment_pending):
+            if segment == self.segment or self.segment_pending[segment]:
+                break
+
+            del self.segment_pending[segment]
+            del self.segment_sizes[segment]
+            os.remove(self.get_segment_path(segment))
+
+    def remove_record(self, id):
+        if id in self.records:
+            segment, _ = self.records.pop(id)
+            self.segment_pending[segment].discard(id)
+
+    def write(self, record):
+        if self.segment_sizes[self.segment] >= self.segment_size:
+            self.commit()
+            self.open_segment(self.segment + 1)
+            self.delete_done_segments()
+
+        line = json.dumps(record) + '\n'
+        self.segment_file.write(line)
+        self.segment_sizes[self.segment] += len(line)
+
+        d = Deferred()
+        self.waiting.append(d)
+
+        if self.commit_call is None:
+            self.commit_call = self.clock.callLater(0, self.commit)
+
+        return d
+
+    def commit(self):
+        self.commit_call = None
+        self.segment_file.flush()
+        os.fsync(self.segment_file.fileno())
+
+        waiting, self.waiting = self.waiting, []
+
+        for d in waiting:
+            d.callback(None)
+
+    def add(self, id, data):
+        """
+        Adds a pending record, returning a deferred that fires once it has
+        been written to disk.
+        """
+        d = self.write({'type': 'add', 'id': id, 'data': data})
+        self.records[id] = (self.segment, data)
+        self.segment_pending[self.segment].add(id)
+        return d
+
+    def done(self, id):
+        """
+        Marks a pending record as done, returning a deferred that fires once
+        this has been written to disk.
+        """
+        self.remove_record(id)
+        d = self.write({'type': 'done', 'id': id})
+        self.delete_done_segments()
+        return d
+
+    def pending(self):
+        return [(id, data) for id, (_, data) in self.records.iteritems()]
+
+    def first(self):
+        for id, (_, data) in self.records.iteritems():
+            return id, data
+
+        return None
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, id):
+        return id in self.records
+
+    def disk_usage(self):
+        return sum(self.segment_sizes.itervalues())
@@ -0,0 +1,318 @@
+import math
+from collections import OrderedDict
+
+from twisted.internet.defer import FirstError, gatherResults, succeed
+from twisted.internet.task import LoopingCall
+
+from vumi.components.session import SessionManager
+
+
+class UssdSessionManager(SessionManager):
+    """
+    A session manager that can resume or create a session in a single
+    round trip to Redis. Sessions are stored under the same keys as vumi's
+    `SessionManager`, so sessions created by either can be used by the
+    other.
+    """
+
+    def touch_or_create(self, user_id, created_at, **fields):
+        """
+        Creates a session for `user_id` if it doesn't exist yet, and restarts
+        the session's expiry time. `fields` are only set on new sessions.
+        Returns a deferred that fires with true if the session was created,
+        and false if it already existed.
+
+        Whether the session is new is decided by setting the session's
+        `created_at` field with HSETNX, so two requests for the same session
+        can't both create it. The other commands are sent without waiting
+        for replies, so the whole operation takes one round trip.
+        """
+        key = "%s:%s" % ('session', user_id)
+
+        ds = [self.redis.hsetnx(key, 'created_at', created_at)]
+        ds.extend(
+            self.redis.hsetnx(key, field, value)
+            for field, value in sorted(fields.iteritems()))
+
+        if self.max_session_length:
+            ds.append(self.redis.expire(key, int(self.max_session_length)))
+
+        d = gatherResults(ds, consumeErrors=True)
+        d.addCallbacks(lambda results: bool(results[0]), unwrap_first_error)
+        return d
+
+
+class SessionCache(object):
+    """
+    Remembers which sessions exist for `ttl` seconds after they were last
+    used. Once the cache holds `max_size` sessions, the least recently used
+    session is forgotten to make space for a new one.
+    """
+
+    def __init__(self, clock, ttl, max_size):
+        self.clock = clock
+        self.ttl = ttl
+        self.max_size = max_size
+        self.sessions = OrderedDict()
+
+    def touch(self, session_id):
+        """
+        Restarts the session's expiry time if it is cached. Returns true if
+        the session was cached, and false otherwise.
+        """
+        expires_at = self.sessions.pop(session_id, None)
+        now = self.clock.seconds()
+
+        if expires_at is None or expires_at <= now:
+            return False
+
+        self.sessions[session_id] = now + self.ttl
+        return True
+
+    def add(self, session_id):
+        self.sessions.pop(session_id, None)
+
+        while len(self.sessions) >= self.max_size:
+            self.sessions.popitem(last=False)
+
+        self.sessions[session_id] = self.clock.seconds() + self.ttl
+
+    def delete(self, session_id):
+        self.sessions.pop(session_id, None)
+
+    def __len__(self):
+        return len(self.sessions)
+
+
+class TimerWheel(object):
+    """
+    A hashed timer wheel. Items are scheduled into one of `size` slots by
+    their deadline, rounded up to a multiple of `tick` seconds. Each tick,
+    the items in the next slot are passed to `due`, which is expected to
+    check whether each item is actually due, since a slot holds items for
+    every deadline that hashes to it. Scheduling an item takes constant
+    time, as does each item's check once its slot comes up.
+    """
+
+    def __init__(self, clock, due, tick=1.0, size=512):
+        self.clock = clock
+        self.due = due
+        self.tick = tick
+        self.slots = [[] for _ in range(size)]
+        self.current = self.get_tick(clock.seconds())
+        self.task = None
+
+    def get_tick(self, t):
+        return int(math.floor(t / self.tick))
+
+    def start(self):
+        self.task = LoopingCall(self.advance)
+        self.task.clock = self.clock
+        self.task.start(self.tick, now=False)
+
+    def stop(self):
+        if self.task is not None and self.task.running:
+            self.task.stop()
+
+    def schedule(self, deadline, item):
+        tick = max(
+            int(math.ceil(deadline / self.tick)),
+            self.current + 1)
+
+        self.slots[tick % len(self.slots)].append(item)
+
+    def advance(self):
+        now = self.get_tick(self.clock.seconds())
+
+        # Each slot only needs to be visited once, however many ticks have
+        # passed
+        end = min(now, self.current + len(self.slots))
+
+        while self.current < end:
+            self.current += 1
+            i = self.current % len(self.slots)
+            items, self.slots[i] = self.slots[i], []
+
+            for item in items:
+                self.due(item)
+
+        self.current = now
+
+    def __len__(self):
+        return sum(len(slot) for slot in self.slots)
+
+
+class MemorySession(object):
+    """A session kept in memory by `MemorySessionManager`."""
+
+    __slots__ = (
+        'user_id', 'expires_at', 'created_at', 'fields', 'scheduled_at')
+
+    def __init__(self, user_id, expires_at, created_at, fields):
+        self.user_id = user_id
+        self.expires_at = expires_at
+        self.created_at = created_at
+        # Most sessions have one or two fields, which take less space as a
+        # tuple of pairs than as a dict
+        self.fields = tuple(sorted(fields.iteritems()))
+        self.scheduled_at = None
+
+    def update(self, fields):
+        updated = dict(self.fields)
+        updated.update(fields)
+        self.fields = tuple(sorted(updated.iteritems()))
+
+    def to_dict(self):
+        session = dict(self.fields)
+        session['created_at'] = self.created_at
+        return session
+
+
+class MemorySessionManager(object):
+    """
+    A session manager that keeps sessions in memory, for transports running
+    on a single node. It has the same interface as `UssdSessionManager`.
+
+    Sessions are expired using a timer wheel, rather than a timer for each
+    session. Touching a session only updates its expiry time, and the
+    session is moved to the slot for its new expiry time once its old slot
+    comes up. Clearing a session only removes it from `sessions`, and it is
+    dropped from the wheel once its slot comes up. A session is only added
+    to the wheel again if its expiry time is brought forward, in which case
+    its old entry is ignored when its slot comes up.
+    """
+
+    def __init__(self, clock, max_session_length=None, tick=1.0,
+                 wheel_size=512):
+        self.clock = clock
+        self.max_session_length = max_session_length
+        self.sessions = {}
+        self.wheel = TimerWheel(clock, self.session_due, tick, wheel_size)
+
+    def start(self):
+        if self.max_session_length:
+            self.wheel.start()
+
+    def stop(self, stop_redis=True):
+        self.wheel.stop()
+        return succeed(None)
+
+    def get_expires_at(self, timeout=None):
+        if timeout is None:
+            timeout = self.max_session_length
+
+        if not timeout:
+            return None
+
+        return self.clock.seconds() + timeout
+
+    def add_session(self, user_id, created_at, fields):
+        session = MemorySession(
+            user_id, self.get_expires_at(), created_at, fields)
+
+        self.sessions[user_id] = session
+        self.schedule(session)
+        return session
+
+    def schedule(self, session):
+        if session.expires_at is None:
+            return
+
+        if (session.scheduled_at is None or
+                session.expires_at < session.scheduled_at):
+            self.wheel.schedule(
+                session.expires_at, (session, session.expires_at))
+            session.scheduled_at = session.expires_at
+
+    def session_due(self, entry):
+        session, scheduled_at = entry
+
+        if session.scheduled_at != scheduled_at:
+            # The session was added to the wheel again for an earlier time
+            return
+
+        session.scheduled_at = None
+
+        if self.sessions.get(session.user_id) is not session:
+            # The session was cleared, and possibly created again since
+            return
+
+        if session.expires_at is None:
+            return
+
+        if session.expires_at > self.clock.seconds():
+            self.schedule(session)
+        else:
+            del self.sessions[session.user_id]
+
+    def get_session(self, user_id):
+        session = self.sessions.get(user_id)
+
+        if session is None:
+            return None
+
+        if (session.expires_at is not None and
+                session.expires_at <= self.clock.seconds()):
+            # Expired, but its slot hasn't come up yet
+            del self.sessions[user_id]
+            return None
+
+        return session
+
+    def touch_or_create(self, user_id, created_at, **fields):
+        session = self.get_session(user_id)
+
+        if session is None:
+            self.add_session(user_id, created_at, fields)
+            return succeed(True)
+
+        if session.expires_at is not None:
+            session.expires_at = self.get_expires_at()
+
+        return succeed(False)
+
+    def active_sessions(self):
+        return succeed([
+            (user_id, session.to_dict())
+            for user_id, session in self.sessions.items()
+            if self.get_session(user_id) is not None])
+
+    def load_session(self, user_id):
+        session = self.get_session(user_id)
+        return succeed(session.to_dict() if session is not None else {})
+
+    def schedule_session_expiry(self, user_id, timeout):
+        session = self.get_session(user_id)
+
+        if session is None:
+            return succeed(0)
+
+        session.expires_at = self.get_expires_at(timeout)
+        self.schedule(session)
+        return succeed(1)
+
+    def create_session(self, user_id, **kwargs):
+        created_at = kwargs.pop('created_at', self.clock.seconds())
+        session = self.add_session(user_id, created_at, kwargs)
+        return succeed(session.to_dict())
+
+    def clear_session(self, user_id):
+        return succeed(int(self.sessions.pop(user_id, None) is not None))
+
+    def save_session(self, user_id, session):
+        session = dict(session)
+        current = self.get_session(user_id)
+
+        if current is None:
+            current = self.add_session(
+                user_id, session.pop('created_at', None), {})
+
+        current.update(
+            (k, v) for k, v in session.iteritems() if k != 'created_at')
+
+        return succeed(session)
+
+
+def unwrap_first_error(f):
+    f.trap(FirstError)
+    return f.value.subFailure
@@ -0,0 +1,147 @@
+from twisted.internet.defer import succeed
+from twisted.internet.task import LoopingCall
+
+from vumi import log
+from vumi.config import Config, ConfigDict, ConfigInt, ConfigText
+from vumi.utils import StatusEdgeDetector
+
+
+class StatusAggregatorConfig(Config):
+    """Config for publishing transport status events."""
+
+    status_mode = ConfigText(
+        "When to publish status events for a component. 'change' publishes "
+        "only when the component's status changes, 'type' also publishes "
+        "when a new type of event is seen for the component's current "
+        "status and 'none' publishes no events",
+        default='type', static=True)
+
+    status_components = ConfigDict(
+        "Per-component overrides, keyed by component name. Each value is a "
+        "dict that may contain 'mode', overriding status_mode, and "
+        "'summary', which can be set to false to leave the component out of "
+        "status summaries",
+        default={}, static=True)
+
+    status_summary_interval = ConfigInt(
+        "Number of seconds between status summaries, which give the number "
+        "of status events of each type seen for each component since the "
+        "last summary. Set to 0 to disable summaries",
+        default=0, static=True)
+
+    def post_validate(self):
+        super(StatusAggregatorConfig, self).post_validate()
+        modes = [self.status_mode] + [
+            c['mode'] for c in self.status_components.itervalues()
+            if 'mode' in c]
+
+        for mode in modes:
+            if mode not in StatusAggregator.MODES:
+                self.raise_config_error('Invalid status mode: %s' % (mode,))
+
+
+class StatusAggregatorMixin(object):
+    """
+    Mixin for transports that publish their status events through a
+    `StatusAggregator`.
+    """
+
+    def setup_status_aggregator(self):
+        self.status_aggregator = StatusAggregator.from_config(
+            self.clock, self.publish_status, self.get_static_config())
+        self.status_aggregator.start()
+
+    def teardown_status_aggregator(self):
+        self.status_aggregator.stop()
+
+    def add_status(self, **kw):
+        return self.status_aggregator.add(**kw)
+
+
+class StatusAggregator(object):
+    """
+    Decides which status events for a transport are worth publishing and
+    publishes them without making the caller wait for the publish to
+    complete.
+    """
+
+    MODES = ('change', 'type', 'none')
+
+    def __init__(self, clock, publish, mode='type', components=None,
+                 summary_interval=0):
+        self.clock = clock
+        self.publish = publish
+        self.mode = mode
+        self.components = components or {}
+        self.summary_interval = summary_interval
+        self.detector = StatusEdgeDetector()
+        self.states = {}
+        self.counts = {}
+        self.summary_task = None
+
+    @classmethod
+    def from_config(cls, clock, publish, config):
+        return cls(
+            clock, publish,
+            mode=config.status_mode,
+            components=config.status_components,
+            summary_interval=config.status_summary_interval)
+
+    def start(self):
+        if self.summary_interval > 0:
+            self.summary_task = LoopingCall(self.publish_summaries)
+            self.summary_task.clock = self.clock
+            self.summary_task.start(self.summary_interval, now=False)
+
+    def stop(self):
+        if self.summary_task is not None and self.summary_task.running:
+            self.summary_task.stop()
+
+    def get_mode(self, component):
+        return self.components.get(component, {}).get('mode', self.mode)
+
+    def has_summary(self, component):
+        return self.components.get(component, {}).get('summary', True)
+
+    def add(self, **status):
+        component = status['component']
+        counts = self.counts.setdefault(component, {})
+        counts[status['type']] = counts.get(status['type'], 0) + 1
+
+        previous = self.states.get(component)
+        self.states[component] = status['status']
+
+        if self.should_publish(status, previous):
+            d = self.publish(**status)
+            d.addErrback(log.err, 'Error publishing status')
+
+        return succeed(None)
+
+    def should_publish(self, status, previous):
+        mode = self.get_mode(status['component'])
+
+        if mode == 'change':
+            return status['status'] != previous
+        elif mode == 'type':
+            return self.detector.check_status(**status) is not None
+        else:
+            return False
+
+    def publish_summaries(self):
+        counts, self.counts = self.counts, {}
+
+        for component, types in sorted(counts.iteritems()):
+            if not self.has_summary(component):
+                continue
+
+            d = self.publish(
+                component=component,
+                status=self.states[component],
+                type='status_summary',
+                message='Status summary',
+                details={
+                    'interval': self.summary_interval,
+                    'counts': types,
+                })
+
+            d.addErrback(log.err, 'Error publishing status summary')
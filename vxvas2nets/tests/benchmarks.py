@@ -0,0 +1,380 @@
+"""
+Helpers for the transport benchmarks. Benchmarks only run when the
+VXVAS2NETS_BENCHMARKS environment variable is set. They can be tuned with:
+
+    VXVAS2NETS_BENCHMARK_MESSAGES     number of messages to send (2000)
+    VXVAS2NETS_BENCHMARK_CONCURRENCY  number of messages in flight (50)
+    VXVAS2NETS_BENCHMARK_LATENCY      fake Vas2Nets response time (0.005s)
+    VXVAS2NETS_BENCHMARK_ERRORS       error mix for sends (none), see below
+    VXVAS2NETS_BENCHMARK_SEED         seed for the error mix (0)
+    VXVAS2NETS_BENCHMARK_TIMEOUT      outbound request timeout (5s)
+    VXVAS2NETS_BENCHMARK_OUTPUT       directory to save JSON results in
+
+The error mix is a comma-separated list of outcomes and the fraction of
+sends that have each outcome, for example:
+
+    VXVAS2NETS_BENCHMARK_ERRORS=ERR-52:0.02,ERR-41:0.01,503:0.01,timeout:0.005
+
+An outcome is a Vas2Nets error code, an HTTP status code, or 'timeout' for
+a send that is never responded to.
+
+The USSD session benchmark also takes:
+
+    VXVAS2NETS_BENCHMARK_LEVELS       concurrent sessions to try (100,...)
+    VXVAS2NETS_BENCHMARK_STEPS        requests per session (3)
+    VXVAS2NETS_BENCHMARK_THINK_TIME   seconds between requests (0.0)
+    VXVAS2NETS_BENCHMARK_RAMP_UP      seconds to start sessions over (1.0)
+    VXVAS2NETS_BENCHMARK_CLOSE_RATIO  fraction of sessions closed (0.8)
+    VXVAS2NETS_BENCHMARK_SLO          p99 round trip to stay within (1.0s)
+
+The session manager benchmarks also take:
+
+    VXVAS2NETS_BENCHMARK_REDIS_RTT    simulated Redis round trip (0.001s)
+    VXVAS2NETS_BENCHMARK_SESSIONS     live in-memory sessions (200000)
+
+The pending request benchmark also takes:
+
+    VXVAS2NETS_BENCHMARK_REQUESTS     pending requests (50000)
+    VXVAS2NETS_BENCHMARK_EXPIRED      requests timing out each sweep (500)
+    VXVAS2NETS_BENCHMARK_ROUNDS       sweeps to time (20)
+
+Results saved to VXVAS2NETS_BENCHMARK_OUTPUT can be compared across
+releases.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import resource
+
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, DeferredList)
+from twisted.internet.task import deferLater
+from twisted.trial.unittest import SkipTest
+from twisted.web.server import NOT_DONE_YET
+
+from vumi.tests.utils import MockHttpServer
+
+import vxvas2nets
+from vxvas2nets.instrumentation import percentile
+
+
+def skip_unless_benchmarking():
+    if not os.environ.get('VXVAS2NETS_BENCHMARKS'):
+        raise SkipTest("VXVAS2NETS_BENCHMARKS is not set")
+
+
+def get_param(name, default, cast=int):
+    value = os.environ.get('VXVAS2NETS_BENCHMARK_%s' % (name.upper(),))
+    return cast(value) if value is not None else default
+
+
+def get_params(**defaults):
+    """
+    Returns the benchmark parameters, taking each from the environment if
+    it is set there and from `defaults` otherwise.
+    """
+    params = {
+        'messages': get_param('messages', 2000),
+        'concurrency': get_param('concurrency', 50),
+        'latency': get_param('latency', 0.005, float),
+        'errors': get_param('errors', '', str),
+        'seed': get_param('seed', 0),
+        'timeout': get_param('timeout', 5),
+    }
+
+    for name, default in defaults.iteritems():
+        params[name] = get_param(name, default, type(default))
+
+    return params
+
+
+def parse_errors(errors):
+    """
+    Parses an error mix like 'ERR-52:0.02,503:0.01,timeout:0.005' into a
+    list of outcomes and the fraction of requests that have each outcome.
+    """
+    mix = []
+
+    for item in filter(None, errors.split(',')):
+        outcome, fraction = item.rsplit(':', 1)
+        mix.append((outcome.strip(), float(fraction)))
+
+    if sum(fraction for _, fraction in mix) > 1:
+        raise ValueError("Error fractions add up to more than 1: %s" % (
+            errors,))
+
+    return mix
+
+
+class FakeVas2NetsServer(object):
+    """
+    An in-process stand-in for Vas2Nets' send API. Each request is
+    responded to after `latency` seconds. `errors` is a list of outcomes
+    and the fraction of requests that have each outcome, as returned by
+    `parse_errors`. Other requests succeed with `response`. Outcomes are
+    chosen with a seeded random number generator so that runs are
+    reproducible.
+    """
+
+    TIMEOUT = 'timeout'
+
+    def __init__(self, latency=0, errors=(), seed=0, response='OK.1234'):
+        self.latency = latency
+        self.errors = errors
+        self.response = response
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.outcomes = {}
+        self.server = MockHttpServer(self.handle_request)
+
+    @property
+    def url(self):
+        return self.server.url
+
+    def start(self):
+        return self.server.start()
+
+    def stop(self):
+        return self.server.stop()
+
+    def get_outcome(self):
+        r = self.random.random()
+
+        for outcome, fraction in self.errors:
+            if r < fraction:
+                return outcome
+
+            r -= fraction
+
+        return None
+
+    def get_response(self, req, outcome):
+        if outcome is None:
+            return self.response
+        elif outcome.isdigit():
+            req.setResponseCode(int(outcome))
+            return 'Server error'
+        else:
+            return '%s Error' % (outcome,)
+
+    def handle_request(self, req):
+        self.requests += 1
+        outcome = self.get_outcome()
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+        if outcome == self.TIMEOUT:
+            # Left for the transport to time out
+            return NOT_DONE_YET
+
+        if not self.latency:
+            return self.get_response(req, outcome)
+
+        reactor.callLater(self.latency, self.finish_request, req, outcome)
+        return NOT_DONE_YET
+
+    def finish_request(self, req, outcome):
+        if not req.finished and not req._disconnected:
+            req.write(self.get_response(req, outcome))
+            req.finish()
+
+
+@inlineCallbacks
+def run_concurrently(n, concurrency, f):
+    """
+    Calls `f` with each of 0 to `n - 1`, with at most `concurrency` of the
+    deferreds it returns waiting at a time. Returns the number of seconds
+    taken and the latency of each call.
+    """
+    latencies = []
+    indexes = iter(range(n))
+
+    @inlineCallbacks
+    def worker():
+        for i in indexes:
+            started = time.time()
+            yield f(i)
+            latencies.append(time.time() - started)
+
+    started = time.time()
+    workers = [worker() for _ in range(min(n, concurrency))]
+
+    for d in workers:
+        yield d
+
+    returnValue((time.time() - started, latencies))
+
+
+class UssdLoadGenerator(object):
+    """
+    Simulates users dialing in to a USSD line. Each session makes `steps`
+    requests, waiting `think_time` seconds between a response and the next
+    request. Sessions start at random times over the first `ramp_up`
+    seconds, since starting them all at once mostly measures how quickly
+    the listening socket accepts connections. The last request of a
+    `close_ratio` fraction of sessions has 'close' as its content, and the
+    rest have 'continue', so that an echo application can decide whether to
+    end each session. Sessions that aren't closed are abandoned, as they
+    would be by a user hanging up.
+
+    `request` is called with the content, msisdn and session id of each
+    request and should return a deferred that fires once it has a
+    response.
+    """
+
+    def __init__(self, request, steps=3, think_time=0, close_ratio=1.0,
+                 ramp_up=0, seed=0):
+        self.request = request
+        self.steps = steps
+        self.think_time = think_time
+        self.ramp_up = ramp_up
+        self.close_ratio = close_ratio
+        self.random = random.Random(seed)
+        self.sessions = 0
+
+    @inlineCallbacks
+    def run(self, sessions):
+        """
+        Runs `sessions` concurrent sessions. Returns the number of seconds
+        taken and the round-trip latency of each request.
+        """
+        latencies = []
+        started = time.time()
+
+        yield DeferredList([
+            self.run_session(latencies) for _ in range(sessions)],
+            fireOnOneErrback=True, consumeErrors=True)
+
+        returnValue((time.time() - started, latencies))
+
+    @inlineCallbacks
+    def run_session(self, latencies):
+        self.sessions += 1
+        session_id = str(self.sessions)
+        msisdn = '+27%09d' % (self.sessions,)
+        close = self.random.random() < self.close_ratio
+        yield self.sleep(self.random.uniform(0, self.ramp_up))
+
+        for step in range(self.steps):
+            if step > 0:
+                yield self.sleep(self.think_time)
+
+            last = step == self.steps - 1
+            content = 'close' if last and close else 'continue'
+
+            started = time.time()
+            yield self.request(content, msisdn, session_id)
+            latencies.append(time.time() - started)
+
+    def sleep(self, seconds):
+        return deferLater(reactor, seconds, lambda: None)
+
+
+class CountingRedis(object):
+    """Wraps a Redis manager, counting the calls made to it."""
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.calls = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self.redis, name)
+
+        if not callable(attr) or name.startswith('_'):
+            return attr
+
+        def call(*args, **kw):
+            self.calls += 1
+            return attr(*args, **kw)
+
+        return call
+
+
+class DelayedRedis(CountingRedis):
+    """
+    Wraps a Redis manager, delaying the reply to each call by `rtt`
+    seconds to simulate the round trip to a Redis server. Calls made
+    without waiting for earlier replies are delayed together, as they would
+    be when pipelined over a connection.
+    """
+
+    def __init__(self, redis, rtt):
+        super(DelayedRedis, self).__init__(redis)
+        self.rtt = rtt
+
+    def __getattr__(self, name):
+        attr = super(DelayedRedis, self).__getattr__(name)
+
+        if not callable(attr) or name.startswith('_'):
+            return attr
+
+        def call(*args, **kw):
+            d = attr(*args, **kw)
+            return deferLater(reactor, self.rtt, lambda: d)
+
+        return call
+
+
+def peak_rss():
+    """Returns the peak resident set size of this process in kilobytes."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is in bytes on OS X and kilobytes elsewhere
+    if sys.platform == 'darwin':
+        rss //= 1024
+
+    return rss
+
+
+def summarize(seconds, latencies):
+    return {
+        'count': len(latencies),
+        'seconds': seconds,
+        'msgs_per_sec': len(latencies) / seconds if seconds else None,
+        'latency_p50': percentile(latencies, 50),
+        'latency_p95': percentile(latencies, 95),
+        'latency_p99': percentile(latencies, 99),
+        'latency_max': max(latencies) if latencies else None,
+        'peak_rss_kb': peak_rss(),
+    }
+
+
+def report(name, params, results):
+    """
+    Prints `results` and saves them, along with `params` and details of the
+    environment, as JSON in VXVAS2NETS_BENCHMARK_OUTPUT if it is set.
+    """
+    print
+    print name
+
+    for key, value in sorted(results.iteritems()):
+        print '  %-20s %s' % (key, format_value(value))
+
+    path = os.environ.get('VXVAS2NETS_BENCHMARK_OUTPUT')
+
+    if path is None:
+        return
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    with open(os.path.join(path, '%s.json' % (name,)), 'w') as f:
+        json.dump({
+            'benchmark': name,
+            'version': vxvas2nets.__version__,
+            'python': sys.version.split()[0],
+            'platform': sys.platform,
+            'timestamp': time.time(),
+            'params': params,
+            'results': results,
+        }, f, indent=2, sort_keys=True)
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return '%.6f' % (value,)
+    else:
+        return str(value)
@@ -0,0 +1,19 @@
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, Deferred
+
+
+@inlineCallbacks
+def wait_for(predicate, tries=100):
+    """
+    Waits for `predicate` to return true, checking it once each time the
+    reactor runs, for up to `tries` times.
+    """
+    for _ in range(tries):
+        if predicate():
+            return
+
+        d = Deferred()
+        reactor.callLater(0, d.callback, None)
+        yield d
+
+    raise AssertionError("Timed out waiting for condition")
@@ -0,0 +1,104 @@
+from twisted.internet.defer import inlineCallbacks, fail
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+
+from vxvas2nets.dedup import MemoryDedupCache, RedisDedupCache
+
+
+class TestMemoryDedupCache(VumiTestCase):
+    def setUp(self):
+        self.clock = Clock()
+
+    @inlineCallbacks
+    def test_get_set(self):
+        cache = MemoryDedupCache(self.clock, ttl=60, max_size=10)
+        self.assertEqual((yield cache.get('a')), None)
+
+        yield cache.set('a', {'event_type': 'ack'})
+        self.assertEqual((yield cache.get('a')), {'event_type': 'ack'})
+
+    @inlineCallbacks
+    def test_ttl(self):
+        cache = MemoryDedupCache(self.clock, ttl=60, max_size=10)
+        yield cache.set('a', {'event_type': 'ack'})
+
+        self.clock.advance(59)
+        self.assertEqual((yield cache.get('a')), {'event_type': 'ack'})
+
+        self.clock.advance(1)
+        self.assertEqual((yield cache.get('a')), None)
+        self.assertEqual(len(cache), 0)
+
+    @inlineCallbacks
+    def test_set_evicts_expired(self):
+        cache = MemoryDedupCache(self.clock, ttl=60, max_size=10)
+        yield cache.set('a', {'event_type': 'ack'})
+        yield cache.set('b', {'event_type': 'ack'})
+
+        self.clock.advance(60)
+        yield cache.set('c', {'event_type': 'ack'})
+        self.assertEqual(cache.entries.keys(), ['c'])
+
+    @inlineCallbacks
+    def test_max_size(self):
+        cache = MemoryDedupCache(self.clock, ttl=60, max_size=2)
+        yield cache.set('a', {'event_type': 'ack'})
+        yield cache.set('b', {'event_type': 'ack'})
+
+        # 'a' is now more recently used than 'b'
+        yield cache.get('a')
+        yield cache.set('c', {'event_type': 'ack'})
+
+        self.assertEqual((yield cache.get('a')), {'event_type': 'ack'})
+        self.assertEqual((yield cache.get('b')), None)
+        self.assertEqual((yield cache.get('c')), {'event_type': 'ack'})
+
+    @inlineCallbacks
+    def test_add(self):
+        cache = MemoryDedupCache(self.clock, ttl=60, max_size=10)
+        self.assertTrue((yield cache.add('a', {'message_id': '1'})))
+        self.assertFalse((yield cache.add('a', {'message_id': '2'})))
+        self.assertEqual((yield cache.get('a')), {'message_id': '1'})
+
+        self.clock.advance(60)
+        self.assertTrue((yield cache.add('a', {'message_id': '3'})))
+
+    @inlineCallbacks
+    def test_delete(self):
+        cache = MemoryDedupCache(self.clock, ttl=60, max_size=10)
+        yield cache.set('a', {'event_type': 'ack'})
+        yield cache.delete('a')
+        self.assertEqual((yield cache.get('a')), None)
+
+
+class TestRedisDedupCache(VumiTestCase):
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.cache = RedisDedupCache(self.redis, ttl=60, prefix='dedup')
+
+    @inlineCallbacks
+    def test_add(self):
+        self.assertTrue((yield self.cache.add('a', {'message_id': '1'})))
+        self.assertFalse((yield self.cache.add('a', {'message_id': '2'})))
+        self.assertEqual((yield self.cache.get('a')), {'message_id': '1'})
+        self.assertEqual((yield self.redis.ttl('dedup:a')), 60)
+
+    @inlineCallbacks
+    def test_add_existing_without_ttl(self):
+        yield self.redis.set('dedup:a', '{"message_id": "1"}')
+
+        self.assertFalse((yield self.cache.add('a', {'message_id': '2'})))
+        self.assertEqual((yield self.redis.ttl('dedup:a')), 60)
+
+    @inlineCallbacks
+    def test_add_expire_failed(self):
+        self.patch(self.redis, 'expire', lambda key, seconds: fail(
+            Exception('Redis went away')))
+
+        yield self.assertFailure(
+            self.cache.add('a', {'message_id': '1'}), Exception)
+
+        self.assertEqual((yield self.cache.get('a')), None)
@@ -0,0 +1,173 @@
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+
+from vumi.blinkenlights.metrics import MetricManager
+from vumi.tests.helpers import VumiTestCase
+
+from vxvas2nets.instrumentation import (
+    Instrumentation, LatencyHistogram, LatencyHistogramWindow, percentile)
+
+
+class TestLatencyHistogram(VumiTestCase):
+    def test_observe(self):
+        histogram = LatencyHistogram(buckets=(0.1, 1.0))
+        histogram.observe(0.05)
+        histogram.observe(0.1)
+        histogram.observe(0.5)
+        histogram.observe(2)
+
+        self.assertEqual(histogram.counts, [2, 1, 1])
+        self.assertEqual(histogram.count, 4)
+        self.assertEqual(histogram.sum, 2.65)
+
+        self.assertEqual(list(histogram.cumulative_counts()), [
+            (0.1, 2),
+            (1.0, 3),
+            (float('inf'), 4),
+        ])
+
+    def test_merge(self):
+        histogram = LatencyHistogram(buckets=(0.1, 1.0))
+        histogram.observe(0.05)
+        other = LatencyHistogram(buckets=(0.1, 1.0))
+        other.observe(0.5)
+        other.observe(2)
+
+        histogram.merge(other)
+        self.assertEqual(histogram.counts, [1, 1, 1])
+        self.assertEqual(histogram.count, 3)
+        self.assertEqual(histogram.sum, 2.55)
+
+    def test_percentile(self):
+        histogram = LatencyHistogram(buckets=(0.1, 1.0))
+        self.assertEqual(histogram.percentile(95), None)
+
+        for _ in range(19):
+            histogram.observe(0.05)
+
+        histogram.observe(0.5)
+        self.assertEqual(histogram.percentile(50), 0.1)
+        self.assertEqual(histogram.percentile(95), 0.1)
+        self.assertEqual(histogram.percentile(99), 1.0)
+
+        histogram.observe(2)
+        self.assertEqual(histogram.percentile(100), float('inf'))
+
+
+class TestLatencyHistogramWindow(VumiTestCase):
+    def test_histogram(self):
+        clock = Clock()
+        window = LatencyHistogramWindow(clock, 10, buckets=(0.1, 1.0))
+        window.observe(0.05)
+        clock.advance(5)
+        window.observe(0.5)
+        window.observe(2)
+
+        histogram = window.histogram()
+        self.assertEqual(histogram.counts, [1, 1, 1])
+        self.assertEqual(histogram.count, 3)
+
+    def test_histogram_expired(self):
+        clock = Clock()
+        window = LatencyHistogramWindow(clock, 10, buckets=(0.1, 1.0))
+        window.observe(0.05)
+        clock.advance(5)
+        window.observe(0.5)
+
+        clock.advance(5)
+        self.assertEqual(window.histogram().counts, [0, 1, 0])
+
+        clock.advance(5)
+        self.assertEqual(window.histogram().count, 0)
+        self.assertEqual(len(window.slices), 0)
+
+    def test_histogram_interval(self):
+        clock = Clock()
+        window = LatencyHistogramWindow(
+            clock, 10, interval=5, buckets=(0.1, 1.0))
+        window.observe(0.05)
+        clock.advance(4)
+        window.observe(0.5)
+        self.assertEqual(len(window.slices), 1)
+
+        clock.advance(1)
+        window.observe(2)
+        self.assertEqual(len(window.slices), 2)
+
+        clock.advance(5)
+        self.assertEqual(window.histogram().counts, [0, 0, 1])
+
+
+class TestInstrumentation(VumiTestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.metrics = MetricManager('test.')
+        self.instrumentation = Instrumentation(
+            self.clock, self.metrics, 'test')
+
+    def metric_values(self, name):
+        return [v for (_, v) in self.metrics[name].poll()]
+
+    def test_measure(self):
+        def f(a, b=None):
+            self.clock.advance(2)
+            return (a, b)
+
+        result = self.instrumentation.measure('foo', f, 1, b=2)
+        self.assertEqual(result, (1, 2))
+        self.assertEqual(self.instrumentation.histograms['foo'].sum, 2)
+        self.assertEqual(self.metric_values('stages.foo.latency'), [2])
+
+    def test_measure_deferred(self):
+        d = Deferred()
+        result = self.instrumentation.measure('foo', lambda: d)
+        self.assertFalse('foo' in self.instrumentation.histograms)
+
+        self.clock.advance(3)
+        d.callback('bar')
+        self.assertEqual(self.successResultOf(result), 'bar')
+        self.assertEqual(self.instrumentation.histograms['foo'].sum, 3)
+
+    def test_measure_error(self):
+        def f():
+            raise ValueError('Oops')
+
+        self.assertRaises(ValueError, self.instrumentation.measure, 'foo', f)
+        self.assertEqual(self.instrumentation.histograms['foo'].count, 1)
+
+    def test_count(self):
+        self.instrumentation.add_counter('bar')
+        self.instrumentation.count('foo')
+        self.instrumentation.count('foo')
+
+        self.assertEqual(self.instrumentation.counts, {'foo': 2, 'bar': 0})
+        self.assertEqual(self.metric_values('events.foo'), [1, 1])
+
+    def test_render(self):
+        self.instrumentation.record('foo', 0.003)
+        self.instrumentation.count('bar')
+
+        lines = self.instrumentation.render().splitlines()
+        self.assertEqual(lines[0], '# TYPE test_stage_seconds histogram')
+        self.assertTrue(
+            'test_stage_seconds_bucket{stage="foo",le="0.0025"} 0' in lines)
+        self.assertTrue(
+            'test_stage_seconds_bucket{stage="foo",le="0.005"} 1' in lines)
+        self.assertTrue(
+            'test_stage_seconds_bucket{stage="foo",le="+Inf"} 1' in lines)
+        self.assertTrue('test_stage_seconds_sum{stage="foo"} 0.003' in lines)
+        self.assertTrue('test_stage_seconds_count{stage="foo"} 1' in lines)
+        self.assertEqual(lines[-2:], [
+            '# TYPE test_events_total counter',
+            'test_events_total{event="bar"} 1',
+        ])
+
+
+class TestPercentile(VumiTestCase):
+    def test_percentile(self):
+        self.assertEqual(percentile([], 50), None)
+        self.assertEqual(percentile(range(1, 101), 50), 50)
+        self.assertEqual(percentile(range(1, 101), 99), 99)
+        self.assertEqual(percentile(range(1, 101), 100), 100)
+        self.assertEqual(percentile(range(1, 2001), 99), 1980)
+        self.assertEqual(percentile([3, 1, 2], 0), 1)
@@ -0,0 +1,121 @@
+import os
+
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase
+from vumi.tests.utils import LogCatcher
+
+from vxvas2nets.journal import Journal
+
+
+class TestJournal(VumiTestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.path = self.mktemp()
+
+    def mk_journal(self, **kw):
+        journal = Journal(self.path, clock=self.clock, **kw)
+        journal.open()
+        self.addCleanup(self.close_journal, journal)
+        return journal
+
+    def close_journal(self, journal):
+        if journal.segment_file is not None:
+            journal.close()
+
+    def segment_files(self):
+        return sorted(os.listdir(self.path))
+
+    def test_add(self):
+        journal = self.mk_journal()
+        d = journal.add('1', {'foo': 'bar'})
+        self.assertNoResult(d)
+
+        self.clock.advance(0)
+        self.successResultOf(d)
+        self.assertEqual(journal.pending(), [('1', {'foo': 'bar'})])
+        self.assertEqual(len(journal), 1)
+        self.assertTrue('1' in journal)
+
+    def test_group_commit(self):
+        journal = self.mk_journal()
+        fsyncs = []
+        self.patch(os, 'fsync', fsyncs.append)
+
+        d1 = journal.add('1', {})
+        d2 = journal.add('2', {})
+        self.clock.advance(0)
+
+        self.successResultOf(d1)
+        self.successResultOf(d2)
+        self.assertEqual(len(fsyncs), 1)
+
+    def test_done(self):
+        journal = self.mk_journal()
+        journal.add('1', {})
+        journal.add('2', {})
+        journal.done('1')
+        self.assertEqual(journal.pending(), [('2', {})])
+        self.assertEqual(journal.first(), ('2', {}))
+
+        journal.done('2')
+        self.assertEqual(journal.first(), None)
+
+    def test_reopen(self):
+        journal = self.mk_journal()
+        journal.add('1', {'foo': 'bar'})
+        journal.add('2', {'baz': 'quux'})
+        journal.done('1')
+        journal.close()
+
+        journal = self.mk_journal()
+        self.assertEqual(journal.pending(), [('2', {'baz': 'quux'})])
+
+    def test_reopen_partial_record(self):
+        journal = self.mk_journal()
+        journal.add('1', {})
+        journal.close()
+
+        [filename] = self.segment_files()
+
+        with open(os.path.join(self.path, filename), 'ab') as f:
+            f.write('{"type": "add", "id": "2", "da')
+
+        with LogCatcher() as lc:
+            journal = self.mk_journal()
+
+        self.assertEqual(journal.pending(), [('1', {})])
+        [log] = lc.messages()
+        self.assertTrue(log.startswith('Ignoring partial journal record'))
+
+    def test_segments(self):
+        journal = self.mk_journal(segment_size=1)
+        journal.add('1', {})
+        journal.add('2', {})
+        journal.add('3', {})
+        self.assertEqual(len(self.segment_files()), 3)
+
+        # The first segment needs to be deleted before the second one can be
+        journal.done('2')
+        self.assertEqual(len(self.segment_files()), 4)
+
+        journal.done('1')
+        self.assertEqual(len(self.segment_files()), 3)
+        journal.close()
+
+        journal = self.mk_journal(segment_size=1)
+        self.assertEqual(journal.pending(), [('3', {})])
+
+        journal.done('3')
+        self.assertEqual(len(self.segment_files()), 1)
+
+    def test_disk_usage(self):
+        journal = self.mk_journal()
+        self.assertEqual(journal.disk_usage(), 0)
+
+        journal.add('1', {})
+        journal.close()
+
+        [filename] = self.segment_files()
+        size = os.path.getsize(os.path.join(self.path, filename))
+        self.assertEqual(journal.disk_usage(), size)
@@ -0,0 +1,420 @@
+import time
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+
+from vxvas2nets.session import (
+    UssdSessionManager, MemorySessionManager, SessionCache, TimerWheel)
+from vxvas2nets.tests.benchmarks import (
+    skip_unless_benchmarking, get_params, DelayedRedis, summarize, report,
+    peak_rss)
+
+
+class TestUssdSessionManager(VumiTestCase):
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.manager = UssdSessionManager(self.redis, max_session_length=60)
+
+    @inlineCallbacks
+    def test_touch_or_create_new(self):
+        created = yield self.manager.touch_or_create(
+            '4', created_at=23, transaction_id='4')
+
+        self.assertTrue(created)
+
+        session = yield self.manager.load_session('4')
+        self.assertEqual(session, {'created_at': '23', 'transaction_id': '4'})
+
+        ttl = yield self.redis.ttl('session:4')
+        self.assertEqual(ttl, 60)
+
+    @inlineCallbacks
+    def test_touch_or_create_existing(self):
+        yield self.manager.create_session('4', transaction_id='4')
+        [session] = yield self.redis.keys()
+        yield self.redis.persist(session)
+
+        created = yield self.manager.touch_or_create(
+            '4', created_at=23, transaction_id='5')
+
+        self.assertFalse(created)
+
+        session = yield self.manager.load_session('4')
+        self.assertNotEqual(session['created_at'], '23')
+        self.assertEqual(session['transaction_id'], '4')
+
+        ttl = yield self.redis.ttl('session:4')
+        self.assertEqual(ttl, 60)
+
+    @inlineCallbacks
+    def test_touch_or_create_concurrent(self):
+        d1 = self.manager.touch_or_create('4', created_at=23)
+        d2 = self.manager.touch_or_create('4', created_at=24)
+
+        created1 = yield d1
+        created2 = yield d2
+        self.assertEqual([created1, created2], [True, False])
+
+    @inlineCallbacks
+    def test_touch_or_create_no_expiry(self):
+        manager = UssdSessionManager(self.redis)
+        yield manager.touch_or_create('4', created_at=23)
+
+        ttl = yield self.redis.ttl('session:4')
+        self.assertEqual(ttl, None)
+
+    @inlineCallbacks
+    def test_touch_or_create_after_clear(self):
+        yield self.manager.touch_or_create('4', created_at=23)
+        yield self.manager.clear_session('4')
+        created = yield self.manager.touch_or_create('4', created_at=24)
+        self.assertTrue(created)
+
+
+class TestTimerWheel(VumiTestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.due = []
+
+    def mk_wheel(self, tick=1.0, size=4):
+        wheel = TimerWheel(self.clock, self.due.append, tick, size)
+        wheel.start()
+        self.addCleanup(wheel.stop)
+        return wheel
+
+    def test_schedule(self):
+        wheel = self.mk_wheel()
+        wheel.schedule(2, 'a')
+        wheel.schedule(2.5, 'b')
+        wheel.schedule(1, 'c')
+
+        self.clock.advance(1)
+        self.assertEqual(self.due, ['c'])
+
+        self.clock.advance(1)
+        self.assertEqual(self.due, ['c', 'a'])
+
+        self.clock.advance(1)
+        self.assertEqual(self.due, ['c', 'a', 'b'])
+        self.assertEqual(len(wheel), 0)
+
+    def test_schedule_past(self):
+        wheel = self.mk_wheel()
+        self.clock.advance(3)
+        wheel.schedule(1, 'a')
+
+        self.clock.advance(1)
+        self.assertEqual(self.due, ['a'])
+
+    def test_schedule_beyond_wheel(self):
+        """
+        Items scheduled more than a rotation ahead come up early, and are
+        left to `due` to schedule again.
+        """
+        wheel = self.mk_wheel()
+        wheel.schedule(5, 'a')
+
+        self.clock.advance(1)
+        self.assertEqual(self.due, ['a'])
+
+    def test_advance_many_ticks(self):
+        """
+        If several rotations' worth of time passes between ticks, each slot
+        is only visited once.
+        """
+        wheel = self.mk_wheel()
+        wheel.schedule(1, 'a')
+        wheel.schedule(3, 'b')
+
+        self.clock.pump([0] + [10])
+        self.assertEqual(sorted(self.due), ['a', 'b'])
+
+        wheel.schedule(12, 'c')
+        self.clock.advance(1)
+        self.assertEqual(sorted(self.due), ['a', 'b'])
+        self.clock.advance(1)
+        self.assertEqual(sorted(self.due), ['a', 'b', 'c'])
+
+
+class TestMemorySessionManager(VumiTestCase):
+    def setUp(self):
+        self.clock = Clock()
+
+    def mk_manager(self, max_session_length=60):
+        manager = MemorySessionManager(
+            self.clock, max_session_length=max_session_length)
+
+        manager.start()
+        self.addCleanup(manager.stop)
+        return manager
+
+    @inlineCallbacks
+    def test_touch_or_create(self):
+        manager = self.mk_manager()
+
+        created = yield manager.touch_or_create(
+            '4', created_at=23, transaction_id='4')
+        self.assertTrue(created)
+
+        created = yield manager.touch_or_create(
+            '4', created_at=24, transaction_id='5')
+        self.assertFalse(created)
+
+        session = yield manager.load_session('4')
+        self.assertEqual(session, {'created_at': 23, 'transaction_id': '4'})
+
+    @inlineCallbacks
+    def test_expiry(self):
+        manager = self.mk_manager()
+        yield manager.touch_or_create('4', created_at=0)
+
+        self.clock.advance(59)
+        session = yield manager.load_session('4')
+        self.assertNotEqual(session, {})
+
+        self.clock.advance(1)
+        self.assertEqual(manager.sessions, {})
+
+    @inlineCallbacks
+    def test_touch_restarts_expiry(self):
+        manager = self.mk_manager()
+        yield manager.touch_or_create('4', created_at=0)
+
+        self.clock.advance(50)
+        created = yield manager.touch_or_create('4', created_at=50)
+        self.assertFalse(created)
+
+        self.clock.advance(50)
+        self.assertEqual(len(manager.sessions), 1)
+
+        self.clock.advance(10)
+        self.assertEqual(manager.sessions, {})
+        self.assertEqual(len(manager.wheel), 0)
+
+    @inlineCallbacks
+    def test_expired_before_slot(self):
+        """
+        A session that has expired is treated as missing even if its slot in
+        the wheel hasn't come up yet.
+        """
+        manager = self.mk_manager()
+        yield manager.touch_or_create('4', created_at=0)
+        self.clock.seconds = lambda: 60.5
+
+        created = yield manager.touch_or_create('4', created_at=60.5)
+        self.assertTrue(created)
+
+    @inlineCallbacks
+    def test_clear_session(self):
+        manager = self.mk_manager()
+        yield manager.touch_or_create('4', created_at=0)
+        yield manager.clear_session('4')
+
+        session = yield manager.load_session('4')
+        self.assertEqual(session, {})
+
+        # Creating the session again doesn't leave it expiring at the old
+        # session's expiry time
+        self.clock.advance(30)
+        yield manager.touch_or_create('4', created_at=30)
+        self.clock.advance(30)
+        self.assertEqual(len(manager.sessions), 1)
+        self.clock.advance(30)
+        self.assertEqual(manager.sessions, {})
+
+    @inlineCallbacks
+    def test_schedule_session_expiry(self):
+        manager = self.mk_manager()
+        yield manager.touch_or_create('4', created_at=0)
+
+        updated = yield manager.schedule_session_expiry('4', 10)
+        self.assertEqual(updated, 1)
+
+        updated = yield manager.schedule_session_expiry('5', 10)
+        self.assertEqual(updated, 0)
+
+        self.clock.advance(10)
+        self.assertEqual(manager.sessions, {})
+
+    @inlineCallbacks
+    def test_create_and_save_session(self):
+        manager = self.mk_manager()
+        yield manager.create_session('4', foo='bar')
+        yield manager.save_session('4', {'baz': 'quux'})
+
+        session = yield manager.load_session('4')
+        self.assertEqual(session, {
+            'created_at': 0,
+            'foo': 'bar',
+            'baz': 'quux',
+        })
+
+        sessions = yield manager.active_sessions()
+        self.assertEqual(sessions, [('4', session)])
+
+    @inlineCallbacks
+    def test_no_expiry(self):
+        manager = self.mk_manager(max_session_length=None)
+        yield manager.touch_or_create('4', created_at=0)
+
+        self.clock.advance(3600)
+        self.assertEqual(len(manager.sessions), 1)
+        self.assertEqual(len(manager.wheel), 0)
+
+
+class TestSessionCache(VumiTestCase):
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_touch(self):
+        cache = SessionCache(self.clock, ttl=10, max_size=2)
+        self.assertFalse(cache.touch('a'))
+
+        cache.add('a')
+        self.assertTrue(cache.touch('a'))
+
+    def test_touch_expiry(self):
+        cache = SessionCache(self.clock, ttl=10, max_size=2)
+        cache.add('a')
+
+        self.clock.advance(9)
+        self.assertTrue(cache.touch('a'))
+
+        # Touching the session restarts its expiry time
+        self.clock.advance(9)
+        self.assertTrue(cache.touch('a'))
+
+        self.clock.advance(10)
+        self.assertFalse(cache.touch('a'))
+        self.assertEqual(len(cache), 0)
+
+    def test_add_evicts_least_recently_used(self):
+        cache = SessionCache(self.clock, ttl=10, max_size=2)
+        cache.add('a')
+        cache.add('b')
+        cache.touch('a')
+        cache.add('c')
+
+        self.assertEqual(len(cache), 2)
+        self.assertTrue(cache.touch('a'))
+        self.assertFalse(cache.touch('b'))
+        self.assertTrue(cache.touch('c'))
+
+    def test_delete(self):
+        cache = SessionCache(self.clock, ttl=10, max_size=2)
+        cache.add('a')
+        cache.delete('a')
+        cache.delete('b')
+        self.assertFalse(cache.touch('a'))
+
+
+class BenchmarkUssdSessionManager(VumiTestCase):
+    """
+    Compares the time taken to resume or create a session with separate
+    load and save calls to the time taken with `touch_or_create`, with a
+    simulated Redis round trip time. See `vxvas2nets.tests.benchmarks` for
+    how to run and tune it.
+    """
+
+    timeout = 600
+
+    @inlineCallbacks
+    def setUp(self):
+        skip_unless_benchmarking()
+        self.params = get_params(redis_rtt=0.001, steps=3)
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        redis = yield self.persistence_helper.get_redis_manager()
+        self.redis = DelayedRedis(redis, self.params['redis_rtt'])
+        self.manager = UssdSessionManager(self.redis, max_session_length=60)
+
+    @inlineCallbacks
+    def load_or_create(self, session_id):
+        session = yield self.manager.load_session(session_id)
+
+        if session:
+            yield self.manager.save_session(session_id, session)
+        else:
+            yield self.manager.create_session(
+                session_id, transaction_id=session_id)
+
+    def touch_or_create(self, session_id):
+        return self.manager.touch_or_create(
+            session_id, created_at=time.time(), transaction_id=session_id)
+
+    @inlineCallbacks
+    def run_requests(self, name, f):
+        self.redis.calls = 0
+        latencies = []
+        started = time.time()
+
+        for i in range(self.params['messages']):
+            session_id = '%s-%d' % (name, i // self.params['steps'])
+            request_started = time.time()
+            yield f(session_id)
+            latencies.append(time.time() - request_started)
+
+        results = summarize(time.time() - started, latencies)
+        results['session_ops_per_request'] = (
+            self.redis.calls / float(len(latencies)))
+        report('ussd_session_%s' % (name,), self.params, results)
+
+    @inlineCallbacks
+    def test_session_ops(self):
+        yield self.run_requests('load_or_create', self.load_or_create)
+        yield self.run_requests('touch_or_create', self.touch_or_create)
+
+
+class BenchmarkMemorySessionManager(VumiTestCase):
+    """
+    Measures the cost of each in-memory session operation, and the memory
+    taken by each live session. See `vxvas2nets.tests.benchmarks` for how
+    to run and tune it.
+    """
+
+    timeout = 600
+
+    def setUp(self):
+        skip_unless_benchmarking()
+        self.params = get_params(sessions=200000)
+
+    def test_session_ops(self):
+        clock = Clock()
+        manager = MemorySessionManager(clock, max_session_length=60)
+        manager.start()
+        self.addCleanup(manager.stop)
+
+        n = self.params['sessions']
+        session_ids = [str(i) for i in range(n)]
+        rss = peak_rss()
+
+        def timed(f):
+            started = time.time()
+
+            for session_id in session_ids:
+                f(session_id)
+
+            return (time.time() - started) / n
+
+        create = timed(lambda session_id: manager.touch_or_create(
+            session_id, created_at=0, transaction_id=session_id))
+
+        rss = peak_rss() - rss
+
+        touch = timed(lambda session_id: manager.touch_or_create(
+            session_id, created_at=0, transaction_id=session_id))
+
+        started = time.time()
+        clock.advance(60)
+        expire = (time.time() - started) / n
+
+        report('ussd_memory_sessions', self.params, {
+            'create_us': create * 1e6,
+            'touch_us': touch * 1e6,
+            'expire_us': expire * 1e6,
+            'bytes_per_session': rss * 1024.0 / n,
+            'peak_rss_kb': peak_rss(),
+        })
@@ -0,0 +1,157 @@
+from twisted.internet.defer import Deferred, succeed, fail
+from twisted.internet.task import Clock
+
+from vumi.config import ConfigError
+from vumi.tests.helpers import VumiTestCase
+from vumi.tests.utils import LogCatcher
+
+from vxvas2nets.status import StatusAggregator, StatusAggregatorConfig
+
+
+class TestStatusAggregator(VumiTestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.published = []
+
+    def publish(self, **status):
+        self.published.append(status)
+        return succeed(None)
+
+    def mk_aggregator(self, **kw):
+        aggregator = StatusAggregator(self.clock, self.publish, **kw)
+        aggregator.start()
+        self.addCleanup(aggregator.stop)
+        return aggregator
+
+    def mk_status(self, status, type, component='outbound'):
+        return {
+            'component': component,
+            'status': status,
+            'type': type,
+            'message': type,
+        }
+
+    def published_types(self):
+        return [(s['component'], s['type']) for s in self.published]
+
+    def test_mode_type(self):
+        aggregator = self.mk_aggregator(mode='type')
+        aggregator.add(**self.mk_status('ok', 'request_success'))
+        aggregator.add(**self.mk_status('ok', 'request_success'))
+        aggregator.add(**self.mk_status('down', 'request_timeout'))
+        aggregator.add(**self.mk_status('down', 'system_error'))
+        aggregator.add(**self.mk_status('down', 'system_error'))
+
+        self.assertEqual(self.published_types(), [
+            ('outbound', 'request_success'),
+            ('outbound', 'request_timeout'),
+            ('outbound', 'system_error'),
+        ])
+
+    def test_mode_change(self):
+        aggregator = self.mk_aggregator(mode='change')
+        aggregator.add(**self.mk_status('ok', 'request_success'))
+        aggregator.add(**self.mk_status('ok', 'request_success'))
+        aggregator.add(**self.mk_status('down', 'request_timeout'))
+        aggregator.add(**self.mk_status('down', 'system_error'))
+        aggregator.add(**self.mk_status('ok', 'request_success'))
+
+        self.assertEqual(self.published_types(), [
+            ('outbound', 'request_success'),
+            ('outbound', 'request_timeout'),
+            ('outbound', 'request_success'),
+        ])
+
+    def test_mode_none(self):
+        aggregator = self.mk_aggregator(mode='none')
+        aggregator.add(**self.mk_status('ok', 'request_success'))
+        aggregator.add(**self.mk_status('down', 'request_timeout'))
+        self.assertEqual(self.published, [])
+
+    def test_component_mode(self):
+        aggregator = self.mk_aggregator(mode='type', components={
+            'inbound': {'mode': 'change'},
+        })
+
+        aggregator.add(**self.mk_status('down', 'a', component='inbound'))
+        aggregator.add(**self.mk_status('down', 'b', component='inbound'))
+        aggregator.add(**self.mk_status('down', 'a', component='outbound'))
+        aggregator.add(**self.mk_status('down', 'b', component='outbound'))
+
+        self.assertEqual(self.published_types(), [
+            ('inbound', 'a'),
+            ('outbound', 'a'),
+            ('outbound', 'b'),
+        ])
+
+    def test_add_does_not_wait_for_publish(self):
+        aggregator = StatusAggregator(self.clock, lambda **kw: Deferred())
+        d = aggregator.add(**self.mk_status('ok', 'request_success'))
+        self.assertTrue(d.called)
+
+    def test_publish_error_logged(self):
+        aggregator = StatusAggregator(
+            self.clock, lambda **kw: fail(Exception('Oops')))
+
+        with LogCatcher() as lc:
+            aggregator.add(**self.mk_status('ok', 'request_success'))
+
+        [err] = lc.errors
+        self.assertEqual(err['why'], 'Error publishing status')
+        self.flushLoggedErrors(Exception)
+
+    def test_summary(self):
+        aggregator = self.mk_aggregator(
+            mode='none', summary_interval=60, components={
+                'response': {'summary': False},
+            })
+
+        aggregator.add(**self.mk_status('ok', 'request_success'))
+        aggregator.add(**self.mk_status('ok', 'request_success'))
+        aggregator.add(**self.mk_status('down', 'request_timeout'))
+        aggregator.add(**self.mk_status(
+            'ok', 'request_success', component='inbound'))
+        aggregator.add(**self.mk_status(
+            'ok', 'response_sent', component='response'))
+
+        self.clock.advance(59)
+        self.assertEqual(self.published, [])
+
+        self.clock.advance(1)
+        self.assertEqual(self.published, [{
+            'component': 'inbound',
+            'status': 'ok',
+            'type': 'status_summary',
+            'message': 'Status summary',
+            'details': {
+                'interval': 60,
+                'counts': {'request_success': 1},
+            },
+        }, {
+            'component': 'outbound',
+            'status': 'down',
+            'type': 'status_summary',
+            'message': 'Status summary',
+            'details': {
+                'interval': 60,
+                'counts': {'request_success': 2, 'request_timeout': 1},
+            },
+        }])
+
+        del self.published[:]
+        self.clock.advance(60)
+        self.assertEqual(self.published, [])
+
+    def test_summary_disabled(self):
+        aggregator = self.mk_aggregator(mode='none')
+        aggregator.add(**self.mk_status('ok', 'request_success'))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_config_invalid_mode(self):
+        self.assertRaises(
+            ConfigError, StatusAggregatorConfig, {'status_mode': 'foo'})
+
+        self.assertRaises(
+            ConfigError, StatusAggregatorConfig, {
+                'status_components': {'inbound': {'mode': 'foo'}},
+            })
@@ -1,15 +1,22 @@
 # -*- encoding: utf-8 -*-
 
 import json
+import random
+import timeit
 from urllib import urlencode
 from urlparse import urljoin
 
 from twisted.web import http
 from twisted.internet import reactor
 from twisted.internet.task import Clock
-from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, fail)
+from twisted.internet.protocol import Factory
 from twisted.web.client import HTTPConnectionPool
-from twisted.web.server import NOT_DONE_YET
+from twisted.web.server import NOT_DONE_YET, Request
+from twisted.web.test.test_web import DummyChannel
+
+from vumi.config import ConfigError
 
 import treq
 
@@ -19,6 +26,14 @@ from vumi.tests.utils import LogCatcher
 from vumi.tests.utils import MockHttpServer
 
 from vxvas2nets import Vas2NetsSmsTransport
+from vxvas2nets.journal import Journal
+from vxvas2nets.tests.benchmarks import (
+    skip_unless_benchmarking, get_params, parse_errors, FakeVas2NetsServer,
+    run_concurrently, summarize, report)
+from vxvas2nets.tests.helpers import wait_for
+from vxvas2nets.vas2nets_sms import (
+    TokenBucket, CircuitBreaker, Endpoint, EndpointBalancer, PriorityLanes,
+    SendBatcher, LatencyWindow)
 
 
 class TestVas2NetsSmsTransport(VumiTestCase):
@@ -72,6 +87,46 @@ class TestVas2NetsSmsTransport(VumiTestCase):
         reactor.callLater(0, d.callback, None)
         return d
 
+    def wait_for_retry_scheduled(self):
+        def retry_scheduled():
+            return any(
+                isinstance(getattr(call.func, '__self__', None), Deferred)
+                for call in self.clock.getDelayedCalls())
+
+        return wait_for(retry_scheduled)
+
+    @inlineCallbacks
+    def mk_refused_url(self):
+        port = reactor.listenTCP(0, Factory(), interface='127.0.0.1')
+        url = 'http://127.0.0.1:%d/nonreply' % (port.getHost().port,)
+        yield port.stopListening()
+        returnValue(url)
+
+    def wait_for_commits(self, predicate):
+        """
+        Waits for `predicate` to be true, running the journal commits
+        scheduled on the test clock in the meantime.
+        """
+        def check():
+            self.clock.advance(0)
+            return predicate()
+
+        return wait_for(check)
+
+    def run_commits(self, d):
+        """
+        Waits for `d` to fire, running the journal commits scheduled on the
+        test clock in the meantime.
+        """
+        fired = []
+
+        def cb(result):
+            fired.append(True)
+            return result
+
+        d.addBoth(cb)
+        return self.wait_for_commits(lambda: fired).addCallback(lambda _: d)
+
     def capture_remote_requests(self, response='OK.1234'):
         def handler(req):
             reqs.append(req)
@@ -81,6 +136,34 @@ class TestVas2NetsSmsTransport(VumiTestCase):
         self.remote_request_handler = handler
         return reqs
 
+    def capture_pending_remote_requests(self):
+        def handler(req):
+            reqs.append(req)
+
+            while waiters and len(reqs) >= waiters[0][0]:
+                waiters.pop(0)[1].callback(reqs)
+
+            return NOT_DONE_YET
+
+        def wait_for(n):
+            d = Deferred()
+
+            if len(reqs) >= n:
+                d.callback(reqs)
+            else:
+                waiters.append((n, d))
+
+            return d
+
+        reqs = []
+        waiters = []
+        self.remote_request_handler = handler
+        return reqs, wait_for
+
+    def finish_remote_request(self, req, response='OK.1234'):
+        req.write(response)
+        req.finish()
+
     def remote_handle_request(self, req):
         return self.remote_request_handler(req)
 
@@ -92,6 +175,16 @@ class TestVas2NetsSmsTransport(VumiTestCase):
         for name, value in items.iteritems():
             self.assertEqual(obj[name], value)
 
+    @inlineCallbacks
+    def get_metrics(self, transport):
+        transport.metrics.publish_metrics()
+        [datapoints] = yield self.tx_helper.wait_for_dispatched_metrics()
+        self.tx_helper.clear_dispatched_metrics()
+
+        returnValue(dict(
+            (name, sum(v for (_, v) in values))
+            for (name, _, values) in datapoints))
+
     def assert_uri(self, actual_uri, path, params):
         actual_path, actual_params = actual_uri.split('?')
         self.assertEqual(actual_path, path)
@@ -149,6 +242,227 @@ class TestVas2NetsSmsTransport(VumiTestCase):
             'message': 'Request successful',
         })
 
+    def mk_inbound_request(self, msgid):
+        return self.tx_helper.mk_request(
+            sender='+123',
+            receiver='456',
+            msgdata='hi',
+            operator='MTN',
+            recvtime='2012-02-27 19-50-07',
+            msgid=msgid)
+
+    @inlineCallbacks
+    def test_inbound_journal(self):
+        transport = yield self.mk_transport(inbound_journal_path=self.mktemp())
+
+        res = yield self.run_commits(self.mk_inbound_request('789'))
+        self.assertEqual(res.code, http.OK)
+
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertEqual(
+            msg['transport_metadata'], {'vas2nets_sms': {'msgid': '789'}})
+
+        yield self.wait_for_commits(lambda: not transport.inbound_publishing)
+        self.assertEqual(transport.inbound_journal.pending(), [])
+
+    @inlineCallbacks
+    def test_inbound_journal_respond_before_publish(self):
+        transport = yield self.mk_transport(inbound_journal_path=self.mktemp())
+        published = Deferred()
+        self.patch(transport, 'publish_message', lambda **kw: published)
+
+        res = yield self.run_commits(self.mk_inbound_request('789'))
+        self.assertEqual(res.code, http.OK)
+
+        [(message_id, message)] = transport.inbound_journal.pending()
+        self.assertEqual(
+            message['transport_metadata'],
+            {'vas2nets_sms': {'msgid': '789'}})
+
+        published.callback(None)
+        yield self.wait_for_commits(lambda: not transport.inbound_publishing)
+        self.assertEqual(transport.inbound_journal.pending(), [])
+
+    @inlineCallbacks
+    def test_inbound_journal_publish_retry(self):
+        transport = yield self.mk_transport(
+            inbound_journal_path=self.mktemp(),
+            inbound_journal_retry_delay=5)
+
+        publish_message = transport.publish_message
+        errors = [ValueError('Publish failed')]
+        self.patch(
+            transport, 'publish_message',
+            lambda **kw: (
+                fail(errors.pop()) if errors else publish_message(**kw)))
+
+        res = yield self.run_commits(self.mk_inbound_request('789'))
+        self.assertEqual(res.code, http.OK)
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+        [(message_id, _)] = transport.inbound_journal.pending()
+        self.assertEqual(self.tx_helper.get_dispatched_inbound(), [])
+
+        self.clock.advance(5)
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertEqual(msg['message_id'], message_id)
+
+        yield self.wait_for_commits(lambda: not transport.inbound_publishing)
+        self.assertEqual(transport.inbound_journal.pending(), [])
+
+    def test_config_invalid_journal_retry_delay(self):
+        self.assertRaises(
+            ConfigError, Vas2NetsSmsTransport.CONFIG_CLASS, {
+                'transport_name': 'sphex',
+                'outbound_url': 'http://www.example.com/',
+                'reply_outbound_url': None,
+                'username': 'root',
+                'password': 't00r',
+                'inbound_journal_retry_delay': 0,
+            })
+
+    @inlineCallbacks
+    def test_inbound_journal_replay(self):
+        path = self.mktemp()
+        journal = Journal(path)
+        journal.open()
+        journal.add('abc', {
+            'message_id': 'abc',
+            'from_addr': '+123',
+            'from_addr_type': 'msisdn',
+            'to_addr': '456',
+            'content': 'hi',
+            'provider': 'MTN',
+            'transport_type': 'sms',
+            'transport_metadata': {'vas2nets_sms': {'msgid': '789'}},
+        })
+        journal.close()
+
+        transport = yield self.mk_transport(inbound_journal_path=path)
+
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertEqual(msg['message_id'], 'abc')
+        self.assertEqual(msg['content'], 'hi')
+
+        yield self.wait_for_commits(lambda: not transport.inbound_publishing)
+        self.assertEqual(transport.inbound_journal.pending(), [])
+
+    @inlineCallbacks
+    def test_inbound_dedup(self):
+        transport = yield self.mk_transport(inbound_dedup='memory')
+
+        res1 = yield self.mk_inbound_request('789')
+        res2 = yield self.mk_inbound_request('789')
+        res3 = yield self.mk_inbound_request('790')
+
+        self.assertEqual(res1.code, http.OK)
+        self.assertEqual(res2.code, http.OK)
+        self.assertEqual(res3.code, http.OK)
+
+        [msg1, msg2] = self.tx_helper.get_dispatched_inbound()
+        self.assertEqual(
+            msg1['transport_metadata'], {'vas2nets_sms': {'msgid': '789'}})
+        self.assertEqual(
+            msg2['transport_metadata'], {'vas2nets_sms': {'msgid': '790'}})
+
+        metrics = yield self.get_metrics(transport)
+        self.assertEqual(
+            metrics['vumi.transports.vas2nets_sms.sphex.inbound.duplicates'],
+            1)
+
+    @inlineCallbacks
+    def test_inbound_dedup_ttl(self):
+        yield self.mk_transport(inbound_dedup='memory', inbound_dedup_ttl=60)
+
+        yield self.mk_inbound_request('789')
+        self.clock.advance(60)
+        yield self.mk_inbound_request('789')
+
+        self.assertEqual(len(self.tx_helper.get_dispatched_inbound()), 2)
+
+    @inlineCallbacks
+    def test_inbound_dedup_redis(self):
+        yield self.mk_transport(inbound_dedup='redis')
+
+        yield self.mk_inbound_request('789')
+        res = yield self.mk_inbound_request('789')
+
+        self.assertEqual(res.code, http.OK)
+        self.assertEqual(len(self.tx_helper.get_dispatched_inbound()), 1)
+
+    @inlineCallbacks
+    def test_inbound_dedup_disabled(self):
+        yield self.mk_transport()
+
+        yield self.mk_inbound_request('789')
+        yield self.mk_inbound_request('789')
+
+        self.assertEqual(len(self.tx_helper.get_dispatched_inbound()), 2)
+
+    def mk_inbound_args_request(self, args):
+        request = Request(DummyChannel(), False)
+        request.args = args
+        return request
+
+    @inlineCallbacks
+    def test_inbound_field_values(self):
+        transport = yield self.mk_transport()
+
+        def assert_same(args):
+            request = self.mk_inbound_args_request(args)
+            self.assertEqual(
+                transport.get_inbound_field_values(request),
+                transport.get_field_values(
+                    request, transport.EXPECTED_FIELDS))
+
+        args = {
+            'sender': ['+123'],
+            'receiver': ['456'],
+            'msgdata': [u'hi \u2603'.encode('utf-8')],
+            'recvtime': ['2012-02-27 19-50-07'],
+            'msgid': ['789'],
+            'operator': ['MTN'],
+        }
+
+        assert_same(args)
+        assert_same(dict(args, msgdata=['a\0b']))
+        assert_same(dict(args, foo=['bar']))
+
+        missing = dict(args)
+        del missing['msgid']
+        assert_same(missing)
+
+        unexpected = dict(missing, foo=['bar'])
+        assert_same(unexpected)
+
+        self.assertEqual(
+            transport.get_inbound_field_values(
+                self.mk_inbound_args_request(args)),
+            ({
+                'sender': u'+123',
+                'receiver': u'456',
+                'msgdata': u'hi \u2603',
+                'recvtime': u'2012-02-27 19-50-07',
+                'msgid': u'789',
+                'operator': u'MTN',
+            }, {}))
+
+    @inlineCallbacks
+    def test_inbound_field_values_decode_error(self):
+        transport = yield self.mk_transport()
+
+        request = self.mk_inbound_args_request({
+            'sender': ['+123'],
+            'receiver': ['456'],
+            'msgdata': ['\xc3'],
+            'recvtime': ['2012-02-27 19-50-07'],
+            'msgid': ['789'],
+            'operator': ['MTN'],
+        })
+
+        self.assertRaises(
+            UnicodeDecodeError, transport.get_inbound_field_values, request)
+
     @inlineCallbacks
     def test_inbound_decode_error(self):
         transport = yield self.mk_transport()
@@ -577,6 +891,2442 @@ class TestVas2NetsSmsTransport(VumiTestCase):
             'message': 'Request timeout',
         })
 
+    @inlineCallbacks
+    def test_outbound_connection_error(self):
+        url = yield self.mk_refused_url()
+        yield self.mk_transport(outbound_url=url)
 
-def map_get(collection, key):
-    return dict((k, d.get(key)) for (k, d) in collection.iteritems())
+        msg = yield self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi')
+
+        [nack] = yield self.tx_helper.wait_for_dispatched_events(1)
+
+        self.assert_contains_items(nack, {
+            'event_type': 'nack',
+            'user_message_id': msg['message_id'],
+            'sent_message_id': msg['message_id'],
+            'nack_reason': 'Connection error',
+        })
+
+        [status] = self.tx_helper.get_dispatched_statuses()
+
+        self.assert_contains_items(status, {
+            'status': 'down',
+            'component': 'outbound',
+            'type': 'connection_error',
+        })
+
+        self.assertTrue(status['message'].startswith('Connection error: '))
+
+    @inlineCallbacks
+    def test_outbound_connection_reuse(self):
+        transport = yield self.mk_transport()
+        reqs = self.capture_remote_requests()
+
+        yield self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi')
+
+        yield self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi again')
+
+        self.assertEqual(len(reqs), 2)
+        self.assertEqual(transport.pool.opened, 1)
+        self.assertEqual(transport.pool.reused, 1)
+
+        metrics = yield self.get_metrics(transport)
+        prefix = 'vumi.transports.vas2nets_sms.sphex.'
+
+        self.assertEqual(metrics[prefix + 'outbound.connections.opened'], 1)
+        self.assertEqual(metrics[prefix + 'outbound.connections.reused'], 1)
+
+    @inlineCallbacks
+    def test_outbound_pool_config(self):
+        transport = yield self.mk_transport(
+            outbound_pool_max_per_host=5,
+            outbound_pool_idle_timeout=30)
+
+        self.assertEqual(transport.pool.maxPersistentPerHost, 5)
+        self.assertEqual(transport.pool.cachedConnectionTimeout, 30)
+        self.assertTrue(transport.pool.persistent)
+
+    @inlineCallbacks
+    def test_outbound_pool_prewarm(self):
+        reqs = self.capture_remote_requests()
+
+        transport = yield self.mk_transport(
+            outbound_url=urljoin(self.remote_server.url, 'nonreply'),
+            reply_outbound_url=urljoin(self.remote_server.url, 'reply'),
+            outbound_pool_prewarm=2)
+
+        self.assertEqual(
+            sorted((req.method, req.path) for req in reqs), [
+                ('HEAD', '/nonreply'),
+                ('HEAD', '/nonreply'),
+                ('HEAD', '/reply'),
+                ('HEAD', '/reply'),
+            ])
+
+        self.assertEqual(transport.pool.opened, 4)
+
+        yield self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi')
+
+        self.assertEqual(transport.pool.opened, 4)
+        self.assertEqual(transport.pool.reused, 1)
+
+    @inlineCallbacks
+    def test_health_connection_counts(self):
+        transport = yield self.mk_transport()
+
+        yield self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi')
+
+        health = json.loads(transport.get_health_response())
+
+        self.assert_contains_items(health, {
+            'pending_requests': 0,
+            'outbound_in_flight': 0,
+            'outbound_connections': {
+                'opened': 1,
+                'reused': 0,
+            }
+        })
+
+    @inlineCallbacks
+    def test_outbound_max_in_flight(self):
+        transport = yield self.mk_transport(outbound_max_in_flight=2)
+        connector = transport.connectors[transport.transport_name]
+        reqs, wait_for_reqs = self.capture_pending_remote_requests()
+
+        msg1 = yield self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='one')
+
+        self.assertFalse(connector.paused)
+
+        yield self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='two')
+
+        self.assertTrue(connector.paused)
+        self.assertEqual(len(transport.in_flight), 2)
+
+        msg3 = self.tx_helper.make_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='three')
+
+        self.tx_helper.dispatch_outbound(msg3)
+        yield wait_for_reqs(2)
+        self.assertEqual(len(reqs), 2)
+
+        [req1, req2] = reqs
+        self.assertEqual(req1.args['message'], ['one'])
+        self.assertEqual(req2.args['message'], ['two'])
+
+        self.finish_remote_request(req1)
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(ack['user_message_id'], msg1['message_id'])
+
+        yield wait_for_reqs(3)
+        req3 = reqs[2]
+        self.assertEqual(req3.args['message'], ['three'])
+        self.assertTrue(connector.paused)
+
+        self.finish_remote_request(req2)
+        self.finish_remote_request(req3)
+        yield self.tx_helper.wait_for_dispatched_events(3)
+
+        self.assertFalse(connector.paused)
+        self.assertEqual(transport.in_flight, set())
+
+    def make_outbound_reply(self, content):
+        return self.tx_helper.make_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content=content,
+            transport_metadata={'vas2nets_sms': {'msgid': '789'}})
+
+    @inlineCallbacks
+    def test_outbound_priority_lanes(self):
+        transport = yield self.mk_transport(
+            outbound_max_in_flight=1,
+            outbound_queue_size=10,
+            outbound_lane_weights={'reply': 2, 'bulk': 1})
+
+        reqs, wait_for_reqs = self.capture_pending_remote_requests()
+
+        for content in ['b1', 'b2', 'b3', 'b4']:
+            yield self.tx_helper.make_dispatch_outbound(
+                from_addr='456',
+                to_addr='+123',
+                content=content)
+
+        for content in ['r1', 'r2', 'r3']:
+            yield self.tx_helper.dispatch_outbound(
+                self.make_outbound_reply(content))
+
+        self.assertEqual(len(transport.in_flight), 1)
+        self.assertEqual(transport.lanes.depth('reply'), 3)
+        self.assertEqual(transport.lanes.depth('bulk'), 3)
+
+        for i in range(1, 8):
+            yield wait_for_reqs(i)
+            self.finish_remote_request(reqs[-1])
+
+        yield self.tx_helper.wait_for_dispatched_events(7)
+        self.assertEqual(
+            [req.args['message'][0] for req in reqs],
+            ['b1', 'r1', 'b2', 'r2', 'r3', 'b3', 'b4'])
+
+    @inlineCallbacks
+    def test_outbound_priority_lanes_full(self):
+        transport = yield self.mk_transport(
+            outbound_max_in_flight=1,
+            outbound_queue_size=2)
+
+        connector = transport.connectors[transport.transport_name]
+        reqs, wait_for_reqs = self.capture_pending_remote_requests()
+
+        for content in ['one', 'two']:
+            yield self.tx_helper.make_dispatch_outbound(
+                from_addr='456',
+                to_addr='+123',
+                content=content)
+
+        self.assertFalse(connector.paused)
+
+        yield self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='three')
+
+        self.assertTrue(connector.paused)
+
+        yield wait_for_reqs(1)
+        self.finish_remote_request(reqs[0])
+        yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertFalse(connector.paused)
+
+        yield wait_for_reqs(2)
+        self.finish_remote_request(reqs[1])
+        yield wait_for_reqs(3)
+        self.finish_remote_request(reqs[2])
+        yield self.tx_helper.wait_for_dispatched_events(3)
+
+        self.assertEqual(len(transport.lanes), 0)
+        self.assertEqual(transport.in_flight, set())
+
+    @inlineCallbacks
+    def test_outbound_priority_lane_metrics(self):
+        transport = yield self.mk_transport(
+            outbound_max_in_flight=1,
+            outbound_queue_size=10)
+
+        reqs, wait_for_reqs = self.capture_pending_remote_requests()
+
+        yield self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='one')
+
+        yield self.tx_helper.dispatch_outbound(
+            self.make_outbound_reply('two'))
+
+        self.clock.advance(3)
+        yield wait_for_reqs(1)
+        self.finish_remote_request(reqs[0])
+        yield wait_for_reqs(2)
+        self.finish_remote_request(reqs[1])
+        yield self.tx_helper.wait_for_dispatched_events(2)
+
+        def values(lane, name):
+            metric = transport.lane_metrics[lane][name]
+            return [v for (_, v) in metric.poll()]
+
+        self.assertEqual(values('bulk', 'depth'), [1, 0])
+        self.assertEqual(values('bulk', 'wait_time'), [0])
+        self.assertEqual(values('reply', 'depth'), [1, 0])
+        self.assertEqual(values('reply', 'wait_time'), [3])
+
+    @inlineCallbacks
+    def test_outbound_batch(self):
+        reqs = self.capture_remote_requests()
+        yield self.mk_transport(
+            outbound_max_in_flight=10,
+            outbound_batch_window=0.5)
+
+        msgs = [
+            self.tx_helper.make_outbound(
+                from_addr='456', to_addr=to_addr, content=content)
+            for (to_addr, content) in [
+                ('+1', 'hi'),
+                ('+2', 'hi'),
+                ('+3', 'bye'),
+                ('+4', 'hi'),
+            ]]
+
+        for msg in msgs:
+            yield self.tx_helper.dispatch_outbound(msg)
+
+        self.assertEqual(reqs, [])
+        self.clock.advance(0.5)
+
+        events = yield self.tx_helper.wait_for_dispatched_events(4)
+        self.assertEqual(
+            sorted(e['user_message_id'] for e in events),
+            sorted(m['message_id'] for m in msgs))
+        self.assertEqual(
+            set(e['event_type'] for e in events), set(['ack']))
+
+        self.assertEqual(sorted(
+            (req.args['message'], req.args['receiver']) for req in reqs), [
+            (['bye'], ['+3']),
+            (['hi'], ['+1,+2,+4']),
+        ])
+
+    @inlineCallbacks
+    def test_outbound_batch_statuses(self):
+        self.capture_remote_requests(
+            'OK.1\nERR-70 Invalid destination\nOK.3')
+
+        yield self.mk_transport(
+            outbound_max_in_flight=10,
+            outbound_batch_window=0.5)
+
+        msgs = [
+            self.tx_helper.make_outbound(
+                from_addr='456', to_addr=to_addr, content='hi')
+            for to_addr in ['+1', '+2', '+3']]
+
+        for msg in msgs:
+            yield self.tx_helper.dispatch_outbound(msg)
+
+        self.clock.advance(0.5)
+        events = yield self.tx_helper.wait_for_dispatched_events(3)
+        events = dict((e['user_message_id'], e) for e in events)
+        [event1, event2, event3] = [events[m['message_id']] for m in msgs]
+
+        self.assertEqual(event1['event_type'], 'ack')
+        self.assertEqual(event2['event_type'], 'nack')
+        self.assertEqual(event2['nack_reason'], 'Invalid destination')
+        self.assertEqual(event3['event_type'], 'ack')
+
+    @inlineCallbacks
+    def test_outbound_batch_max_size(self):
+        reqs = self.capture_remote_requests()
+        yield self.mk_transport(
+            outbound_max_in_flight=10,
+            outbound_batch_window=0.5,
+            outbound_batch_max_size=2)
+
+        for to_addr in ['+1', '+2']:
+            yield self.tx_helper.make_dispatch_outbound(
+                from_addr='456', to_addr=to_addr, content='hi')
+
+        yield self.tx_helper.wait_for_dispatched_events(2)
+
+        [req] = reqs
+        self.assertEqual(req.args['receiver'], ['+1,+2'])
+
+    @inlineCallbacks
+    def test_outbound_batch_rate_limit(self):
+        reqs = self.capture_remote_requests()
+        transport = yield self.mk_transport(
+            outbound_max_in_flight=10,
+            outbound_batch_window=0.5,
+            outbound_rate_limit=1,
+            outbound_rate_burst=2)
+
+        for to_addr in ['+1', '+2', '+3']:
+            yield self.tx_helper.make_dispatch_outbound(
+                from_addr='456', to_addr=to_addr, content='hi')
+
+        self.clock.advance(0.5)
+        yield wait_for(lambda: len(reqs) == 1)
+
+        # The batch took a token for each of its 3 receivers, leaving the
+        # bucket a token short. The next message waits until the bucket has
+        # a token again, 2 seconds after the batch was sent.
+        yield self.tx_helper.make_dispatch_outbound(
+            from_addr='456', to_addr='+4', content='bye')
+        self.clock.advance(0.5)
+
+        bucket = transport.buckets[transport.config['outbound_url']]
+        yield wait_for(lambda: bucket.waiting)
+
+        self.clock.advance(1.4)
+        self.assertEqual(len(reqs), 1)
+
+        self.clock.advance(0.1)
+        yield self.tx_helper.wait_for_dispatched_events(4)
+        self.assertEqual(len(reqs), 2)
+
+    @inlineCallbacks
+    def test_outbound_batch_reply(self):
+        reqs = self.capture_remote_requests()
+        yield self.mk_transport(
+            reply_outbound_url=urljoin(self.remote_server.url, 'reply'),
+            outbound_max_in_flight=10,
+            outbound_batch_window=0.5)
+
+        yield self.tx_helper.dispatch_outbound(
+            self.make_outbound_reply('hi'))
+
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(ack['event_type'], 'ack')
+
+        [req] = reqs
+        self.assertEqual(req.args['message_id'], ['789'])
+
+    def test_config_batch_requires_max_in_flight(self):
+        self.assertRaises(
+            ConfigError, Vas2NetsSmsTransport.CONFIG_CLASS, {
+                'transport_name': 'sphex',
+                'outbound_url': 'http://www.example.com/',
+                'reply_outbound_url': None,
+                'username': 'root',
+                'password': 't00r',
+                'outbound_batch_window': 0.5,
+            })
+
+    def test_config_invalid_max_in_flight(self):
+        self.assertRaises(
+            ConfigError, Vas2NetsSmsTransport.CONFIG_CLASS, {
+                'transport_name': 'sphex',
+                'outbound_url': 'http://www.example.com/',
+                'reply_outbound_url': None,
+                'username': 'root',
+                'password': 't00r',
+                'outbound_max_in_flight': 0,
+            })
+
+    def test_config_invalid_queue_size(self):
+        self.assertRaises(
+            ConfigError, Vas2NetsSmsTransport.CONFIG_CLASS, {
+                'transport_name': 'sphex',
+                'outbound_url': 'http://www.example.com/',
+                'reply_outbound_url': None,
+                'username': 'root',
+                'password': 't00r',
+                'outbound_max_in_flight': 2,
+                'outbound_queue_size': 0,
+            })
+
+    def test_config_priority_lanes_requires_max_in_flight(self):
+        self.assertRaises(
+            ConfigError, Vas2NetsSmsTransport.CONFIG_CLASS, {
+                'transport_name': 'sphex',
+                'outbound_url': 'http://www.example.com/',
+                'reply_outbound_url': None,
+                'username': 'root',
+                'password': 't00r',
+                'outbound_queue_size': 10,
+            })
+
+    def test_config_retry_requires_max_in_flight(self):
+        self.assertRaises(
+            ConfigError, Vas2NetsSmsTransport.CONFIG_CLASS, {
+                'transport_name': 'sphex',
+                'outbound_url': 'http://www.example.com/',
+                'reply_outbound_url': None,
+                'username': 'root',
+                'password': 't00r',
+                'outbound_retry_max_attempts': 3,
+            })
+
+    def test_config_invalid_lane_weights(self):
+        self.assertRaises(
+            ConfigError, Vas2NetsSmsTransport.CONFIG_CLASS, {
+                'transport_name': 'sphex',
+                'outbound_url': 'http://www.example.com/',
+                'reply_outbound_url': None,
+                'username': 'root',
+                'password': 't00r',
+                'outbound_lane_weights': {'reply': 1},
+            })
+
+    @inlineCallbacks
+    def test_outbound_rate_limit(self):
+        transport = yield self.mk_transport(
+            outbound_url=urljoin(self.remote_server.url, 'nonreply'),
+            reply_outbound_url=urljoin(self.remote_server.url, 'reply'),
+            outbound_rate_limit=1,
+            outbound_rate_burst=1)
+
+        reqs = self.capture_remote_requests()
+
+        yield self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi')
+
+        # replies are limited separately to non-replies
+        yield self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi',
+            transport_metadata={'vas2nets_sms': {'msgid': '789'}})
+
+        self.assertEqual(
+            [req.path for req in reqs],
+            ['/nonreply', '/reply'])
+
+        d = self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi')
+
+        bucket = transport.buckets[transport.config['outbound_url']]
+        yield wait_for(lambda: bucket.waiting)
+        self.assertEqual(len(reqs), 2)
+
+        self.clock.advance(1)
+        yield d
+
+        self.assertEqual(
+            [req.path for req in reqs],
+            ['/nonreply', '/reply', '/nonreply'])
+
+        events = yield self.tx_helper.wait_for_dispatched_events(3)
+        self.assertEqual(
+            [event['event_type'] for event in events],
+            ['ack', 'ack', 'ack'])
+
+    @inlineCallbacks
+    def test_outbound_rate_limit_multiple_urls(self):
+        transport = yield self.mk_transport(
+            outbound_url=urljoin(self.remote_server.url, 'nonreply1'),
+            outbound_urls=[
+                urljoin(self.remote_server.url, 'nonreply2'),
+                urljoin(self.remote_server.url, 'nonreply3'),
+            ],
+            outbound_balancing='weighted_round_robin',
+            outbound_max_in_flight=3,
+            outbound_rate_limit=1,
+            outbound_rate_burst=1)
+
+        reqs = self.capture_remote_requests()
+
+        for _ in range(3):
+            yield self.tx_helper.make_dispatch_outbound(
+                from_addr='456',
+                to_addr='+123',
+                content='hi')
+
+        # The urls share the rate limit of outbound_url
+        self.assertEqual(transport.buckets.keys(), [
+            transport.config['outbound_url']])
+
+        bucket = transport.buckets[transport.config['outbound_url']]
+        yield wait_for(lambda: len(bucket.waiting) == 2)
+        yield wait_for(lambda: len(reqs) == 1)
+
+        # Sends waiting for the rate limit aren't outstanding on a url
+        balancer = transport.balancers[transport.config['outbound_url']]
+        yield wait_for(lambda: sum(
+            e.outstanding for e in balancer.endpoints) == 0)
+
+        self.clock.advance(1)
+        yield wait_for(lambda: len(reqs) == 2)
+        self.clock.advance(1)
+        yield self.tx_helper.wait_for_dispatched_events(3)
+
+        self.assertEqual(
+            sorted(req.path for req in reqs),
+            ['/nonreply1', '/nonreply2', '/nonreply3'])
+
+    def test_config_invalid_rate_limit(self):
+        self.assertRaises(
+            ConfigError, Vas2NetsSmsTransport.CONFIG_CLASS, {
+                'transport_name': 'sphex',
+                'outbound_url': 'http://www.example.com/',
+                'reply_outbound_url': None,
+                'username': 'root',
+                'password': 't00r',
+                'outbound_rate_limit': 0,
+            })
+
+    def test_config_invalid_rate_burst(self):
+        self.assertRaises(
+            ConfigError, Vas2NetsSmsTransport.CONFIG_CLASS, {
+                'transport_name': 'sphex',
+                'outbound_url': 'http://www.example.com/',
+                'reply_outbound_url': None,
+                'username': 'root',
+                'password': 't00r',
+                'outbound_rate_burst': 0,
+            })
+
+    @inlineCallbacks
+    def test_outbound_retry(self):
+        responses = ['ERR-52 System error', 'ERR-52 System error', 'OK.1234']
+        reqs = []
+
+        def handler(req):
+            reqs.append(req)
+            return responses.pop(0)
+
+        transport = yield self.mk_transport(
+            outbound_max_in_flight=1,
+            outbound_retry_max_attempts=3,
+            outbound_retry_delay=2,
+            outbound_retry_jitter=0)
+
+        self.remote_request_handler = handler
+
+        msg = self.tx_helper.make_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi')
+
+        yield self.tx_helper.dispatch_outbound(msg)
+
+        yield self.wait_for_retry_scheduled()
+        self.assertEqual(len(reqs), 1)
+        self.clock.advance(2)
+
+        yield self.wait_for_retry_scheduled()
+        self.assertEqual(len(reqs), 2)
+        self.clock.advance(3)
+        self.assertEqual(len(reqs), 2)
+        self.clock.advance(1)
+
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(len(reqs), 3)
+
+        self.assert_contains_items(ack, {
+            'event_type': 'ack',
+            'user_message_id': msg['message_id'],
+        })
+
+        [status] = self.tx_helper.get_dispatched_statuses()
+        self.assertEqual(status['type'], 'request_success')
+
+        metrics = yield self.get_metrics(transport)
+        prefix = 'vumi.transports.vas2nets_sms.sphex.'
+        self.assertEqual(metrics[prefix + 'outbound.retries'], 2)
+        self.assertEqual(metrics[prefix + 'outbound.retries_exhausted'], 0)
+
+    @inlineCallbacks
+    def test_outbound_retry_exhausted(self):
+        reqs = self.capture_remote_requests('ERR-52 System error')
+
+        transport = yield self.mk_transport(
+            outbound_max_in_flight=1,
+            outbound_retry_max_attempts=2,
+            outbound_retry_delay=2,
+            outbound_retry_jitter=0)
+
+        msg = self.tx_helper.make_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi')
+
+        yield self.tx_helper.dispatch_outbound(msg)
+
+        yield self.wait_for_retry_scheduled()
+        self.clock.advance(2)
+
+        [nack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(len(reqs), 2)
+
+        self.assert_contains_items(nack, {
+            'event_type': 'nack',
+            'user_message_id': msg['message_id'],
+            'nack_reason': 'System error',
+        })
+
+        [status] = self.tx_helper.get_dispatched_statuses()
+        self.assertEqual(status['type'], 'system_error')
+
+        metrics = yield self.get_metrics(transport)
+        prefix = 'vumi.transports.vas2nets_sms.sphex.'
+        self.assertEqual(metrics[prefix + 'outbound.retries'], 1)
+        self.assertEqual(metrics[prefix + 'outbound.retries_exhausted'], 1)
+
+    @inlineCallbacks
+    def test_outbound_retry_connection_error(self):
+        url = yield self.mk_refused_url()
+        transport = yield self.mk_transport(
+            outbound_url=url,
+            outbound_max_in_flight=1,
+            outbound_retry_max_attempts=2,
+            outbound_retry_delay=2,
+            outbound_retry_jitter=0)
+
+        yield self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi')
+
+        yield self.wait_for_retry_scheduled()
+        self.clock.advance(2)
+
+        [nack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(nack['nack_reason'], 'Connection error')
+
+        metrics = yield self.get_metrics(transport)
+        prefix = 'vumi.transports.vas2nets_sms.sphex.'
+        self.assertEqual(metrics[prefix + 'outbound.retries'], 1)
+
+    @inlineCallbacks
+    def test_outbound_retry_non_retryable(self):
+        reqs = self.capture_remote_requests('ERR-33 Invalid login')
+
+        yield self.mk_transport(
+            outbound_max_in_flight=1,
+            outbound_retry_max_attempts=3)
+
+        yield self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi')
+
+        [nack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(len(reqs), 1)
+        self.assertEqual(nack['nack_reason'], 'Invalid login')
+
+    @inlineCallbacks
+    def test_outbound_retry_timeout(self):
+        self.remote_request_handler = lambda _: NOT_DONE_YET
+        yield self.mk_transport(
+            outbound_max_in_flight=1,
+            outbound_request_timeout=3,
+            outbound_retry_max_attempts=2,
+            outbound_retry_delay=5,
+            outbound_retry_jitter=0)
+
+        msg = self.tx_helper.make_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi')
+
+        yield self.patch_reactor_call_later()
+        d = self.tx_helper.dispatch_outbound(msg)
+        self.clock.advance(0)
+        self.clock.advance(3)  # first attempt times out
+        self.clock.advance(5)  # wait to retry
+        self.assertEqual(self.tx_helper.get_dispatched_events(), [])
+        self.clock.advance(3)  # second attempt times out
+        yield d
+
+        [nack] = yield self.tx_helper.get_dispatched_events()
+        self.assertEqual(nack['nack_reason'], 'Request timeout')
+
+    @inlineCallbacks
+    def test_outbound_adaptive_timeout(self):
+        transport = yield self.mk_transport(
+            outbound_request_timeout=3,
+            outbound_adaptive_timeout=True,
+            outbound_adaptive_timeout_multiple=2,
+            outbound_adaptive_timeout_min=1,
+            outbound_adaptive_timeout_max=10,
+            outbound_adaptive_timeout_min_samples=3)
+
+        self.assertEqual(transport.get_request_timeout(), 10)
+
+        transport.record_request_latency(2)
+        transport.record_request_latency(3)
+        self.assertEqual(transport.get_request_timeout(), 10)
+
+        transport.record_request_latency(1)
+        self.assertEqual(transport.get_request_timeout(), 6)
+
+        for _ in range(3):
+            transport.record_request_latency(6)
+
+        self.assertEqual(transport.get_request_timeout(), 10)
+
+        self.assertEqual(
+            [v for (_, v) in transport.latency_p99_metric.poll()],
+            [3, 6, 6, 6])
+        self.assertEqual(
+            [v for (_, v) in transport.request_timeout_metric.poll()],
+            [6, 10, 10, 10])
+
+    @inlineCallbacks
+    def test_outbound_adaptive_timeout_min(self):
+        transport = yield self.mk_transport(
+            outbound_adaptive_timeout=True,
+            outbound_adaptive_timeout_min=1,
+            outbound_adaptive_timeout_min_samples=2)
+
+        for content in ['one', 'two']:
+            yield self.tx_helper.make_dispatch_outbound(
+                from_addr='456',
+                to_addr='+123',
+                content=content)
+
+        # Requests take no time on the test clock
+        self.assertEqual(list(transport.latencies.latencies), [0, 0])
+        self.assertEqual(transport.get_request_timeout(), 1)
+
+    @inlineCallbacks
+    def test_outbound_adaptive_timeout_request_timeout(self):
+        '''Requests that time out during an outage shouldn't make the
+        timeout longer.'''
+        self.remote_request_handler = lambda _: NOT_DONE_YET
+        transport = yield self.mk_transport(
+            outbound_adaptive_timeout=True,
+            outbound_adaptive_timeout_multiple=3,
+            outbound_adaptive_timeout_min=1,
+            outbound_adaptive_timeout_max=30,
+            outbound_adaptive_timeout_min_samples=2)
+
+        transport.record_request_latency(1)
+        transport.record_request_latency(1)
+        self.assertEqual(transport.get_request_timeout(), 3)
+
+        yield self.patch_reactor_call_later()
+
+        for i in range(20):
+            msg = self.tx_helper.make_outbound(
+                from_addr='456',
+                to_addr='+123',
+                content='hi')
+
+            d = self.tx_helper.dispatch_outbound(msg)
+            self.clock.advance(0)
+            self.clock.advance(3)
+            yield d
+
+        nacks = yield self.tx_helper.get_dispatched_events()
+        self.assertEqual(
+            [nack['nack_reason'] for nack in nacks],
+            ['Request timeout'] * 20)
+
+        self.assertEqual(transport.get_request_timeout(), 3)
+        self.assertEqual(list(transport.latencies.latencies), [1, 1])
+
+    @inlineCallbacks
+    def test_outbound_adaptive_timeout_inbound_request_timeout(self):
+        '''The adaptive timeout is only for outbound requests, inbound
+        requests should still use `request_timeout`.'''
+        transport = yield self.mk_transport(
+            request_timeout=240,
+            outbound_adaptive_timeout=True,
+            outbound_adaptive_timeout_min=1,
+            outbound_adaptive_timeout_min_samples=2)
+
+        for _ in range(30):
+            transport.record_request_latency(0.05)
+
+        self.assertEqual(transport.get_request_timeout(), 1)
+        self.assertEqual(transport.request_timeout, 240)
+
+        closed = []
+        self.patch(transport, 'close_request', closed.append)
+        transport._requests['abc'] = {'timestamp': self.clock.seconds()}
+
+        # Requests are closed by the request gc on the transport's clock
+        self.clock.advance(2)
+        self.assertEqual(closed, [])
+
+        self.clock.advance(239)
+        self.assertEqual(closed, ['abc'])
+        del transport._requests['abc']
+
+    @inlineCallbacks
+    def test_retry_delay(self):
+        transport = yield self.mk_transport(
+            outbound_retry_delay=1,
+            outbound_retry_max_delay=5,
+            outbound_retry_jitter=0)
+
+        self.assertEqual(
+            [transport.get_retry_delay(i) for i in range(1, 6)],
+            [1, 2, 4, 5, 5])
+
+    @inlineCallbacks
+    def test_retry_delay_jitter(self):
+        transport = yield self.mk_transport(
+            outbound_retry_delay=4,
+            outbound_retry_jitter=0.5)
+
+        self.patch(random, 'random', lambda: 1)
+        self.assertEqual(transport.get_retry_delay(1), 2)
+
+        self.patch(random, 'random', lambda: 0)
+        self.assertEqual(transport.get_retry_delay(1), 4)
+
+    @inlineCallbacks
+    def test_outbound_circuit_breaker(self):
+        reqs = self.capture_remote_requests()
+
+        def fail(req):
+            reqs.append(req)
+            req.setResponseCode(502)
+            return 'Bad Gateway'
+
+        self.remote_request_handler = fail
+
+        yield self.mk_transport(
+            outbound_breaker_failure_ratio=1,
+            outbound_breaker_window=2,
+            outbound_breaker_min_sends=2,
+            outbound_breaker_reset_timeout=30)
+
+        for _ in range(2):
+            yield self.tx_helper.make_dispatch_outbound(
+                from_addr='456',
+                to_addr='+123',
+                content='hi')
+
+        self.assertEqual(len(reqs), 2)
+
+        [_, status] = self.tx_helper.get_dispatched_statuses()
+        self.assert_contains_items(status, {
+            'component': 'outbound_circuit',
+            'status': 'down',
+            'type': 'circuit_open',
+        })
+
+        self.tx_helper.clear_dispatched_events()
+        self.tx_helper.clear_dispatched_statuses()
+
+        msg = yield self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi')
+
+        self.assertEqual(len(reqs), 2)
+
+        [nack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assert_contains_items(nack, {
+            'event_type': 'nack',
+            'user_message_id': msg['message_id'],
+            'nack_reason': 'Circuit breaker open',
+        })
+
+        self.assertEqual(self.tx_helper.get_dispatched_statuses(), [])
+
+        self.clock.advance(30)
+        [status] = yield self.tx_helper.wait_for_dispatched_statuses()
+        self.assert_contains_items(status, {
+            'component': 'outbound_circuit',
+            'status': 'degraded',
+            'type': 'circuit_half_open',
+        })
+
+        self.tx_helper.clear_dispatched_events()
+        self.tx_helper.clear_dispatched_statuses()
+        self.capture_remote_requests()
+
+        yield self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi')
+
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(ack['event_type'], 'ack')
+
+        statuses = self.tx_helper.get_dispatched_statuses()
+        self.assertEqual(
+            [(s['component'], s['type']) for s in statuses], [
+                ('outbound_circuit', 'circuit_closed'),
+                ('outbound', 'request_success'),
+            ])
+
+    @inlineCallbacks
+    def test_outbound_circuit_breaker_hold(self):
+        reqs = self.capture_remote_requests('ERR-52 System error')
+
+        transport = yield self.mk_transport(
+            outbound_breaker_failure_ratio=1,
+            outbound_breaker_window=1,
+            outbound_breaker_min_sends=1,
+            outbound_breaker_reset_timeout=30,
+            outbound_breaker_hold=True)
+
+        yield self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi')
+
+        self.assertEqual(transport.breaker.state, CircuitBreaker.OPEN)
+        self.tx_helper.clear_dispatched_events()
+        reqs = self.capture_remote_requests()
+
+        d = self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi')
+
+        yield wait_for(lambda: transport.breaker.waiting)
+        self.assertEqual(reqs, [])
+
+        self.clock.advance(30)
+        msg = yield d
+
+        self.assertEqual(len(reqs), 1)
+        self.assertEqual(transport.breaker.state, CircuitBreaker.CLOSED)
+
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assert_contains_items(ack, {
+            'event_type': 'ack',
+            'user_message_id': msg['message_id'],
+        })
+
+    @inlineCallbacks
+    def test_outbound_circuit_breaker_hold_teardown(self):
+        '''Messages held by the breaker shouldn't hold up teardown.'''
+        self.capture_remote_requests('ERR-52 System error')
+
+        transport = yield self.mk_transport(
+            outbound_max_in_flight=3,
+            outbound_breaker_failure_ratio=1,
+            outbound_breaker_window=1,
+            outbound_breaker_min_sends=1,
+            outbound_breaker_reset_timeout=30,
+            outbound_breaker_hold=True)
+
+        yield self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi')
+
+        yield self.tx_helper.wait_for_dispatched_events(1)
+        self.tx_helper.clear_dispatched_events()
+
+        for _ in range(2):
+            yield self.tx_helper.make_dispatch_outbound(
+                from_addr='456',
+                to_addr='+123',
+                content='hi')
+
+        yield wait_for(lambda: len(transport.breaker.waiting) == 2)
+        yield self.tx_helper.cleanup_worker(transport)
+
+        nacks = self.tx_helper.get_dispatched_events()
+        self.assertEqual(
+            [nack['nack_reason'] for nack in nacks],
+            ['Circuit breaker open'] * 2)
+
+    @inlineCallbacks
+    def test_outbound_status_mode_change(self):
+        def handler(req):
+            [error] = req.args['message']
+            return error
+
+        yield self.mk_transport(
+            status_mode='change',
+            status_summary_interval=10)
+
+        self.remote_request_handler = handler
+
+        for content in ['OK', 'ERR-52 System error', 'ERR-33 Invalid login',
+                        'ERR-52 System error']:
+            yield self.tx_helper.make_dispatch_outbound(
+                from_addr='456',
+                to_addr='+123',
+                content=content)
+
+        statuses = self.tx_helper.get_dispatched_statuses()
+        self.assertEqual(
+            [(s['status'], s['type']) for s in statuses], [
+                ('ok', 'request_success'),
+                ('down', 'system_error'),
+            ])
+
+        self.tx_helper.clear_dispatched_statuses()
+        self.clock.advance(10)
+
+        [status] = yield self.tx_helper.wait_for_dispatched_statuses()
+        self.assert_contains_items(status, {
+            'component': 'outbound',
+            'status': 'down',
+            'type': 'status_summary',
+            'details': {
+                'interval': 10,
+                'counts': {
+                    'request_success': 1,
+                    'system_error': 2,
+                    'invalid_login': 1,
+                },
+            },
+        })
+
+    @inlineCallbacks
+    def test_outbound_unicode_content(self):
+        yield self.mk_transport()
+        reqs = self.capture_remote_requests()
+
+        yield self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content=u'ポケモン')
+
+        [req] = reqs
+        self.assertEqual(req.args['message'], [u'ポケモン'.encode('utf-8')])
+
+    @inlineCallbacks
+    def test_outbound_url_with_query(self):
+        yield self.mk_transport(
+            outbound_url=urljoin(self.remote_server.url, 'nonreply?foo=bar'))
+
+        reqs = self.capture_remote_requests()
+
+        yield self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi')
+
+        [req] = reqs
+        self.assertEqual(req.path, '/nonreply')
+        self.assertEqual(req.args, {
+            'foo': ['bar'],
+            'username': ['root'],
+            'message': ['hi'],
+            'password': ['t00r'],
+            'sender': ['456'],
+            'receiver': ['+123'],
+            'message_type': ['1'],
+        })
+
+    @inlineCallbacks
+    def test_outbound_multiple_urls(self):
+        transport = yield self.mk_transport(
+            outbound_url=urljoin(self.remote_server.url, 'nonreply1'),
+            outbound_urls=[urljoin(self.remote_server.url, 'nonreply2')],
+            reply_outbound_url=urljoin(self.remote_server.url, 'reply1'),
+            reply_outbound_urls=[{
+                'url': urljoin(self.remote_server.url, 'reply2'),
+                'weight': 2,
+            }],
+            outbound_balancing='weighted_round_robin')
+
+        reqs = self.capture_remote_requests()
+
+        for _ in range(4):
+            yield self.tx_helper.make_dispatch_outbound(
+                from_addr='456',
+                to_addr='+123',
+                content='hi')
+
+        for _ in range(3):
+            yield self.tx_helper.make_dispatch_outbound(
+                from_addr='456',
+                to_addr='+123',
+                content='hi',
+                transport_metadata={'vas2nets_sms': {'msgid': '789'}})
+
+        self.assertEqual(sorted(req.path for req in reqs), [
+            '/nonreply1',
+            '/nonreply1',
+            '/nonreply2',
+            '/nonreply2',
+            '/reply1',
+            '/reply2',
+            '/reply2',
+        ])
+
+        [req] = [req for req in reqs if req.path == '/reply1']
+        self.assertEqual(req.args['message_id'], ['789'])
+        self.assertEqual(req.args['username'], ['root'])
+
+        health = json.loads(transport.get_health_response())
+        self.assertEqual(
+            sorted(health['outbound_endpoints']),
+            sorted([transport.config['outbound_url'],
+                    transport.config['reply_outbound_url']]))
+
+    @inlineCallbacks
+    def test_outbound_eject_failing_url(self):
+        def handler(req):
+            reqs.append(req)
+
+            if req.path == '/bad':
+                req.setResponseCode(503)
+                return 'Service Unavailable'
+
+            return 'OK.1234'
+
+        reqs = []
+        self.remote_request_handler = handler
+
+        transport = yield self.mk_transport(
+            outbound_url=urljoin(self.remote_server.url, 'bad'),
+            outbound_urls=[urljoin(self.remote_server.url, 'good')],
+            outbound_balancing='weighted_round_robin',
+            outbound_eject_failures=1,
+            outbound_eject_duration=30)
+
+        for _ in range(4):
+            yield self.tx_helper.make_dispatch_outbound(
+                from_addr='456',
+                to_addr='+123',
+                content='hi')
+
+        self.assertEqual(
+            [req.path for req in reqs],
+            ['/bad', '/good', '/good', '/good'])
+
+        self.clock.advance(30)
+        del reqs[:]
+
+        yield self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi')
+
+        [bad] = [
+            e for e in transport.balancers[transport.config['outbound_url']]
+            .endpoints if e.url.endswith('/bad')]
+
+        self.assertFalse(bad.is_ejected(self.clock.seconds()))
+
+    @inlineCallbacks
+    def test_outbound_noisy_logging(self):
+        yield self.mk_transport(noisy=True)
+
+        with LogCatcher(message='Outbound success') as lc:
+            msg = yield self.tx_helper.make_dispatch_outbound(
+                from_addr='456',
+                to_addr='+123',
+                content='hi')
+
+        [log] = lc.messages()
+        self.assertTrue(msg['message_id'] in log)
+
+    @inlineCallbacks
+    def test_outbound_quiet_logging(self):
+        transport = yield self.mk_transport()
+        emitted = []
+        self.patch(transport, 'log_emitted', lambda *a: emitted.append(a))
+
+        yield self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi')
+
+        self.assertEqual(emitted, [])
+
+    @inlineCallbacks
+    def test_outbound_sampled_logging(self):
+        transport = yield self.mk_transport(log_sample_every=2)
+
+        def mk_msg(message_id):
+            return self.tx_helper.make_outbound(
+                'hi', from_addr='456', to_addr='+123', message_id=message_id)
+
+        # crc32('a') is odd and crc32('d') is even
+        msg_a = mk_msg('a')
+        msg_b = mk_msg('d')
+        self.assertFalse(transport.is_log_sampled(msg_a))
+        self.assertTrue(transport.is_log_sampled(msg_b))
+
+        with LogCatcher(message='Outbound success') as lc:
+            yield self.tx_helper.dispatch_outbound(msg_a)
+            yield self.tx_helper.dispatch_outbound(msg_b)
+
+        [log] = lc.messages()
+        self.assertTrue("'message_id': u'd'" in log)
+
+    @inlineCallbacks
+    def test_instrumentation(self):
+        self.capture_remote_requests('ERR-41 Insufficient credit')
+        transport = yield self.mk_transport()
+
+        yield self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi')
+
+        instrumentation = transport.instrumentation
+        self.assertEqual(sorted(instrumentation.histograms), [
+            'content', 'parse', 'publish', 'send', 'status', 'validate'])
+        self.assertEqual(instrumentation.counts['insufficient_credit'], 1)
+        self.assertEqual(instrumentation.counts['request_timeout'], 0)
+
+        metrics = yield self.get_metrics(transport)
+        prefix = 'vumi.transports.vas2nets_sms.sphex.'
+        self.assertEqual(metrics[prefix + 'events.insufficient_credit'], 1)
+        self.assertTrue(prefix + 'stages.send.latency' in metrics)
+
+    @inlineCallbacks
+    def test_instrumentation_resource(self):
+        transport = yield self.mk_transport(metrics_path='/metrics')
+
+        yield self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi')
+
+        resp = yield treq.get('http://127.0.0.1:%d/metrics' % (
+            transport.web_resource.getHost().port,))
+
+        self.assertEqual(resp.code, http.OK)
+        content = yield resp.content()
+        lines = content.splitlines()
+        self.assertTrue(
+            'vas2nets_sms_stage_seconds_count{stage="send"} 1' in lines)
+        self.assertTrue(
+            'vas2nets_sms_events_total{event="system_error"} 0' in lines)
+
+    @inlineCallbacks
+    def test_outbound_dedup_ack(self):
+        reqs = self.capture_remote_requests()
+        transport = yield self.mk_transport(outbound_dedup='memory')
+
+        msg = self.tx_helper.make_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi')
+
+        yield self.tx_helper.dispatch_outbound(msg)
+        yield self.tx_helper.dispatch_outbound(msg)
+        self.assertEqual(len(reqs), 1)
+
+        [ack1, ack2] = yield self.tx_helper.get_dispatched_events()
+        self.assertEqual(ack1['event_type'], 'ack')
+        self.assertEqual(ack2['event_type'], 'ack')
+        self.assertEqual(ack2['user_message_id'], msg['message_id'])
+        self.assertEqual(ack2['sent_message_id'], msg['message_id'])
+
+        metrics = yield self.get_metrics(transport)
+        self.assertEqual(
+            metrics['vumi.transports.vas2nets_sms.sphex.outbound.duplicates'],
+            1)
+
+    @inlineCallbacks
+    def test_outbound_dedup_nack(self):
+        reqs = self.capture_remote_requests('ERR-41 Insufficient credit')
+        yield self.mk_transport(outbound_dedup='memory')
+
+        msg = self.tx_helper.make_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi')
+
+        yield self.tx_helper.dispatch_outbound(msg)
+        yield self.tx_helper.dispatch_outbound(msg)
+        self.assertEqual(len(reqs), 1)
+
+        [nack1, nack2] = yield self.tx_helper.get_dispatched_events()
+        self.assertEqual(nack1['nack_reason'], 'Insufficient credit')
+        self.assertEqual(nack2['nack_reason'], 'Insufficient credit')
+        self.assertEqual(nack2['user_message_id'], msg['message_id'])
+
+    @inlineCallbacks
+    def test_outbound_dedup_ttl(self):
+        reqs = self.capture_remote_requests()
+        yield self.mk_transport(outbound_dedup='memory', outbound_dedup_ttl=60)
+
+        msg = self.tx_helper.make_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi')
+
+        yield self.tx_helper.dispatch_outbound(msg)
+        self.clock.advance(60)
+        yield self.tx_helper.dispatch_outbound(msg)
+        self.assertEqual(len(reqs), 2)
+
+    @inlineCallbacks
+    def test_outbound_dedup_redis(self):
+        reqs = self.capture_remote_requests()
+        yield self.mk_transport(outbound_dedup='redis')
+
+        msg = self.tx_helper.make_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi')
+
+        yield self.tx_helper.dispatch_outbound(msg)
+        yield self.tx_helper.dispatch_outbound(msg)
+        self.assertEqual(len(reqs), 1)
+
+        [ack1, ack2] = yield self.tx_helper.get_dispatched_events()
+        self.assertEqual(ack1['event_type'], 'ack')
+        self.assertEqual(ack2['event_type'], 'ack')
+
+    @inlineCallbacks
+    def test_dedup_redis_teardown(self):
+        transport = yield self.mk_transport(
+            inbound_dedup='redis',
+            outbound_dedup='redis')
+
+        close = transport.redis._close
+        closed = []
+        self.patch(
+            transport.redis, '_close', lambda: closed.append(1) or close())
+
+        yield self.tx_helper.cleanup_worker(transport)
+        self.assertEqual(closed, [1])
+
+    @inlineCallbacks
+    def test_outbound_dedup_disabled(self):
+        reqs = self.capture_remote_requests()
+        yield self.mk_transport()
+
+        msg = self.tx_helper.make_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi')
+
+        yield self.tx_helper.dispatch_outbound(msg)
+        yield self.tx_helper.dispatch_outbound(msg)
+        self.assertEqual(len(reqs), 2)
+
+    def test_config_invalid_dedup(self):
+        self.assertRaises(
+            ConfigError, Vas2NetsSmsTransport.CONFIG_CLASS, {
+                'transport_name': 'sphex',
+                'outbound_url': 'http://www.example.com/',
+                'reply_outbound_url': None,
+                'username': 'root',
+                'password': 't00r',
+                'outbound_dedup': 'foo',
+            })
+
+    def test_config_invalid_balancing(self):
+        self.assertRaises(
+            ConfigError, Vas2NetsSmsTransport.CONFIG_CLASS, {
+                'transport_name': 'sphex',
+                'outbound_url': 'http://www.example.com/',
+                'reply_outbound_url': None,
+                'username': 'root',
+                'password': 't00r',
+                'outbound_balancing': 'random',
+            })
+
+    def test_config_invalid_url_weight(self):
+        self.assertRaises(
+            ConfigError, Vas2NetsSmsTransport.CONFIG_CLASS, {
+                'transport_name': 'sphex',
+                'outbound_url': 'http://www.example.com/',
+                'reply_outbound_url': None,
+                'username': 'root',
+                'password': 't00r',
+                'outbound_urls': [
+                    {'url': 'http://www.example.org/', 'weight': 0},
+                ],
+            })
+
+    @inlineCallbacks
+    def test_outbound_spool(self):
+        transport = yield self.mk_transport(
+            outbound_spool_path=self.mktemp())
+
+        reqs = self.capture_remote_requests('ERR-52 System error')
+        msg = yield self.run_commits(self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi'))
+
+        self.assertEqual(len(reqs), 1)
+        self.assertEqual(self.tx_helper.get_dispatched_events(), [])
+        [(message_id, _)] = transport.spool.pending()
+        self.assertEqual(message_id, msg['message_id'])
+
+        self.clock.advance(1)
+        yield self.run_commits(transport.spool_draining)
+        self.assertEqual(len(reqs), 2)
+        self.assertEqual(self.tx_helper.get_dispatched_events(), [])
+        self.assertEqual(len(transport.spool), 1)
+
+        reqs = self.capture_remote_requests('OK.1234')
+        self.clock.advance(1)
+        yield self.run_commits(transport.spool_draining)
+        self.assertEqual(len(reqs), 1)
+        self.assertEqual(transport.spool.pending(), [])
+
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assert_contains_items(ack, {
+            'event_type': 'ack',
+            'user_message_id': msg['message_id'],
+            'sent_message_id': msg['message_id'],
+        })
+
+    @inlineCallbacks
+    def test_outbound_spool_fail(self):
+        transport = yield self.mk_transport(
+            outbound_spool_path=self.mktemp())
+
+        self.capture_remote_requests('ERR-52 System error')
+        msg = yield self.run_commits(self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi'))
+
+        self.capture_remote_requests('ERR-33 Invalid login')
+        self.clock.advance(1)
+        yield self.run_commits(transport.spool_draining)
+        self.assertEqual(transport.spool.pending(), [])
+
+        [nack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assert_contains_items(nack, {
+            'event_type': 'nack',
+            'user_message_id': msg['message_id'],
+            'nack_reason': 'Invalid login',
+        })
+
+    @inlineCallbacks
+    def test_outbound_spool_failing_message_moved_back(self):
+        def handler(req):
+            reqs.append(req.args['receiver'][0])
+
+            if req.args['receiver'] == ['+1'] or len(reqs) <= 2:
+                return 'ERR-52 System error'
+            else:
+                return 'OK.1234'
+
+        reqs = []
+        self.remote_request_handler = handler
+
+        transport = yield self.mk_transport(
+            outbound_spool_path=self.mktemp())
+
+        msg1 = yield self.run_commits(self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+1',
+            content='hi'))
+
+        msg2 = yield self.run_commits(self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+2',
+            content='hi'))
+
+        self.assertEqual(
+            [message_id for (message_id, _) in transport.spool.pending()],
+            [msg1['message_id'], msg2['message_id']])
+
+        self.clock.advance(1)
+        yield self.run_commits(transport.spool_draining)
+        self.assertEqual(
+            [message_id for (message_id, _) in transport.spool.pending()],
+            [msg2['message_id'], msg1['message_id']])
+
+        self.clock.advance(1)
+        yield self.run_commits(transport.spool_draining)
+        self.assertEqual(reqs, ['+1', '+2', '+1', '+2'])
+
+        [(message_id, _)] = transport.spool.pending()
+        self.assertEqual(message_id, msg1['message_id'])
+
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assert_contains_items(ack, {
+            'event_type': 'ack',
+            'user_message_id': msg2['message_id'],
+        })
+
+    @inlineCallbacks
+    def test_outbound_spool_max_age(self):
+        transport = yield self.mk_transport(
+            outbound_spool_path=self.mktemp(),
+            outbound_spool_max_age=2)
+
+        self.capture_remote_requests('ERR-52 System error')
+        msg = yield self.run_commits(self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi'))
+
+        self.clock.advance(1)
+        yield self.run_commits(transport.spool_draining)
+        self.assertEqual(len(transport.spool), 1)
+        self.assertEqual(self.tx_helper.get_dispatched_events(), [])
+
+        self.clock.advance(1)
+        yield self.run_commits(transport.spool_draining)
+        self.assertEqual(len(transport.spool), 0)
+
+        [nack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assert_contains_items(nack, {
+            'event_type': 'nack',
+            'user_message_id': msg['message_id'],
+            'nack_reason': 'System error',
+        })
+
+    @inlineCallbacks
+    def test_outbound_spool_connection_error(self):
+        url = yield self.mk_refused_url()
+        transport = yield self.mk_transport(
+            outbound_url=url,
+            outbound_spool_path=self.mktemp())
+
+        msg = yield self.run_commits(self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi'))
+
+        [(message_id, data)] = transport.spool.pending()
+        self.assertEqual(message_id, msg['message_id'])
+        self.assertEqual(data['status']['type'], 'connection_error')
+        self.assertEqual(self.tx_helper.get_dispatched_events(), [])
+
+    @inlineCallbacks
+    def test_outbound_spool_already_spooled(self):
+        transport = yield self.mk_transport(
+            outbound_spool_path=self.mktemp())
+
+        reqs = self.capture_remote_requests('ERR-52 System error')
+        msg = self.tx_helper.make_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi')
+
+        yield self.run_commits(self.tx_helper.dispatch_outbound(msg))
+        yield self.run_commits(self.tx_helper.dispatch_outbound(msg))
+
+        self.assertEqual(len(reqs), 1)
+        self.assertEqual(len(transport.spool), 1)
+        self.assertEqual(self.tx_helper.get_dispatched_events(), [])
+
+    @inlineCallbacks
+    def test_outbound_spool_reject_new(self):
+        transport = yield self.mk_transport(
+            outbound_spool_path=self.mktemp(),
+            outbound_spool_max_size=1)
+
+        self.capture_remote_requests('ERR-52 System error')
+        msg1 = yield self.run_commits(self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi'))
+
+        msg2 = yield self.run_commits(self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi'))
+
+        [(message_id, _)] = transport.spool.pending()
+        self.assertEqual(message_id, msg1['message_id'])
+
+        [nack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assert_contains_items(nack, {
+            'event_type': 'nack',
+            'user_message_id': msg2['message_id'],
+            'nack_reason': 'System error',
+        })
+
+    @inlineCallbacks
+    def test_outbound_spool_drop_oldest(self):
+        transport = yield self.mk_transport(
+            outbound_spool_path=self.mktemp(),
+            outbound_spool_max_size=1,
+            outbound_spool_overflow='drop_oldest')
+
+        self.capture_remote_requests('ERR-52 System error')
+        msg1 = yield self.run_commits(self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi'))
+
+        msg2 = yield self.run_commits(self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi'))
+
+        [(message_id, _)] = transport.spool.pending()
+        self.assertEqual(message_id, msg2['message_id'])
+
+        [nack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assert_contains_items(nack, {
+            'event_type': 'nack',
+            'user_message_id': msg1['message_id'],
+            'nack_reason': 'System error',
+        })
+
+    @inlineCallbacks
+    def test_outbound_spool_drop_oldest_sending(self):
+        '''The message being sent from the spool shouldn't be dropped, or
+        it would be nacked and then acked or nacked again once its send
+        finishes.'''
+        transport = yield self.mk_transport(
+            outbound_spool_path=self.mktemp(),
+            outbound_spool_max_size=1,
+            outbound_spool_overflow='drop_oldest')
+
+        self.capture_remote_requests('ERR-52 System error')
+        msg1 = yield self.run_commits(self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi'))
+
+        reqs, wait_for_reqs = self.capture_pending_remote_requests()
+        self.clock.advance(1)
+        [req] = yield wait_for_reqs(1)
+
+        self.capture_remote_requests('ERR-52 System error')
+        msg2 = yield self.run_commits(self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi'))
+
+        [(message_id, _)] = transport.spool.pending()
+        self.assertEqual(message_id, msg1['message_id'])
+
+        req.write('OK.1234')
+        req.finish()
+        yield self.run_commits(transport.spool_draining)
+        self.assertEqual(transport.spool.pending(), [])
+
+        [nack, ack] = yield self.tx_helper.wait_for_dispatched_events(2)
+        self.assert_contains_items(nack, {
+            'event_type': 'nack',
+            'user_message_id': msg2['message_id'],
+            'nack_reason': 'System error',
+        })
+        self.assert_contains_items(ack, {
+            'event_type': 'ack',
+            'user_message_id': msg1['message_id'],
+        })
+
+    @inlineCallbacks
+    def test_outbound_spool_replay(self):
+        msg = self.tx_helper.make_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi')
+
+        path = self.mktemp()
+        journal = Journal(path)
+        journal.open()
+        journal.add(msg['message_id'], {
+            'message': msg.to_json(),
+            'status': {'type': 'system_error', 'message': 'System error'},
+            'spooled_at': 0,
+        })
+        journal.close()
+
+        transport = yield self.mk_transport(outbound_spool_path=path)
+        reqs = self.capture_remote_requests()
+
+        self.clock.advance(1)
+        yield self.run_commits(transport.spool_draining)
+        self.assertEqual(len(reqs), 1)
+
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assert_contains_items(ack, {
+            'event_type': 'ack',
+            'user_message_id': msg['message_id'],
+        })
+
+    @inlineCallbacks
+    def test_outbound_spool_metrics(self):
+        transport = yield self.mk_transport(
+            outbound_spool_path=self.mktemp())
+
+        self.capture_remote_requests('ERR-52 System error')
+        yield self.run_commits(self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi'))
+
+        # The metrics are published before the next message is drained
+        disk_usage = transport.spool.disk_usage()
+        self.clock.advance(1)
+        yield self.run_commits(transport.spool_draining)
+
+        def values(name):
+            metric = transport.spool_metrics[name]
+            return [v for (_, v) in metric.poll()]
+
+        self.assertEqual(values('depth'), [1])
+        self.assertEqual(values('age'), [1])
+        self.assertEqual(values('disk_usage'), [disk_usage])
+
+    def test_config_invalid_spool_drain_rate(self):
+        self.assertRaises(
+            ConfigError, Vas2NetsSmsTransport.CONFIG_CLASS, {
+                'transport_name': 'sphex',
+                'outbound_url': 'http://www.example.com/',
+                'reply_outbound_url': None,
+                'username': 'root',
+                'password': 't00r',
+                'outbound_spool_drain_rate': 0,
+            })
+
+    def test_config_invalid_spool_overflow(self):
+        self.assertRaises(
+            ConfigError, Vas2NetsSmsTransport.CONFIG_CLASS, {
+                'transport_name': 'sphex',
+                'outbound_url': 'http://www.example.com/',
+                'reply_outbound_url': None,
+                'username': 'root',
+                'password': 't00r',
+                'outbound_spool_overflow': 'drop_newest',
+            })
+
+
+class BenchmarkVas2NetsSmsTransport(VumiTestCase):
+    """
+    Micro-benchmarks for the SMS transport's hot paths. These only run when
+    the VXVAS2NETS_BENCHMARKS environment variable is set, for example:
+
+        VXVAS2NETS_BENCHMARKS=1 trial vxvas2nets.tests.test_vas2nets_sms
+    """
+
+    ITERATIONS = 20000
+
+    @inlineCallbacks
+    def setUp(self):
+        skip_unless_benchmarking()
+
+        self.tx_helper = self.add_helper(
+            HttpRpcTransportHelper(Vas2NetsSmsTransport))
+
+        self.transport = yield self.tx_helper.get_transport({
+            'web_port': 0,
+            'web_path': '/api/v1/vas2nets/sms/',
+            'outbound_url': 'http://www.example.com/send',
+            'reply_outbound_url': 'http://www.example.com/reply',
+            'username': 'root',
+            'password': 't00r',
+        })
+
+    def report(self, name, results):
+        print
+        print name
+
+        for label, seconds in results:
+            print '  %-10s %8.2f us/msg %10.0f msg/s' % (
+                label,
+                seconds * 1e6 / self.ITERATIONS,
+                self.ITERATIONS / seconds)
+
+    def test_send_query(self):
+        from treq.client import _combine_query_params
+
+        transport = self.transport
+        msg = self.tx_helper.make_outbound(
+            'hello world', from_addr='456', to_addr='+123',
+            transport_metadata={'vas2nets_sms': {'msgid': '789'}})
+
+        url = transport.get_send_url(msg)
+
+        def before():
+            _combine_query_params(url, transport.get_send_params(msg))
+
+        def after():
+            transport.get_send_query(url, msg)
+
+        self.report('send query', [
+            ('before', timeit.timeit(before, number=self.ITERATIONS)),
+            ('after', timeit.timeit(after, number=self.ITERATIONS)),
+        ])
+
+    def test_inbound_field_values(self):
+        transport = self.transport
+        request = Request(DummyChannel(), False)
+        request.args = {
+            'sender': ['+123'],
+            'receiver': ['456'],
+            'msgdata': ['hello world'],
+            'recvtime': ['2012-02-27 19-50-07'],
+            'msgid': ['789'],
+            'operator': ['MTN'],
+        }
+
+        def before():
+            transport.get_field_values(request, transport.EXPECTED_FIELDS)
+
+        def after():
+            transport.get_inbound_field_values(request)
+
+        self.report('inbound field values', [
+            ('before', timeit.timeit(before, number=self.ITERATIONS)),
+            ('after', timeit.timeit(after, number=self.ITERATIONS)),
+        ])
+
+    def test_outbound_logging(self):
+        """
+        Measures the cost of the log calls made for a successful outbound
+        message. Allocations are measured with tracemalloc where it is
+        available. Otherwise, the number of bytes formatted into log lines
+        gives an idea of how much garbage logging creates.
+        """
+        try:
+            import tracemalloc
+        except ImportError:
+            tracemalloc = None
+
+        transport = self.transport
+        msg = self.tx_helper.make_outbound(
+            'hello world', from_addr='456', to_addr='+123',
+            transport_metadata={'vas2nets_sms': {'msgid': '789'}})
+
+        formatted = []
+
+        class Log(object):
+            def info(self, line):
+                formatted.append(len(line))
+
+        self.patch(transport, 'log', Log())
+        status = {'code': None, 'message': 'OK.1234', 'type': None}
+
+        def log_outbound():
+            transport.emit_for(
+                msg, 'Vas2Nets response for %s: %s, status: %s',
+                msg['message_id'], 'OK.1234', status)
+            transport.emit_for(msg, 'Outbound success: %s', msg)
+
+        def allocations():
+            if tracemalloc is None:
+                return 'n/a'
+
+            tracemalloc.start()
+            before = tracemalloc.take_snapshot()
+
+            for _ in range(1000):
+                log_outbound()
+
+            after = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+
+            blocks = sum(
+                stat.count_diff
+                for stat in after.compare_to(before, 'lineno'))
+
+            return '%.1f' % (blocks / 1000.0,)
+
+        print
+        print 'outbound logging'
+
+        for noisy in [False, True]:
+            self.patch(transport, 'noisy', noisy)
+            del formatted[:]
+
+            seconds = timeit.timeit(log_outbound, number=self.ITERATIONS)
+
+            print '  noisy=%-5s %8.2f us/msg %8.1f bytes/msg %s blocks/msg' % (
+                noisy,
+                seconds * 1e6 / self.ITERATIONS,
+                sum(formatted) / float(self.ITERATIONS),
+                allocations())
+
+
+class BenchmarkVas2NetsSmsThroughput(VumiTestCase):
+    """
+    End-to-end benchmarks that send messages through the SMS transport over
+    HTTP, using a fake Vas2Nets server. See `vxvas2nets.tests.benchmarks`
+    for how to run and tune them.
+    """
+
+    timeout = 600
+
+    @inlineCallbacks
+    def setUp(self):
+        skip_unless_benchmarking()
+        self.params = get_params()
+
+        self.server = FakeVas2NetsServer(
+            latency=self.params['latency'],
+            errors=parse_errors(self.params['errors']),
+            seed=self.params['seed'])
+
+        yield self.server.start()
+        self.addCleanup(self.server.stop)
+
+        self.tx_helper = self.add_helper(
+            HttpRpcTransportHelper(Vas2NetsSmsTransport))
+
+    def mk_transport(self, **kw):
+        config = {
+            'web_port': 0,
+            'web_path': '/api/v1/vas2nets/sms/',
+            'outbound_url': urljoin(self.server.url, 'send'),
+            'reply_outbound_url': urljoin(self.server.url, 'reply'),
+            'username': 'root',
+            'password': 't00r',
+        }
+        config.update(kw)
+        return self.tx_helper.get_transport(config)
+
+    @inlineCallbacks
+    def test_mo_throughput(self):
+        """
+        Measures the time from Vas2Nets sending an inbound message to the
+        transport responding, which it does once the message is published.
+        """
+        yield self.mk_transport()
+
+        def send(i):
+            return self.tx_helper.mk_request(
+                sender='+123',
+                receiver='456',
+                msgdata='hello world',
+                operator='MTN',
+                recvtime='2012-02-27 19-50-07',
+                msgid=str(i))
+
+        seconds, latencies = yield run_concurrently(
+            self.params['messages'], self.params['concurrency'], send)
+
+        self.assertEqual(
+            len(self.tx_helper.get_dispatched_inbound()),
+            self.params['messages'])
+
+        report('sms_mo', self.params, summarize(seconds, latencies))
+
+    @inlineCallbacks
+    def test_mt_latency(self):
+        """
+        Measures the time from an outbound message being dispatched to the
+        transport publishing its ack or nack. The transport sends up to
+        VXVAS2NETS_BENCHMARK_CONCURRENCY messages at a time.
+        """
+        transport = yield self.mk_transport(
+            outbound_max_in_flight=self.params['concurrency'],
+            outbound_request_timeout=self.params['timeout'])
+        waiting = {}
+        publish_event = transport.publish_event
+
+        def event_published(**kw):
+            d = publish_event(**kw)
+            waiting.pop(kw['user_message_id']).callback(kw['event_type'])
+            return d
+
+        self.patch(transport, 'publish_event', event_published)
+
+        def send(i):
+            msg = self.tx_helper.make_outbound(
+                'hello world', from_addr='456', to_addr='+123')
+
+            d = waiting[msg['message_id']] = Deferred()
+            self.tx_helper.dispatch_outbound(msg)
+            return d
+
+        seconds, latencies = yield run_concurrently(
+            self.params['messages'], self.params['concurrency'], send)
+
+        events = self.tx_helper.get_dispatched_events()
+        results = summarize(seconds, latencies)
+        results['acks'] = sum(1 for e in events if e['event_type'] == 'ack')
+        results['nacks'] = sum(1 for e in events if e['event_type'] == 'nack')
+        results['outcomes'] = dict(
+            (outcome or 'ok', n)
+            for outcome, n in self.server.outcomes.iteritems())
+        report('sms_mt', self.params, results)
+
+
+class TestCircuitBreaker(VumiTestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.states = []
+
+    def mk_breaker(self, failure_ratio=0.5, window=4, min_calls=2,
+                   reset_timeout=10):
+        return CircuitBreaker(
+            self.clock, failure_ratio, window, min_calls, reset_timeout,
+            on_state_change=self.states.append)
+
+    def test_opens_on_failure_ratio(self):
+        breaker = self.mk_breaker()
+        breaker.record(False)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+        breaker.record(True)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+        self.assertEqual(self.states, [CircuitBreaker.OPEN])
+
+    def test_stays_closed_below_failure_ratio(self):
+        breaker = self.mk_breaker()
+
+        for success in [True, True, False, True, True, True, False]:
+            breaker.record(success)
+
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.allow())
+
+    def test_single_probe_when_half_open(self):
+        breaker = self.mk_breaker()
+        breaker.record(False)
+        breaker.record(False)
+
+        self.clock.advance(10)
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+
+    def test_probe_success_closes(self):
+        breaker = self.mk_breaker()
+        breaker.record(False)
+        breaker.record(False)
+
+        self.clock.advance(10)
+        token = breaker.allow()
+        breaker.record(True, token)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.allow())
+
+        self.assertEqual(self.states, [
+            CircuitBreaker.OPEN,
+            CircuitBreaker.HALF_OPEN,
+            CircuitBreaker.CLOSED,
+        ])
+
+    def test_probe_failure_reopens(self):
+        breaker = self.mk_breaker()
+        breaker.record(False)
+        breaker.record(False)
+
+        self.clock.advance(10)
+        token = breaker.allow()
+        breaker.record(False, token)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        self.clock.advance(10)
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+
+    def test_stale_outcome_ignored_when_half_open(self):
+        breaker = self.mk_breaker()
+        stale = breaker.allow()
+        breaker.record(False)
+        breaker.record(False)
+
+        self.clock.advance(10)
+        probe = breaker.allow()
+
+        # A call started before the breaker opened finishes
+        breaker.record(False, stale)
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertEqual(breaker.allow(), None)
+
+        breaker.record(True, probe)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_wait(self):
+        breaker = self.mk_breaker()
+        breaker.record(False)
+        breaker.record(False)
+
+        released = []
+        breaker.wait().addCallback(released.append)
+        breaker.wait().addCallback(released.append)
+        self.assertEqual(released, [])
+
+        self.clock.advance(10)
+        self.assertEqual(len(released), 1)
+
+        breaker.record(True, released[0])
+        self.assertEqual(len(released), 2)
+
+    def test_stop(self):
+        breaker = self.mk_breaker()
+        breaker.record(False)
+        breaker.record(False)
+
+        breaker.stop()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_stop_waiting(self):
+        breaker = self.mk_breaker()
+        breaker.record(False)
+        breaker.record(False)
+
+        released = []
+        breaker.wait().addCallback(released.append)
+        breaker.wait().addCallback(released.append)
+
+        breaker.stop()
+        self.assertEqual(released, [None, None])
+        self.assertEqual(breaker.allow(), None)
+
+        breaker.wait().addCallback(released.append)
+        self.assertEqual(released, [None, None, None])
+
+
+class TestEndpointBalancer(VumiTestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.ejected = []
+
+    def mk_balancer(self, urls, **kw):
+        return EndpointBalancer.from_urls(
+            self.clock, urls, on_eject=self.ejected.append, **kw)
+
+    def choose_urls(self, balancer, n):
+        return [balancer.choose().url for _ in range(n)]
+
+    def test_from_urls(self):
+        balancer = self.mk_balancer(['a', {'url': 'b', 'weight': 3}])
+        self.assertEqual(
+            [(e.url, e.weight) for e in balancer.endpoints],
+            [('a', 1), ('b', 3)])
+
+    def test_least_outstanding(self):
+        balancer = self.mk_balancer(['a', 'b'])
+        [a, b] = balancer.endpoints
+
+        balancer.start(balancer.choose())
+        self.assertEqual(balancer.choose(), b)
+
+        balancer.start(b)
+        balancer.start(b)
+        self.assertEqual(balancer.choose(), a)
+
+    def test_least_outstanding_latency(self):
+        balancer = self.mk_balancer(['a', 'b'])
+        [a, b] = balancer.endpoints
+
+        started = balancer.start(a)
+        self.clock.advance(2)
+        balancer.finish(a, started, True)
+
+        self.assertEqual(self.choose_urls(balancer, 3), ['b', 'b', 'b'])
+
+    def test_least_outstanding_error_rate(self):
+        balancer = self.mk_balancer(['a', 'b'])
+        [a, b] = balancer.endpoints
+
+        balancer.finish(a, balancer.start(a), True)
+        balancer.finish(b, balancer.start(b), False)
+
+        self.assertEqual(balancer.choose(), a)
+
+    def test_weighted_round_robin(self):
+        balancer = self.mk_balancer(
+            ['a', {'url': 'b', 'weight': 2}], mode='weighted_round_robin')
+
+        self.assertEqual(
+            self.choose_urls(balancer, 6),
+            ['b', 'a', 'b', 'b', 'a', 'b'])
+
+    def test_weighted_round_robin_error_rate(self):
+        balancer = self.mk_balancer(
+            ['a', 'b'], mode='weighted_round_robin', eject_failures=100)
+
+        [a, b] = balancer.endpoints
+
+        for _ in range(10):
+            balancer.finish(b, balancer.start(b), False)
+
+        self.assertEqual(self.choose_urls(balancer, 10).count('b'), 1)
+
+    def test_eject(self):
+        balancer = self.mk_balancer(
+            ['a', 'b'], eject_failures=2, eject_duration=10)
+
+        [a, b] = balancer.endpoints
+
+        balancer.finish(a, balancer.start(a), False)
+        self.assertEqual(self.ejected, [])
+
+        balancer.finish(a, balancer.start(a), False)
+        self.assertEqual(self.ejected, [a])
+        self.assertEqual(balancer.available(), [b])
+
+        self.clock.advance(10)
+        self.assertEqual(balancer.available(), [a, b])
+
+    def test_eject_all(self):
+        balancer = self.mk_balancer(['a', 'b'], eject_failures=1)
+        [a, b] = balancer.endpoints
+
+        balancer.finish(a, balancer.start(a), False)
+        balancer.finish(b, balancer.start(b), False)
+        self.assertEqual(balancer.available(), [a, b])
+
+    def test_endpoint_record(self):
+        endpoint = Endpoint('a')
+        endpoint.record(False, 1)
+        self.assertEqual(endpoint.failures, 1)
+        self.assertAlmostEqual(endpoint.error_rate, 0.2)
+        self.assertAlmostEqual(endpoint.latency, 0.2)
+
+        endpoint.record(True, 1)
+        self.assertEqual(endpoint.failures, 0)
+        self.assertAlmostEqual(endpoint.error_rate, 0.16)
+        self.assertAlmostEqual(endpoint.latency, 0.36)
+
+
+class TestTokenBucket(VumiTestCase):
+    def setUp(self):
+        self.clock = Clock()
+
+    def acquire(self, bucket, n):
+        acquired = []
+
+        for _ in range(n):
+            bucket.acquire().addCallback(acquired.append)
+
+        return acquired
+
+    def test_burst(self):
+        bucket = TokenBucket(self.clock, 1, 3)
+        acquired = self.acquire(bucket, 4)
+        self.assertEqual(len(acquired), 3)
+        self.assertEqual(len(bucket.waiting), 1)
+
+    def test_rate(self):
+        bucket = TokenBucket(self.clock, 2, 1)
+        acquired = self.acquire(bucket, 4)
+        self.assertEqual(len(acquired), 1)
+
+        self.clock.advance(0.4)
+        self.assertEqual(len(acquired), 1)
+
+        self.clock.advance(0.1)
+        self.assertEqual(len(acquired), 2)
+
+        self.clock.pump([0.5, 0.5])
+        self.assertEqual(len(acquired), 4)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_refill_capped_at_burst(self):
+        bucket = TokenBucket(self.clock, 1, 2)
+        self.acquire(bucket, 2)
+        self.clock.advance(10)
+
+        acquired = self.acquire(bucket, 3)
+        self.assertEqual(len(acquired), 2)
+
+    def test_acquire_many(self):
+        bucket = TokenBucket(self.clock, 1, 3)
+        acquired = []
+        bucket.acquire(2).addCallback(acquired.append)
+        bucket.acquire(2).addCallback(acquired.append)
+        self.assertEqual(len(acquired), 1)
+
+        self.clock.advance(1)
+        self.assertEqual(len(acquired), 2)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_acquire_more_than_burst(self):
+        bucket = TokenBucket(self.clock, 1, 2)
+        acquired = []
+        bucket.acquire(5).addCallback(acquired.append)
+        bucket.acquire().addCallback(acquired.append)
+        self.assertEqual(len(acquired), 1)
+
+        # The 3 tokens over the burst are paid back before the next caller
+        self.clock.advance(3.9)
+        self.assertEqual(len(acquired), 1)
+
+        self.clock.advance(0.1)
+        self.assertEqual(len(acquired), 2)
+
+    def test_stop(self):
+        bucket = TokenBucket(self.clock, 1, 1)
+        self.acquire(bucket, 2)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+        bucket.stop()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+def map_get(collection, key):
+    return dict((k, d.get(key)) for (k, d) in collection.iteritems())
+
+
+class TestPriorityLanes(VumiTestCase):
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_get_weighted(self):
+        lanes = PriorityLanes(self.clock, {'reply': 3, 'bulk': 1})
+
+        for i in range(4):
+            lanes.put('reply', 'r%d' % i)
+            lanes.put('bulk', 'b%d' % i)
+
+        self.assertEqual(
+            [lanes.get()[1] for _ in range(8)],
+            ['r0', 'r1', 'b0', 'r2', 'r3', 'b1', 'b2', 'b3'])
+
+    def test_get_wait_time(self):
+        lanes = PriorityLanes(self.clock, {'reply': 1, 'bulk': 1})
+        lanes.put('bulk', 'b0')
+        self.clock.advance(2)
+        self.assertEqual(lanes.get(), ('bulk', 'b0', 2))
+
+    def test_len(self):
+        lanes = PriorityLanes(self.clock, {'reply': 1, 'bulk': 1})
+        lanes.put('reply', 'r0')
+        lanes.put('bulk', 'b0')
+        lanes.put('bulk', 'b1')
+        self.assertEqual(len(lanes), 3)
+        self.assertEqual(lanes.depth('reply'), 1)
+        self.assertEqual(lanes.depth('bulk'), 2)
+
+
+class TestSendBatcher(VumiTestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.batches = []
+
+    def send_batch(self, messages):
+        self.batches.append(messages)
+        return ['status-%s' % (m,) for m in messages]
+
+    def mk_batcher(self, window=1, max_size=3):
+        return SendBatcher(self.clock, window, max_size, self.send_batch)
+
+    def test_window(self):
+        batcher = self.mk_batcher()
+        d1 = batcher.add('a', 1)
+        d2 = batcher.add('a', 2)
+        d3 = batcher.add('b', 3)
+        self.assertEqual(self.batches, [])
+
+        self.clock.advance(1)
+        self.assertEqual(sorted(self.batches), [[1, 2], [3]])
+        self.assertEqual(self.successResultOf(d1), 'status-1')
+        self.assertEqual(self.successResultOf(d2), 'status-2')
+        self.assertEqual(self.successResultOf(d3), 'status-3')
+
+    def test_max_size(self):
+        batcher = self.mk_batcher()
+
+        for i in range(4):
+            batcher.add('a', i)
+
+        self.assertEqual(self.batches, [[0, 1, 2]])
+        self.clock.advance(1)
+        self.assertEqual(self.batches, [[0, 1, 2], [3]])
+
+    def test_flush_all(self):
+        batcher = self.mk_batcher()
+        batcher.add('a', 1)
+        batcher.add('b', 2)
+        batcher.flush_all()
+        self.assertEqual(sorted(self.batches), [[1], [2]])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_failure(self):
+        def send_batch(messages):
+            raise Exception('Oops')
+
+        batcher = SendBatcher(self.clock, 1, 3, send_batch)
+        d1 = batcher.add('a', 1)
+        d2 = batcher.add('a', 2)
+        self.clock.advance(1)
+        self.failureResultOf(d1, Exception)
+        self.failureResultOf(d2, Exception)
+
+
+class TestLatencyWindow(VumiTestCase):
+    def test_percentile(self):
+        window = LatencyWindow(100)
+        self.assertEqual(window.percentile(99), None)
+
+        for i in range(1, 101):
+            window.record(i)
+
+        self.assertEqual(window.percentile(50), 50)
+        self.assertEqual(window.percentile(99), 99)
+        self.assertEqual(window.percentile(100), 100)
+
+    def test_size(self):
+        window = LatencyWindow(2)
+        window.record(3)
+        window.record(1)
+        window.record(2)
+        self.assertEqual(len(window), 2)
+        self.assertEqual(window.percentile(99), 2)
@@ -1,16 +1,26 @@
 import json
-from twisted.internet.defer import inlineCallbacks
+import time
+from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.internet.task import Clock
 import urllib
 
+from vumi.config import ConfigError
 from vumi.message import TransportUserMessage
 from vumi.tests.helpers import VumiTestCase
+from vumi.transports.httprpc import HttpRpcTransport
 from vumi.transports.httprpc.tests.helpers import HttpRpcTransportHelper
 
 from vxvas2nets import Vas2NetsUssdTransport
+from vxvas2nets.instrumentation import percentile
+from vxvas2nets.tests.benchmarks import (
+    skip_unless_benchmarking, get_params, UssdLoadGenerator, CountingRedis,
+    summarize, report, peak_rss)
+from vxvas2nets.tests.helpers import wait_for
 
 
 class TestVas2NetsUssdTransport(VumiTestCase):
+    transport_config = {}
+
     @inlineCallbacks
     def setUp(self):
         self.clock = Clock()
@@ -22,6 +32,7 @@ class TestVas2NetsUssdTransport(VumiTestCase):
             'publish_status': True,
             'ussd_number': '*123*45#',
         }
+        self.config.update(self.transport_config)
         self.tx_helper = self.add_helper(
             HttpRpcTransportHelper(Vas2NetsUssdTransport))
         self.transport = yield self.tx_helper.get_transport(self.config)
@@ -246,7 +257,7 @@ class TestVas2NetsUssdTransport(VumiTestCase):
 
     @inlineCallbacks
     def test_status_quick_response(self):
-        '''Ok status event should be sent if the response is quick.'''
+        '''Ok status event should be sent if responses are quick.'''
         d = self.tx_helper.mk_request(
             userdata='test', msisdn='+123', sessionid='4')
         [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
@@ -254,6 +265,7 @@ class TestVas2NetsUssdTransport(VumiTestCase):
 
         self.tx_helper.dispatch_outbound(msg.reply('foo'))
         yield d
+        self.advance_status_interval()
 
         [status] = yield self.tx_helper.get_dispatched_statuses()
         self.assertEqual(status['status'], 'ok')
@@ -263,7 +275,7 @@ class TestVas2NetsUssdTransport(VumiTestCase):
 
     @inlineCallbacks
     def test_status_degraded_slow_response(self):
-        '''A degraded status event should be sent if the response took longer
+        '''A degraded status event should be sent if responses took longer
         than 1 second.'''
         d = self.tx_helper.mk_request(
             userdata='test', msisdn='+123', sessionid='4')
@@ -274,6 +286,7 @@ class TestVas2NetsUssdTransport(VumiTestCase):
 
         self.tx_helper.dispatch_outbound(msg.reply('foo'))
         yield d
+        self.advance_status_interval()
 
         [status] = yield self.tx_helper.get_dispatched_statuses()
         self.assertEqual(status['status'], 'degraded')
@@ -285,7 +298,7 @@ class TestVas2NetsUssdTransport(VumiTestCase):
 
     @inlineCallbacks
     def test_status_down_very_slow_response(self):
-        '''A down status event should be sent if the response took longer
+        '''A down status event should be sent if responses took longer
         than 10 seconds.'''
         d = self.tx_helper.mk_request(
             userdata='test', msisdn='+123', sessionid='4')
@@ -296,6 +309,7 @@ class TestVas2NetsUssdTransport(VumiTestCase):
 
         self.tx_helper.dispatch_outbound(msg.reply('foo'))
         yield d
+        self.advance_status_interval()
 
         [status] = yield self.tx_helper.get_dispatched_statuses()
         self.assertEqual(status['status'], 'down')
@@ -305,6 +319,83 @@ class TestVas2NetsUssdTransport(VumiTestCase):
         self.assertEqual(status['type'], 'very_slow_response')
         self.assertEqual(status['message'], 'Very slow response')
 
+    def advance_status_interval(self):
+        self.clock.advance(
+            self.transport.get_static_config().response_time_status_interval)
+
+    @inlineCallbacks
+    def respond_after(self, delay, sessionid):
+        d = self.tx_helper.mk_request(
+            userdata='test', msisdn='+123', sessionid=sessionid)
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.tx_helper.clear_dispatched_inbound()
+
+        self.clock.advance(delay)
+        self.tx_helper.dispatch_outbound(msg.reply('foo'))
+        yield d
+
+    @inlineCallbacks
+    def test_status_response_time_p95(self):
+        '''The response status is based on the 95th percentile response time
+        over the window, so a few slow responses don't change it.'''
+        yield self.respond_after(
+            self.transport.response_time_down + 0.1, '0')
+
+        for i in range(1, 20):
+            yield self.respond_after(0, str(i))
+
+        yield self.tx_helper.clear_dispatched_statuses()
+        self.advance_status_interval()
+
+        [status] = yield self.tx_helper.get_dispatched_statuses()
+        self.assertEqual(status['status'], 'ok')
+        self.assertEqual(status['details']['responses'], 20)
+        self.assertEqual(
+            status['details']['window'],
+            self.transport.get_static_config().response_time_window)
+
+        yield self.respond_after(
+            self.transport.response_time_degraded + 0.1, '20')
+
+        yield self.tx_helper.clear_dispatched_statuses()
+        self.advance_status_interval()
+
+        [status] = yield self.tx_helper.get_dispatched_statuses()
+        self.assertEqual(status['status'], 'degraded')
+        self.assertEqual(status['details']['responses'], 21)
+        self.assertEqual(status['details']['response_time_p95'], 2.5)
+
+    @inlineCallbacks
+    def test_status_response_time_window(self):
+        '''Responses older than the window are no longer counted, and no
+        status event is sent once there are no responses in the window.'''
+        yield self.respond_after(
+            self.transport.response_time_degraded + 0.1, '1')
+
+        yield self.tx_helper.clear_dispatched_statuses()
+        self.advance_status_interval()
+
+        [status] = yield self.tx_helper.get_dispatched_statuses()
+        self.assertEqual(status['status'], 'degraded')
+
+        self.clock.advance(
+            self.transport.get_static_config().response_time_window)
+        yield self.tx_helper.clear_dispatched_statuses()
+        yield self.respond_after(0, '2')
+        self.advance_status_interval()
+
+        [status] = yield self.tx_helper.get_dispatched_statuses()
+        self.assertEqual(status['status'], 'ok')
+        self.assertEqual(status['details']['responses'], 1)
+
+        self.clock.advance(
+            self.transport.get_static_config().response_time_window)
+        yield self.tx_helper.clear_dispatched_statuses()
+        self.advance_status_interval()
+
+        statuses = yield self.tx_helper.get_dispatched_statuses()
+        self.assertEqual(statuses, [])
+
     @inlineCallbacks
     def test_no_response_status_for_message_not_found(self):
         '''If we cannot find the starting timestamp for a message, no status
@@ -397,3 +488,376 @@ class TestVas2NetsUssdTransport(VumiTestCase):
         self.assertEqual(status['details'], {
             'response_time': self.transport.request_timeout + 0.1,
         })
+
+    @inlineCallbacks
+    def test_instrumentation(self):
+        '''Time spent on sessions, publishing and status events should be
+        recorded separately.'''
+        d = self.tx_helper.mk_request(
+            userdata='test', msisdn='+123', sessionid='4')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+
+        instrumentation = self.transport.instrumentation
+        self.assertEqual(
+            sorted(instrumentation.histograms),
+            ['publish', 'session', 'status'])
+        self.assertEqual(instrumentation.histograms['session'].count, 1)
+        self.assertEqual(instrumentation.histograms['publish'].count, 1)
+
+        self.tx_helper.dispatch_outbound(
+            msg.reply('foo', continue_session=False))
+        yield d
+        self.assertEqual(instrumentation.histograms['session'].count, 2)
+
+    def test_request_timeouts(self):
+        '''Only requests that are still pending should be timed out, once
+        they have waited longer than the request timeout.'''
+        transport = self.transport
+        closed = []
+
+        def close_request(request_id):
+            closed.append(request_id)
+            transport.remove_request(request_id)
+
+        self.patch(transport, 'close_request', close_request)
+        self.patch(transport, 'on_timeout', lambda *a: None)
+
+        now = self.clock.seconds()
+        transport.set_request('c', None, now + 2)
+        transport.set_request('a', None, now)
+        transport.set_request('b', None, now + 1)
+        transport.remove_request('b')
+
+        self.clock.advance(transport.request_timeout + 1.5)
+        transport.manually_close_requests()
+        self.assertEqual(closed, ['a'])
+
+        self.clock.advance(1)
+        transport.manually_close_requests()
+        self.assertEqual(closed, ['a', 'c'])
+        self.assertEqual(transport.request_timestamps, [])
+
+    def test_request_timeouts_replaced_request(self):
+        '''A request that is set again should only time out once its new
+        timestamp is old enough.'''
+        transport = self.transport
+        closed = []
+        self.patch(transport, 'close_request', closed.append)
+        self.patch(transport, 'on_timeout', lambda *a: None)
+
+        now = self.clock.seconds()
+        transport.set_request('a', None, now)
+        transport.set_request('a', None, now + 10)
+
+        self.clock.advance(transport.request_timeout + 1)
+        transport.manually_close_requests()
+        self.assertEqual(closed, [])
+
+    def test_request_timestamps_compacted(self):
+        '''Finished requests should not be kept in the timeout index once
+        they outnumber pending requests.'''
+        transport = self.transport
+
+        for i in range(2000):
+            transport.set_request(str(i), None)
+
+        for i in range(2000):
+            transport.remove_request(str(i))
+
+        self.assertTrue(len(transport.request_timestamps) < 1024)
+
+
+class TestVas2NetsUssdTransportSessionCache(TestVas2NetsUssdTransport):
+    transport_config = {
+        'ussd_session_cache_size': 2,
+        'ussd_session_timeout': 60,
+    }
+
+    def get_count(self, metric):
+        return sum(v for (_, v) in metric.poll())
+
+    @inlineCallbacks
+    def mk_session_request(self, sessionid='4', continue_session=True):
+        d = self.tx_helper.mk_request(
+            userdata='test', msisdn='+123', sessionid=sessionid)
+
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.tx_helper.clear_dispatched_inbound()
+
+        self.tx_helper.dispatch_outbound(
+            msg.reply('foo', continue_session=continue_session))
+
+        yield d
+        returnValue(msg)
+
+    @inlineCallbacks
+    def test_session_cache_hit(self):
+        msg1 = yield self.mk_session_request()
+        msg2 = yield self.mk_session_request()
+
+        self.assertEqual(
+            msg1['session_event'], TransportUserMessage.SESSION_NEW)
+        self.assertEqual(
+            msg2['session_event'], TransportUserMessage.SESSION_RESUME)
+
+        self.assertEqual(self.get_count(self.transport.session_cache_hits), 1)
+        self.assertEqual(
+            self.get_count(self.transport.session_cache_misses), 1)
+
+        session = yield self.transport.session_manager.load_session('4')
+        self.assertEqual(session['transaction_id'], '4')
+
+    @inlineCallbacks
+    def test_session_cache_close(self):
+        yield self.mk_session_request(continue_session=False)
+        self.assertEqual(len(self.transport.session_cache), 0)
+
+        msg = yield self.mk_session_request()
+        self.assertEqual(
+            msg['session_event'], TransportUserMessage.SESSION_NEW)
+
+    @inlineCallbacks
+    def test_session_cache_expiry(self):
+        yield self.mk_session_request()
+        self.clock.advance(60)
+        yield self.mk_session_request()
+
+        self.assertEqual(self.get_count(self.transport.session_cache_hits), 0)
+        self.assertEqual(
+            self.get_count(self.transport.session_cache_misses), 2)
+
+    @inlineCallbacks
+    def test_session_cache_eviction(self):
+        yield self.mk_session_request('4')
+        yield self.mk_session_request('5')
+        yield self.mk_session_request('6')
+        yield self.mk_session_request('4')
+
+        self.assertEqual(self.get_count(self.transport.session_cache_hits), 0)
+        self.assertEqual(
+            self.get_count(self.transport.session_cache_misses), 4)
+
+    @inlineCallbacks
+    def test_session_cache_missing_from_redis(self):
+        '''If a cached session is no longer in Redis, it should be forgotten
+        so that the next request recreates it.'''
+        yield self.mk_session_request()
+        yield self.transport.session_manager.clear_session('4')
+
+        msg1 = yield self.mk_session_request()
+        self.assertEqual(
+            msg1['session_event'], TransportUserMessage.SESSION_RESUME)
+
+        # The session's expiry time is updated without waiting
+        yield wait_for(lambda: len(self.transport.session_cache) == 0)
+
+        msg2 = yield self.mk_session_request()
+        self.assertEqual(
+            msg2['session_event'], TransportUserMessage.SESSION_NEW)
+
+    @inlineCallbacks
+    def test_teardown_stops_session_manager(self):
+        '''The session manager should be stopped along with its Redis
+        connection, if it has one.'''
+        manager = self.transport.session_manager
+        stop = manager.stop
+        stops = []
+        self.patch(
+            manager, 'stop', lambda **kw: stops.append(kw) or stop(**kw))
+
+        yield self.tx_helper.cleanup_worker(self.transport)
+        self.assertEqual(stops, [{}])
+
+
+class TestVas2NetsUssdTransportMemorySessions(TestVas2NetsUssdTransport):
+    transport_config = {
+        'ussd_session_backend': 'memory',
+        'ussd_session_timeout': 60,
+    }
+
+    @inlineCallbacks
+    def test_session_expiry(self):
+        d = self.tx_helper.mk_request(
+            userdata='test', msisdn='+123', sessionid='4')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.tx_helper.dispatch_outbound(msg.reply('foo'))
+        yield d
+
+        self.assertEqual(len(self.transport.session_manager.sessions), 1)
+        self.clock.advance(61)
+        self.assertEqual(len(self.transport.session_manager.sessions), 0)
+
+    def test_config_invalid_session_backend(self):
+        self.assertRaises(
+            ConfigError, Vas2NetsUssdTransport.CONFIG_CLASS, {
+                'transport_name': 'sphex',
+                'web_port': 0,
+                'web_path': '/api/v1/vas2nets/ussd/',
+                'ussd_number': '*123*45#',
+                'ussd_session_backend': 'riak',
+            })
+
+
+class BenchmarkVas2NetsUssdSessions(VumiTestCase):
+    """
+    Runs increasing numbers of concurrent USSD sessions through the
+    transport, with an application that echoes each request back, to find
+    how many concurrent sessions a single transport can handle. See
+    `vxvas2nets.tests.benchmarks` for how to run and tune it.
+    """
+
+    timeout = 1800
+
+    @inlineCallbacks
+    def setUp(self):
+        skip_unless_benchmarking()
+        self.params = get_params(
+            levels='100,250,500,1000',
+            steps=3,
+            think_time=0.0,
+            ramp_up=1.0,
+            close_ratio=0.8,
+            slo=1.0)
+
+        self.tx_helper = self.add_helper(
+            HttpRpcTransportHelper(Vas2NetsUssdTransport))
+
+        self.transport = yield self.tx_helper.get_transport({
+            'web_port': 0,
+            'web_path': '/api/v1/vas2nets/ussd/',
+            'ussd_number': '*123*45#',
+        })
+
+        self.redis = CountingRedis(self.transport.session_manager.redis)
+        self.transport.session_manager.redis = self.redis
+
+        connector = self.transport.connectors[self.transport.transport_name]
+        self.publish_inbound = connector.publish_inbound
+        self.patch(connector, 'publish_inbound', self.echo_inbound)
+
+    def echo_inbound(self, msg, endpoint_name=None):
+        d = self.publish_inbound(msg, endpoint_name)
+        d.addCallback(self.echo, msg)
+        return d
+
+    def echo(self, result, msg):
+        self.tx_helper.dispatch_outbound(msg.reply(
+            msg['content'], continue_session=msg['content'] != 'close'))
+
+        return result
+
+    def request(self, content, msisdn, session_id):
+        return self.tx_helper.mk_request(
+            userdata=content, msisdn=msisdn, sessionid=session_id)
+
+    @inlineCallbacks
+    def test_session_churn(self):
+        generator = UssdLoadGenerator(
+            self.request,
+            steps=self.params['steps'],
+            think_time=self.params['think_time'],
+            close_ratio=self.params['close_ratio'],
+            ramp_up=self.params['ramp_up'],
+            seed=self.params['seed'])
+
+        levels = []
+        saturation = None
+        best = 0
+
+        for sessions in map(int, self.params['levels'].split(',')):
+            self.redis.calls = 0
+            seconds, latencies = yield generator.run(sessions)
+            self.tx_helper.clear_all_dispatched()
+
+            results = summarize(seconds, latencies)
+            results['sessions'] = sessions
+            results['session_ops_per_request'] = (
+                self.redis.calls / float(len(latencies)))
+            levels.append(results)
+
+            # The transport is saturated once more sessions no longer get
+            # more requests through, or the slowest requests take too long
+            if (results['msgs_per_sec'] < best * 1.1 or
+                    results['latency_p99'] > self.params['slo']):
+                break
+
+            saturation = sessions
+            best = results['msgs_per_sec']
+
+        for results in levels:
+            report('ussd_sessions_%d' % (results['sessions'],),
+                   self.params, results)
+
+        report('ussd_sessions', self.params, {
+            'saturation_sessions': saturation,
+            'saturation_msgs_per_sec': best,
+        })
+
+
+class BenchmarkVas2NetsUssdPendingRequests(VumiTestCase):
+    """
+    Compares the time taken by vumi's scan over every pending request to
+    look for timed out requests to the time taken with requests indexed by
+    timestamp. See `vxvas2nets.tests.benchmarks` for how to run and tune
+    it.
+    """
+
+    timeout = 600
+
+    @inlineCallbacks
+    def setUp(self):
+        skip_unless_benchmarking()
+        self.params = get_params(requests=50000, expired=500, rounds=20)
+
+        self.clock = Clock()
+        self.patch(Vas2NetsUssdTransport, 'get_clock', lambda _: self.clock)
+
+        self.tx_helper = self.add_helper(
+            HttpRpcTransportHelper(Vas2NetsUssdTransport))
+
+        self.transport = yield self.tx_helper.get_transport({
+            'web_port': 0,
+            'web_path': '/api/v1/vas2nets/ussd/',
+            'ussd_number': '*123*45#',
+        })
+
+        self.patch(self.transport, 'on_timeout', lambda *a: None)
+        self.patch(
+            self.transport, 'close_request', self.transport.remove_request)
+
+    def fill(self):
+        transport = self.transport
+        now = self.clock.seconds()
+        expired_at = now - transport.request_timeout - 1
+
+        for i in range(self.params['requests']):
+            if i < self.params['expired']:
+                transport.set_request('%d-%d' % (now, i), None, expired_at)
+            else:
+                transport.set_request('%d-%d' % (now, i), None, now)
+
+    def sweep(self, name, f):
+        latencies = []
+
+        for _ in range(self.params['rounds']):
+            self.fill()
+            started = time.time()
+            f()
+            latencies.append(time.time() - started)
+
+            for request_id in self.transport._requests.keys():
+                self.transport.remove_request(request_id)
+
+            self.clock.advance(1)
+
+        report('ussd_pending_requests_%s' % (name,), self.params, {
+            'sweep_p50': percentile(latencies, 50),
+            'sweep_max': max(latencies),
+            'peak_rss_kb': peak_rss(),
+        })
+
+    def test_sweep(self):
+        self.sweep('scan', lambda: HttpRpcTransport.manually_close_requests(
+            self.transport))
+
+        self.sweep('indexed', self.transport.manually_close_requests)
@@ -1,17 +1,40 @@
 import re
 import json
+import random
+import zlib
 import treq
+from collections import deque
+from urllib import urlencode
+from urlparse import urlparse
 
 from twisted.web import http
-from twisted.internet.defer import inlineCallbacks, CancelledError
-from twisted.internet.error import ConnectingCancelledError
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, CancelledError, Deferred, DeferredList,
+    succeed, maybeDeferred)
+from twisted.internet.error import (
+    ConnectingCancelledError, ConnectError, DNSLookupError)
+from twisted.internet.task import LoopingCall, deferLater
 from twisted.web._newclient import ResponseNeverReceived
+from twisted.web.client import HTTPConnectionPool
 
-from vumi.config import ConfigText, ConfigInt
+from vumi.blinkenlights.metrics import Metric, Count, AVG, MAX
+from vumi.config import (
+    ConfigText, ConfigInt, ConfigFloat, ConfigList, ConfigBool, ConfigDict)
+from vumi.message import TransportUserMessage
+from vumi.persist.txredis_manager import TxRedisManager
 from vumi.transports.httprpc import HttpRpcTransport
 
+from vxvas2nets.dedup import MemoryDedupCache, RedisDedupCache
+from vxvas2nets.journal import Journal
+from vxvas2nets.instrumentation import (
+    InstrumentationConfig, InstrumentationMixin, percentile)
+from vxvas2nets.status import StatusAggregatorConfig, StatusAggregatorMixin
 
-class Vas2NetsSmsTransportConfig(HttpRpcTransport.CONFIG_CLASS):
+
+class Vas2NetsSmsTransportConfig(
+        HttpRpcTransport.CONFIG_CLASS, StatusAggregatorConfig,
+        InstrumentationConfig):
     """Config for SMS transport."""
 
     outbound_url = ConfigText(
@@ -23,6 +46,41 @@ class Vas2NetsSmsTransportConfig(HttpRpcTransport.CONFIG_CLASS):
         "null for no timeout",
         default=None)
 
+    outbound_adaptive_timeout = ConfigBool(
+        "If true, the timeout for requests for sending messages is worked "
+        "out from the latencies of recent requests instead of using "
+        "`outbound_request_timeout`. The timeout is "
+        "`outbound_adaptive_timeout_multiple` times the 99th percentile "
+        "latency, bounded by `outbound_adaptive_timeout_min` and "
+        "`outbound_adaptive_timeout_max`. Only requests that complete are "
+        "counted, so requests timing out while Vas2Nets is down don't make "
+        "the timeout longer",
+        default=False, static=True)
+
+    outbound_adaptive_timeout_multiple = ConfigFloat(
+        "Multiple of the 99th percentile latency to use as the adaptive "
+        "request timeout",
+        default=3.0, static=True)
+
+    outbound_adaptive_timeout_min = ConfigFloat(
+        "Minimum adaptive request timeout in seconds",
+        default=1.0, static=True)
+
+    outbound_adaptive_timeout_max = ConfigFloat(
+        "Maximum adaptive request timeout in seconds. This is also the "
+        "timeout used until enough latencies have been seen",
+        default=30.0, static=True)
+
+    outbound_adaptive_timeout_window = ConfigInt(
+        "Number of latencies of recent requests that completed to work out "
+        "the adaptive request timeout from",
+        default=200, static=True)
+
+    outbound_adaptive_timeout_min_samples = ConfigInt(
+        "Number of request latencies that need to be seen before the "
+        "adaptive request timeout is used",
+        default=20, static=True)
+
     reply_outbound_url = ConfigText(
         "Url to use for reply outbound messages",
         required=True)
@@ -35,8 +93,842 @@ class Vas2NetsSmsTransportConfig(HttpRpcTransport.CONFIG_CLASS):
         "Password to use for outbound messages",
         required=True)
 
+    outbound_pool_max_per_host = ConfigInt(
+        "Maximum number of idle persistent connections to keep open to each "
+        "outbound host",
+        default=2, static=True)
+
+    outbound_pool_idle_timeout = ConfigInt(
+        "Number of seconds an idle persistent connection to an outbound host "
+        "is kept open before it is closed",
+        default=240, static=True)
+
+    outbound_pool_prewarm = ConfigInt(
+        "Number of connections to open to each outbound url when the "
+        "transport starts, or 0 to open connections on demand",
+        default=0, static=True)
+
+    outbound_max_in_flight = ConfigInt(
+        "Maximum number of outbound messages to send concurrently. While "
+        "this many sends are in flight, the transport stops consuming "
+        "outbound messages until one of them completes. If null, each "
+        "outbound message is sent to completion before the next one is "
+        "consumed. Messages are acknowledged to the message broker once they "
+        "are consumed rather than once they are sent, so if the transport "
+        "crashes, the messages it has in flight (and waiting in "
+        "`outbound_queue_size`) are lost instead of being delivered again. "
+        "This is why it is null by default, and it should be kept to the "
+        "number of sends needed to keep up with Vas2Nets' latency",
+        default=None, static=True)
+
+    outbound_queue_size = ConfigInt(
+        "Number of outbound messages to hold in priority lanes while "
+        "`outbound_max_in_flight` sends are in flight. Replies to inbound "
+        "messages wait in the 'reply' lane and other messages in the 'bulk' "
+        "lane, and waiting messages are sent from each lane in proportion to "
+        "`outbound_lane_weights`. The transport stops consuming outbound "
+        "messages while this many messages are waiting. If null, messages "
+        "are sent in the order they are consumed. Waiting messages have "
+        "already been acknowledged to the message broker, and are lost if "
+        "the transport crashes",
+        default=None, static=True)
+
+    outbound_batch_window = ConfigFloat(
+        "If set, outbound messages with the same sender and content that "
+        "are sent within this many seconds of each other are sent to "
+        "Vas2Nets in a single request with multiple receivers. Replies to "
+        "inbound messages are always sent on their own. A batch counts as a "
+        "message for each receiver towards `outbound_rate_limit`. Requires "
+        "`outbound_max_in_flight`, which also limits the size of batches",
+        default=None, static=True)
+
+    outbound_batch_max_size = ConfigInt(
+        "Maximum number of receivers to send a message to in a single "
+        "request. A batch is sent as soon as it reaches this size",
+        default=100, static=True)
+
+    outbound_lane_weights = ConfigDict(
+        "Share of sends given to each of the 'reply' and 'bulk' priority "
+        "lanes while both lanes have messages waiting",
+        default={'reply': 4, 'bulk': 1}, static=True)
+
+    outbound_rate_limit = ConfigFloat(
+        "Maximum number of messages per second to send to each of "
+        "outbound_url and reply_outbound_url, or null for no limit. Messages "
+        "over the limit wait until they can be sent",
+        default=None, static=True)
+
+    outbound_rate_burst = ConfigInt(
+        "Maximum number of messages that can be sent at once to each of "
+        "outbound_url and reply_outbound_url before outbound_rate_limit "
+        "applies",
+        default=1, static=True)
+
+    outbound_retry_max_attempts = ConfigInt(
+        "Maximum number of times to try sending a message before nacking it "
+        "when sending fails with one of outbound_retry_types. Retrying "
+        "requires `outbound_max_in_flight`, so that a message waiting to be "
+        "retried doesn't hold up other messages",
+        default=1, static=True)
+
+    outbound_retry_types = ConfigList(
+        "Failure types that are retried. These are the types used for "
+        "outbound status events, for example 'request_timeout', "
+        "'connection_error' or 'system_error'",
+        default=['request_timeout', 'connection_error', 'system_error'],
+        static=True)
+
+    outbound_retry_delay = ConfigFloat(
+        "Number of seconds to wait before the first retry. The delay doubles "
+        "for each retry after that",
+        default=1.0, static=True)
+
+    outbound_retry_max_delay = ConfigFloat(
+        "Maximum number of seconds to wait before a retry",
+        default=60.0, static=True)
+
+    outbound_retry_jitter = ConfigFloat(
+        "Fraction of each retry delay to randomly take off, to avoid retries "
+        "for many messages happening at the same time",
+        default=0.5, static=True)
+
+    outbound_breaker_failure_ratio = ConfigFloat(
+        "Fraction of recent sends that need to fail with a timeout, a 5xx "
+        "response or a system error for the circuit breaker to open and stop "
+        "sending to Vas2Nets, or null to disable the circuit breaker",
+        default=None, static=True)
+
+    outbound_breaker_window = ConfigInt(
+        "Number of recent sends the circuit breaker looks at when deciding "
+        "whether to open",
+        default=20, static=True)
+
+    outbound_breaker_min_sends = ConfigInt(
+        "Minimum number of recent sends needed before the circuit breaker "
+        "can open",
+        default=10, static=True)
+
+    outbound_breaker_reset_timeout = ConfigFloat(
+        "Number of seconds the circuit breaker stays open before letting a "
+        "single probe send through to check whether Vas2Nets has recovered",
+        default=30.0, static=True)
+
+    outbound_breaker_hold = ConfigBool(
+        "If true, messages are held back while the circuit breaker is open "
+        "and sent once it closes. If false, they are nacked straight away. "
+        "Messages still held when the transport stops are handled as if "
+        "the breaker were open",
+        default=False, static=True)
+
+    outbound_urls = ConfigList(
+        "Additional urls to spread non-reply sends across, along with "
+        "outbound_url. Each item is either a url or a dict with a 'url' and "
+        "a 'weight' greater than 0",
+        default=[], static=True)
+
+    reply_outbound_urls = ConfigList(
+        "Additional urls to spread reply sends across, along with "
+        "reply_outbound_url. Each item is either a url or a dict with a "
+        "'url' and a 'weight' greater than 0",
+        default=[], static=True)
+
+    outbound_balancing = ConfigText(
+        "How to choose between multiple outbound urls. Either "
+        "'least_outstanding', which prefers urls with fewer sends in flight "
+        "and better recent latency and error rates, or "
+        "'weighted_round_robin', which takes turns between urls in proportion "
+        "to their weights, scaled down by their recent error rates",
+        default='least_outstanding', static=True)
+
+    outbound_eject_failures = ConfigInt(
+        "Number of sends to an outbound url that need to fail in a row for "
+        "the url to be taken out of use for outbound_eject_duration",
+        default=5, static=True)
+
+    outbound_eject_duration = ConfigFloat(
+        "Number of seconds an outbound url that keeps failing is taken out "
+        "of use for",
+        default=30.0, static=True)
+
+    log_sample_every = ConfigInt(
+        "If set, log what happens to 1 in every `log_sample_every` outbound "
+        "messages even when `noisy` is false. Messages are sampled by their "
+        "message id, so every log line for a sampled message is logged",
+        default=None, static=True)
+
+    outbound_dedup = ConfigText(
+        "Where to remember the ack or nack published for each sent outbound "
+        "message, so that a message that is delivered to the transport again "
+        "has the same ack or nack published again instead of being sent "
+        "again. Either 'memory', 'redis' or null to send every message "
+        "that is delivered",
+        default=None, static=True)
+
+    outbound_dedup_ttl = ConfigInt(
+        "Number of seconds to remember the ack or nack for a sent outbound "
+        "message for",
+        default=86400, static=True)
+
+    outbound_dedup_max_size = ConfigInt(
+        "Maximum number of acks and nacks to remember when `outbound_dedup` "
+        "is 'memory'",
+        default=100000, static=True)
+
+    inbound_dedup = ConfigText(
+        "Where to remember the Vas2Nets msgids of inbound messages, so that "
+        "an inbound message that Vas2Nets sends again is responded to "
+        "without being published again. Either 'memory', 'redis' or null to "
+        "publish every inbound message",
+        default=None, static=True)
+
+    inbound_dedup_ttl = ConfigInt(
+        "Number of seconds to remember the msgid of an inbound message for",
+        default=3600, static=True)
+
+    inbound_dedup_max_size = ConfigInt(
+        "Maximum number of inbound msgids to remember when `inbound_dedup` "
+        "is 'memory'",
+        default=100000, static=True)
+
+    inbound_journal_path = ConfigText(
+        "If set, the directory to journal inbound messages to. Inbound "
+        "messages are written to the journal and responded to before they "
+        "are published, and messages that were journaled but not yet "
+        "published when the transport stopped are published when it starts "
+        "again",
+        default=None, static=True)
+
+    inbound_journal_retry_delay = ConfigFloat(
+        "Number of seconds to wait before publishing a journaled inbound "
+        "message again after publishing it failed. A message stays in the "
+        "journal until it is published, and holds up the deletion of the "
+        "journal's later segments until then",
+        default=5.0, static=True)
+
+    inbound_journal_segment_size = ConfigInt(
+        "Number of bytes to write to each of the inbound journal's segment "
+        "files before starting a new one. A segment file is deleted once the "
+        "messages in it, and in earlier segments, have been published",
+        default=1024 * 1024, static=True)
+
+    outbound_spool_path = ConfigText(
+        "If set, the directory to spool outbound messages to when sending "
+        "them fails with one of `outbound_spool_types`. Spooled messages are "
+        "sent again at `outbound_spool_drain_rate`, and are only acked or "
+        "nacked once sending them succeeds or fails with an error that "
+        "isn't in `outbound_spool_types`",
+        default=None, static=True)
+
+    outbound_spool_types = ConfigList(
+        "Types of send failures that cause outbound messages to be spooled",
+        default=[
+            'request_timeout', 'connection_error', 'system_error',
+            'circuit_open'],
+        static=True)
+
+    outbound_spool_max_size = ConfigInt(
+        "Maximum number of outbound messages to spool",
+        default=10000, static=True)
+
+    outbound_spool_overflow = ConfigText(
+        "What to do with a message that fails once the spool is full. "
+        "'reject_new' nacks the message, and 'drop_oldest' nacks the oldest "
+        "spooled message to make space for the new one. The message being "
+        "sent again from the spool isn't dropped, if it is the only spooled "
+        "message the new message is nacked",
+        default='reject_new', static=True)
+
+    outbound_spool_drain_rate = ConfigFloat(
+        "Number of spooled messages to try send again per second. A message "
+        "that fails to send again is moved to the back of the spool, so that "
+        "a message that keeps failing doesn't hold up the others",
+        default=1.0, static=True)
+
+    outbound_spool_max_age = ConfigFloat(
+        "If set, the number of seconds a message can stay spooled for. A "
+        "message that fails to send again once it has been spooled for this "
+        "long is nacked instead of being kept",
+        default=None, static=True)
+
+    outbound_spool_segment_size = ConfigInt(
+        "Number of bytes to write to each of the spool's segment files "
+        "before starting a new one",
+        default=1024 * 1024, static=True)
+
+    redis_manager = ConfigDict(
+        "Redis client configuration, used when `outbound_dedup` or "
+        "`inbound_dedup` is 'redis'",
+        default={}, static=True)
+
+    def post_validate(self):
+        super(Vas2NetsSmsTransportConfig, self).post_validate()
+
+        if (self.outbound_max_in_flight is not None and
+                self.outbound_max_in_flight < 1):
+            self.raise_config_error(
+                'outbound_max_in_flight must be at least 1')
+
+        if (self.outbound_queue_size is not None and
+                self.outbound_queue_size < 1):
+            self.raise_config_error('outbound_queue_size must be at least 1')
+
+        if (self.outbound_queue_size is not None and
+                self.outbound_max_in_flight is None):
+            self.raise_config_error(
+                'outbound_queue_size requires outbound_max_in_flight')
+
+        if (self.outbound_rate_limit is not None and
+                self.outbound_rate_limit <= 0):
+            self.raise_config_error(
+                'outbound_rate_limit must be greater than 0')
+
+        if self.outbound_rate_burst < 1:
+            self.raise_config_error('outbound_rate_burst must be at least 1')
+
+        if (self.outbound_batch_window is not None and
+                self.outbound_max_in_flight is None):
+            self.raise_config_error(
+                'outbound_batch_window requires outbound_max_in_flight')
+
+        if (self.outbound_retry_max_attempts > 1 and
+                self.outbound_max_in_flight is None):
+            self.raise_config_error(
+                'outbound_retry_max_attempts requires outbound_max_in_flight')
 
-class Vas2NetsSmsTransport(HttpRpcTransport):
+        if sorted(self.outbound_lane_weights) != sorted(PriorityLanes.LANES):
+            self.raise_config_error(
+                'Outbound lane weights must be given for: %s' % (
+                    ', '.join(PriorityLanes.LANES),))
+
+        if self.outbound_dedup not in (None, 'memory', 'redis'):
+            self.raise_config_error(
+                'Invalid outbound dedup backend: %s' % (self.outbound_dedup,))
+
+        if self.outbound_spool_overflow not in ('reject_new', 'drop_oldest'):
+            self.raise_config_error(
+                'Invalid outbound spool overflow policy: %s' % (
+                    self.outbound_spool_overflow,))
+
+        if self.outbound_spool_drain_rate <= 0:
+            self.raise_config_error(
+                'outbound_spool_drain_rate must be greater than 0')
+
+        if self.inbound_dedup not in (None, 'memory', 'redis'):
+            self.raise_config_error(
+                'Invalid inbound dedup backend: %s' % (self.inbound_dedup,))
+
+        if self.inbound_journal_retry_delay <= 0:
+            self.raise_config_error(
+                'inbound_journal_retry_delay must be greater than 0')
+
+        if self.outbound_balancing not in EndpointBalancer.MODES:
+            self.raise_config_error(
+                'Invalid outbound balancing mode: %s' % (
+                    self.outbound_balancing,))
+
+        for url in self.outbound_urls + self.reply_outbound_urls:
+            if isinstance(url, dict) and url.get('weight', 1) <= 0:
+                self.raise_config_error(
+                    'Outbound url weights must be greater than 0: %s' % (
+                        url['url'],))
+
+
+TIMEOUT_ERRORS = (
+    ResponseNeverReceived, ConnectingCancelledError, CancelledError)
+
+CONNECTION_ERRORS = (ConnectError, DNSLookupError)
+
+
+class LatencyWindow(object):
+    """
+    Keeps the latencies of the last `size` requests, for estimating
+    percentiles of recent latency.
+    """
+
+    def __init__(self, size):
+        self.latencies = deque(maxlen=size)
+
+    def __len__(self):
+        return len(self.latencies)
+
+    def record(self, latency):
+        self.latencies.append(latency)
+
+    def percentile(self, p):
+        return percentile(self.latencies, p)
+
+
+class Endpoint(object):
+    """
+    An outbound url along with what we have seen of its recent health.
+    """
+
+    # How much weight the latest outcome gets in the moving averages
+    ALPHA = 0.2
+
+    def __init__(self, url, weight=1):
+        self.url = url
+        self.weight = weight
+        self.outstanding = 0
+        self.latency = 0.0
+        self.error_rate = 0.0
+        self.failures = 0
+        self.ejected_until = None
+        self.current_weight = 0
+
+    def expected_latency(self):
+        # Errors make an endpoint as slow as the retries they lead to
+        return (self.latency + 0.001) / max(0.05, 1 - self.error_rate)
+
+    def effective_weight(self):
+        return self.weight * max(0.05, 1 - self.error_rate)
+
+    def record(self, success, latency):
+        self.latency += self.ALPHA * (latency - self.latency)
+        self.error_rate += self.ALPHA * ((0 if success else 1) -
+                                         self.error_rate)
+        self.failures = 0 if success else self.failures + 1
+
+    def to_dict(self, now):
+        return {
+            'url': self.url,
+            'weight': self.weight,
+            'outstanding': self.outstanding,
+            'latency': self.latency,
+            'error_rate': self.error_rate,
+            'ejected': self.is_ejected(now),
+        }
+
+    def is_ejected(self, now):
+        return self.ejected_until is not None and now < self.ejected_until
+
+
+class EndpointBalancer(object):
+    """
+    Chooses which of a set of equivalent outbound urls to send to, taking
+    urls that keep failing out of use for a while.
+    """
+
+    LEAST_OUTSTANDING = 'least_outstanding'
+    WEIGHTED_ROUND_ROBIN = 'weighted_round_robin'
+    MODES = (LEAST_OUTSTANDING, WEIGHTED_ROUND_ROBIN)
+
+    def __init__(self, clock, endpoints, mode=LEAST_OUTSTANDING,
+                 eject_failures=5, eject_duration=30, on_eject=None):
+        self.clock = clock
+        self.endpoints = endpoints
+        self.mode = mode
+        self.eject_failures = eject_failures
+        self.eject_duration = eject_duration
+        self.on_eject = on_eject
+
+    @classmethod
+    def from_urls(cls, clock, urls, **kw):
+        endpoints = []
+
+        for url in urls:
+            if isinstance(url, dict):
+                endpoints.append(Endpoint(url['url'], url.get('weight', 1)))
+            else:
+                endpoints.append(Endpoint(url))
+
+        return cls(clock, endpoints, **kw)
+
+    def available(self):
+        now = self.clock.seconds()
+        endpoints = [e for e in self.endpoints if not e.is_ejected(now)]
+
+        # If every endpoint has been ejected, we may as well try all of them
+        return endpoints or self.endpoints
+
+    def choose(self):
+        endpoints = self.available()
+
+        if len(endpoints) == 1:
+            return endpoints[0]
+        elif self.mode == self.WEIGHTED_ROUND_ROBIN:
+            return self.choose_weighted_round_robin(endpoints)
+        else:
+            return self.choose_least_outstanding(endpoints)
+
+    def choose_least_outstanding(self, endpoints):
+        return min(endpoints, key=lambda e: (
+            (e.outstanding + 1) * e.expected_latency() / e.weight))
+
+    def choose_weighted_round_robin(self, endpoints):
+        # Smooth weighted round robin, as used by nginx
+        total = 0
+
+        for endpoint in endpoints:
+            weight = endpoint.effective_weight()
+            endpoint.current_weight += weight
+            total += weight
+
+        endpoint = max(endpoints, key=lambda e: e.current_weight)
+        endpoint.current_weight -= total
+        return endpoint
+
+    def start(self, endpoint):
+        endpoint.outstanding += 1
+        return self.clock.seconds()
+
+    def finish(self, endpoint, started, success):
+        endpoint.outstanding -= 1
+        endpoint.record(success, self.clock.seconds() - started)
+
+        if endpoint.failures >= self.eject_failures:
+            self.eject(endpoint)
+
+    def eject(self, endpoint):
+        endpoint.failures = 0
+        endpoint.ejected_until = self.clock.seconds() + self.eject_duration
+
+        if self.on_eject is not None:
+            self.on_eject(endpoint)
+
+    def to_dicts(self):
+        now = self.clock.seconds()
+        return [e.to_dict(now) for e in self.endpoints]
+
+
+class CircuitBreaker(object):
+    """
+    Tracks the outcome of recent calls and opens once too many of them
+    have failed. While open, calls are not allowed. After `reset_timeout`
+    seconds, the breaker is half-open and a single probe call is allowed
+    through: the breaker closes again if it succeeds and re-opens if it
+    fails.
+
+    Each allowed call is given a token, which is passed back with the call's
+    outcome. Outcomes of calls that were allowed before the breaker last
+    changed state are ignored, so that a call started before the breaker
+    opened can't be taken for the probe.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, clock, failure_ratio, window, min_calls, reset_timeout,
+                 on_state_change=None):
+        self.clock = clock
+        self.failure_ratio = failure_ratio
+        self.min_calls = min_calls
+        self.reset_timeout = reset_timeout
+        self.on_state_change = on_state_change
+        self.state = self.CLOSED
+        self.outcomes = deque(maxlen=window)
+        self.generation = 1
+        self.probing = False
+        self.waiting = deque()
+        self.delayed_call = None
+        self.stopped = False
+
+    def allow(self):
+        """
+        Returns a token for the call if it is allowed, or None if it isn't.
+        """
+        if self.stopped:
+            return None
+
+        if self.state == self.CLOSED:
+            return self.generation
+
+        if self.state == self.HALF_OPEN and not self.probing:
+            self.probing = True
+            return self.generation
+
+        return None
+
+    def wait(self):
+        """
+        Returns a deferred that fires with a token once a call is allowed, or
+        with None if the breaker is stopped first.
+        """
+        if self.stopped:
+            return succeed(None)
+
+        if not self.waiting:
+            token = self.allow()
+
+            if token is not None:
+                return succeed(token)
+
+        d = Deferred()
+        self.waiting.append(d)
+        return d
+
+    def release_waiting(self):
+        while self.waiting:
+            token = self.allow()
+
+            if token is None:
+                break
+
+            self.waiting.popleft().callback(token)
+
+    def record(self, success, token=None):
+        """
+        Records the outcome of a call. `token` is the token the call was
+        allowed with, if any.
+        """
+        if token is not None and token != self.generation:
+            return
+
+        if self.state == self.HALF_OPEN:
+            if success:
+                self.set_state(self.CLOSED)
+            else:
+                self.set_state(self.OPEN)
+        elif self.state == self.CLOSED:
+            self.outcomes.append(success)
+
+            if self.should_open():
+                self.set_state(self.OPEN)
+
+    def should_open(self):
+        if len(self.outcomes) < self.min_calls:
+            return False
+
+        failures = self.outcomes.count(False)
+        return float(failures) / len(self.outcomes) >= self.failure_ratio
+
+    def set_state(self, state):
+        self.state = state
+        self.generation += 1
+        self.probing = False
+        self.outcomes.clear()
+
+        if state == self.OPEN:
+            self.delayed_call = self.clock.callLater(
+                self.reset_timeout, self.half_open)
+
+        if self.on_state_change is not None:
+            self.on_state_change(state)
+
+        self.release_waiting()
+
+    def half_open(self):
+        self.delayed_call = None
+        self.set_state(self.HALF_OPEN)
+
+    def stop(self):
+        """
+        Stops the breaker. Calls waiting to be allowed, and calls made after
+        this, aren't allowed.
+        """
+        self.stopped = True
+
+        if self.delayed_call is not None:
+            self.delayed_call.cancel()
+            self.delayed_call = None
+
+        while self.waiting:
+            self.waiting.popleft().callback(None)
+
+
+class TokenBucket(object):
+    """
+    Hands out tokens at `rate` tokens per second, allowing up to `burst`
+    tokens to accumulate while unused. Callers waiting for tokens are
+    served in the order they asked for them.
+
+    A caller asking for more than `burst` tokens is served once the bucket
+    is full, and the tokens it takes beyond that are taken out of the
+    tokens for the callers after it.
+    """
+
+    def __init__(self, clock, rate, burst):
+        self.clock = clock
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last_refill = clock.seconds()
+        self.waiting = deque()
+        self.delayed_call = None
+
+    def acquire(self, n=1):
+        d = Deferred()
+        self.waiting.append((n, d))
+
+        if self.delayed_call is None:
+            self.release()
+
+        return d
+
+    def refill(self):
+        now = self.clock.seconds()
+        elapsed = now - self.last_refill
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.last_refill = now
+
+    def release(self):
+        self.delayed_call = None
+        self.refill()
+
+        while self.waiting and self.tokens >= self.get_needed():
+            n, d = self.waiting.popleft()
+            self.tokens -= n
+            d.callback(None)
+
+        if self.waiting and self.delayed_call is None:
+            delay = (self.get_needed() - self.tokens) / self.rate
+            self.delayed_call = self.clock.callLater(delay, self.release)
+
+    def get_needed(self):
+        n, _ = self.waiting[0]
+        return min(n, self.burst)
+
+    def stop(self):
+        if self.delayed_call is not None:
+            self.delayed_call.cancel()
+            self.delayed_call = None
+
+
+class PriorityLanes(object):
+    """
+    Holds waiting outbound messages in a lane for each priority. Messages
+    are taken from the lanes in proportion to the lanes' weights, so a lane
+    with a low weight is still served while other lanes are busy.
+    """
+
+    REPLY = 'reply'
+    BULK = 'bulk'
+    LANES = (REPLY, BULK)
+
+    def __init__(self, clock, weights):
+        self.clock = clock
+        self.weights = weights
+        self.lanes = dict((lane, deque()) for lane in self.LANES)
+        self.current_weights = dict((lane, 0) for lane in self.LANES)
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.lanes.itervalues())
+
+    def put(self, lane, message):
+        self.lanes[lane].append((self.clock.seconds(), message))
+
+    def get(self):
+        """
+        Takes the next message to send out of the lanes, returning a tuple of
+        the lane, the message and the number of seconds it waited for.
+        """
+        # Smooth weighted round robin over the lanes with waiting messages
+        lanes = [lane for lane in self.LANES if self.lanes[lane]]
+        total = 0
+
+        for lane in lanes:
+            self.current_weights[lane] += self.weights[lane]
+            total += self.weights[lane]
+
+        lane = max(lanes, key=lambda lane: self.current_weights[lane])
+        self.current_weights[lane] -= total
+
+        queued_at, message = self.lanes[lane].popleft()
+        return lane, message, self.clock.seconds() - queued_at
+
+    def depth(self, lane):
+        return len(self.lanes[lane])
+
+
+class SendBatcher(object):
+    """
+    Collects messages with the same batch key for up to `window` seconds, or
+    until `max_size` messages have been collected, and sends them together
+    using `send_batch`. `send_batch` is given a list of messages and returns
+    a list of statuses, one for each message.
+    """
+
+    def __init__(self, clock, window, max_size, send_batch):
+        self.clock = clock
+        self.window = window
+        self.max_size = max_size
+        self.send_batch = send_batch
+        self.batches = {}
+
+    def add(self, key, message):
+        d = Deferred()
+        batch = self.batches.get(key)
+
+        if batch is None:
+            batch = self.batches[key] = {
+                'messages': [],
+                'deferreds': [],
+                'delayed_call': self.clock.callLater(
+                    self.window, self.flush, key),
+            }
+
+        batch['messages'].append(message)
+        batch['deferreds'].append(d)
+
+        if len(batch['messages']) >= self.max_size:
+            self.flush(key)
+
+        return d
+
+    def flush(self, key):
+        batch = self.batches.pop(key)
+
+        if batch['delayed_call'].active():
+            batch['delayed_call'].cancel()
+
+        d = maybeDeferred(self.send_batch, batch['messages'])
+        d.addCallbacks(
+            self.batch_sent, self.batch_failed,
+            callbackArgs=(batch['deferreds'],),
+            errbackArgs=(batch['deferreds'],))
+
+    def flush_all(self):
+        for key in self.batches.keys():
+            self.flush(key)
+
+    def batch_sent(self, statuses, deferreds):
+        for d, status in zip(deferreds, statuses):
+            d.callback(status)
+
+    def batch_failed(self, f, deferreds):
+        for d in deferreds:
+            d.errback(f)
+
+
+class Vas2NetsConnectionPool(HTTPConnectionPool):
+    """
+    Persistent connection pool that keeps track of how many connections
+    it has handed out and how many of those it had to newly open.
+    """
+
+    def __init__(self, reactor, persistent=True):
+        HTTPConnectionPool.__init__(self, reactor, persistent=persistent)
+        self.requested = 0
+        self.opened = 0
+        self.on_opened = None
+        self.on_reused = None
+
+    @property
+    def reused(self):
+        return self.requested - self.opened
+
+    def getConnection(self, key, endpoint):
+        self.requested += 1
+        opened = self.opened
+        d = HTTPConnectionPool.getConnection(self, key, endpoint)
+
+        if self.opened == opened and self.on_reused is not None:
+            self.on_reused()
+
+        return d
+
+    def _newConnection(self, key, endpoint):
+        self.opened += 1
+
+        if self.on_opened is not None:
+            self.on_opened()
+
+        return HTTPConnectionPool._newConnection(self, key, endpoint)
+
+
+class Vas2NetsSmsTransport(
+        InstrumentationMixin, StatusAggregatorMixin, HttpRpcTransport):
     CONFIG_CLASS = Vas2NetsSmsTransportConfig
     ERROR_RE = re.compile(r'^(?P<code>ERR-\d+) (?P<message>.*)$')
 
@@ -49,6 +941,8 @@ class Vas2NetsSmsTransport(HttpRpcTransport):
         'operator'
     ])
 
+    EXPECTED_FIELD_ORDER = tuple(sorted(EXPECTED_FIELDS))
+
     EXPECTED_MESSAGE_FIELDS = frozenset([
         'from_addr',
         'to_addr',
@@ -73,6 +967,282 @@ class Vas2NetsSmsTransport(HttpRpcTransport):
 
     transport_type = 'sms'
 
+    @inlineCallbacks
+    def setup_transport(self):
+        yield self.setup_instrumentation('vas2nets_sms')
+
+        for fail_type in self.get_send_fail_types():
+            self.instrumentation.add_counter(fail_type)
+
+        yield super(Vas2NetsSmsTransport, self).setup_transport()
+        config = self.get_static_config()
+
+        self.setup_status_aggregator()
+
+        self.pool = Vas2NetsConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = config.outbound_pool_max_per_host
+        self.pool.cachedConnectionTimeout = config.outbound_pool_idle_timeout
+        self.pool.on_opened = self.metrics.register(
+            Count('outbound.connections.opened')).inc
+        self.pool.on_reused = self.metrics.register(
+            Count('outbound.connections.reused')).inc
+
+        self.log_sample_every = config.log_sample_every
+        self.max_in_flight = config.outbound_max_in_flight
+        self.in_flight = set()
+        self.outbound_paused = False
+        self.queue_size = config.outbound_queue_size
+        self.lanes = None
+
+        if self.queue_size is not None:
+            self.lanes = PriorityLanes(
+                self.clock, config.outbound_lane_weights)
+            self.lane_metrics = dict((lane, {
+                'depth': self.metrics.register(Metric(
+                    'outbound.lanes.%s.depth' % (lane,), [AVG, MAX])),
+                'wait_time': self.metrics.register(Metric(
+                    'outbound.lanes.%s.wait_time' % (lane,), [AVG, MAX])),
+            }) for lane in PriorityLanes.LANES)
+
+        self.buckets = {}
+
+        self.balancers = {}
+
+        for url, urls in self.get_send_url_groups():
+            self.balancers[url] = EndpointBalancer.from_urls(
+                self.clock, [url] + urls,
+                mode=config.outbound_balancing,
+                eject_failures=config.outbound_eject_failures,
+                eject_duration=config.outbound_eject_duration,
+                on_eject=self.on_endpoint_eject)
+
+        self.latencies = None
+
+        if config.outbound_adaptive_timeout:
+            self.latencies = LatencyWindow(
+                config.outbound_adaptive_timeout_window)
+            # Not `request_timeout`, vumi uses that for inbound requests
+            self.adaptive_request_timeout = (
+                config.outbound_adaptive_timeout_max)
+            self.latency_p99_metric = self.metrics.register(Metric(
+                'outbound.latency.p99', [AVG, MAX]))
+            self.request_timeout_metric = self.metrics.register(Metric(
+                'outbound.request_timeout', [AVG, MAX]))
+
+        self.batcher = None
+
+        if config.outbound_batch_window is not None:
+            self.batcher = SendBatcher(
+                self.clock,
+                config.outbound_batch_window,
+                config.outbound_batch_max_size,
+                self.request_send_batch)
+
+        self.send_query_prefixes = dict(
+            (url, self.get_send_query_prefix(url))
+            for url in self.get_send_urls())
+
+        self.breaker = None
+
+        if config.outbound_breaker_failure_ratio is not None:
+            self.breaker = CircuitBreaker(
+                self.clock,
+                config.outbound_breaker_failure_ratio,
+                config.outbound_breaker_window,
+                config.outbound_breaker_min_sends,
+                config.outbound_breaker_reset_timeout,
+                on_state_change=self.on_breaker_state_change)
+
+        self.retry_count = self.metrics.register(Count('outbound.retries'))
+        self.retry_exhausted_count = self.metrics.register(
+            Count('outbound.retries_exhausted'))
+
+        self.redis = None
+        self.dedup = yield self.get_dedup_cache(
+            config.outbound_dedup,
+            config.outbound_dedup_ttl,
+            config.outbound_dedup_max_size,
+            'outbound_dedup')
+        self.duplicate_count = self.metrics.register(
+            Count('outbound.duplicates'))
+
+        self.inbound_dedup = yield self.get_dedup_cache(
+            config.inbound_dedup,
+            config.inbound_dedup_ttl,
+            config.inbound_dedup_max_size,
+            'inbound_dedup')
+        self.inbound_duplicate_count = self.metrics.register(
+            Count('inbound.duplicates'))
+
+        self.inbound_journal = None
+        self.inbound_publishing = set()
+        self.inbound_publish_retries = {}
+
+        if config.inbound_journal_path is not None:
+            self.inbound_journal = Journal(
+                config.inbound_journal_path,
+                config.inbound_journal_segment_size,
+                clock=self.clock)
+            self.inbound_journal.open()
+            self.replay_inbound_journal()
+
+        self.spool = None
+        self.spool_draining = None
+        self.spool_sending = None
+
+        if config.outbound_spool_path is not None:
+            self.spool = Journal(
+                config.outbound_spool_path,
+                config.outbound_spool_segment_size,
+                clock=self.clock)
+            self.spool.open()
+            self.spool_metrics = {
+                'depth': self.metrics.register(Metric(
+                    'outbound.spool.depth', [AVG, MAX])),
+                'age': self.metrics.register(Metric(
+                    'outbound.spool.age', [AVG, MAX])),
+                'disk_usage': self.metrics.register(Metric(
+                    'outbound.spool.disk_usage', [AVG, MAX])),
+            }
+            self.spool_task = LoopingCall(self.drain_spool)
+            self.spool_task.clock = self.clock
+            self.spool_task.start(
+                1.0 / config.outbound_spool_drain_rate, now=False)
+
+        yield self.prewarm_pool(config.outbound_pool_prewarm)
+
+    @inlineCallbacks
+    def teardown_transport(self):
+        if self.batcher is not None:
+            self.batcher.flush_all()
+
+        # Messages held by the breaker would otherwise only be let through
+        # one reset timeout at a time while Vas2Nets is down. Stopping it
+        # has them nacked or spooled as if the breaker were open.
+        if self.breaker is not None:
+            self.breaker.stop()
+
+        # Sends that finish start the sends waiting in the lanes, so we keep
+        # going until nothing is left in flight
+        while self.in_flight:
+            yield DeferredList(list(self.in_flight))
+
+        yield DeferredList(list(self.inbound_publishing))
+
+        # Messages waiting to be published again stay in the journal, and are
+        # published when the transport starts again
+        for delayed_call in self.inbound_publish_retries.itervalues():
+            delayed_call.cancel()
+
+        if self.spool is not None:
+            self.spool_task.stop()
+
+            if self.spool_draining is not None:
+                yield self.spool_draining
+
+            self.spool.close()
+
+        if self.inbound_journal is not None:
+            self.inbound_journal.close()
+
+        for bucket in self.buckets.itervalues():
+            bucket.stop()
+
+        if self.redis is not None:
+            yield self.redis._close()
+
+        self.teardown_status_aggregator()
+        self.teardown_instrumentation()
+        yield self.pool.closeCachedConnections()
+        yield super(Vas2NetsSmsTransport, self).teardown_transport()
+
+    def publish_ack(self, *args, **kw):
+        return self.instrumentation.measure(
+            'publish', super(Vas2NetsSmsTransport, self).publish_ack,
+            *args, **kw)
+
+    def publish_nack(self, *args, **kw):
+        return self.instrumentation.measure(
+            'publish', super(Vas2NetsSmsTransport, self).publish_nack,
+            *args, **kw)
+
+    @inlineCallbacks
+    def get_dedup_cache(self, backend, ttl, max_size, prefix):
+        if backend == 'memory':
+            returnValue(MemoryDedupCache(self.clock, ttl, max_size))
+        elif backend == 'redis':
+            redis = yield self.get_redis()
+            returnValue(RedisDedupCache(redis, ttl, prefix))
+        else:
+            returnValue(None)
+
+    @inlineCallbacks
+    def get_redis(self):
+        if self.redis is None:
+            config = self.get_static_config()
+            r_prefix = "vumi.transports.vas2nets_sms:%s" % (
+                self.transport_name,)
+            redis = yield TxRedisManager.from_config(config.redis_manager)
+            self.redis = redis.sub_manager(r_prefix)
+
+        returnValue(self.redis)
+
+    def get_health_response(self):
+        return json.dumps({
+            'pending_requests': len(self._requests),
+            'outbound_in_flight': len(self.in_flight),
+            'outbound_request_timeout': self.get_request_timeout(),
+            'outbound_spooled': len(self.spool) if self.spool else 0,
+            'outbound_endpoints': dict(
+                (url, balancer.to_dicts())
+                for url, balancer in self.balancers.iteritems()),
+            'outbound_connections': {
+                'opened': self.pool.opened,
+                'reused': self.pool.reused,
+            },
+        })
+
+    def get_send_url_groups(self):
+        config = self.get_static_config()
+        groups = [(self.config['outbound_url'], config.outbound_urls)]
+
+        if self.use_mo_response_url():
+            groups.append((
+                self.config['reply_outbound_url'],
+                config.reply_outbound_urls))
+
+        return groups
+
+    def get_send_urls(self):
+        return [
+            endpoint.url
+            for balancer in self.balancers.itervalues()
+            for endpoint in balancer.endpoints]
+
+    def on_endpoint_eject(self, endpoint):
+        self.log.warning(
+            'Taking outbound url %s out of use for %fs after %d failures' % (
+                endpoint.url,
+                self.get_static_config().outbound_eject_duration,
+                self.get_static_config().outbound_eject_failures))
+
+    def prewarm_pool(self, n):
+        def eb(f, url):
+            self.log.warning(
+                'Could not prewarm connection to %s: %s' % (
+                    url, f.getErrorMessage()))
+
+        ds = []
+
+        for url in self.get_send_urls():
+            for _ in range(n):
+                d = treq.head(url, pool=self.pool)
+                d.addCallback(treq.content)
+                d.addErrback(eb, url)
+                ds.append(d)
+
+        return DeferredList(ds)
+
     def get_request_dict(self, request):
         return {
             'uri': request.uri,
@@ -101,12 +1271,14 @@ class Vas2NetsSmsTransport(HttpRpcTransport):
             return self.config['outbound_url']
 
     def get_send_params(self, message):
-        params = {
+        params = self.get_static_send_params()
+        params.update(self.get_message_send_params(message))
+        return params
+
+    def get_static_send_params(self):
+        return {
             'username': self.config['username'],
             'password': self.config['password'],
-            'sender': message['from_addr'],
-            'receiver': message['to_addr'],
-            'message': message['content'],
 
             # From docs:
             # flag indicating normal text message
@@ -117,6 +1289,13 @@ class Vas2NetsSmsTransport(HttpRpcTransport):
             'message_type': '1',
         }
 
+    def get_message_send_params(self, message):
+        params = {
+            'sender': message['from_addr'],
+            'receiver': message['to_addr'],
+            'message': message['content'],
+        }
+
         id = get_in(message, 'transport_metadata', 'vas2nets_sms', 'msgid')
 
         # from docs:
@@ -127,9 +1306,56 @@ class Vas2NetsSmsTransport(HttpRpcTransport):
 
         return params
 
+    def encode_send_params(self, params):
+        return urlencode([
+            (k, v.encode(self.ENCODING) if isinstance(v, unicode) else v)
+            for k, v in params.iteritems()])
+
+    def get_send_query_prefix(self, url):
+        sep = '&' if urlparse(url).query else '?'
+        return ''.join([
+            url, sep, self.encode_send_params(self.get_static_send_params())])
+
+    def get_send_query(self, url, message):
+        return self.get_send_query_for_params(
+            url, self.get_message_send_params(message))
+
+    def get_send_batch_query(self, url, messages):
+        params = self.get_message_send_params(messages[0])
+        params['receiver'] = ','.join(m['to_addr'] for m in messages)
+        return self.get_send_query_for_params(url, params)
+
+    def get_send_query_for_params(self, url, params):
+        prefix = self.send_query_prefixes.get(url)
+
+        if prefix is None:
+            prefix = self.get_send_query_prefix(url)
+
+        return '%s&%s' % (prefix, self.encode_send_params(params))
+
+    def is_batchable(self, message):
+        return 'message_id' not in self.get_message_send_params(message)
+
+    def get_batch_key(self, message):
+        return (
+            self.get_send_url(message),
+            message['from_addr'],
+            message['content'])
+
     def get_send_fail_type(self, code):
         return self.SEND_FAIL_TYPES.get(code, 'request_fail_unknown')
 
+    def get_send_fail_types(self):
+        return sorted(set(self.SEND_FAIL_TYPES.values()) | set([
+            'request_fail_unknown',
+            'request_timeout',
+            'connection_error',
+        ]))
+
+    def count_send_status(self, status):
+        if status['type'] is not None:
+            self.instrumentation.count(status['type'])
+
     def use_mo_response_url(self):
         return self.config.get('reply_outbound_url') is not None
 
@@ -173,22 +1399,120 @@ class Vas2NetsSmsTransport(HttpRpcTransport):
                 'message': match.group('message'),
             }
 
+    def get_batch_send_contents(self, content, n):
+        # Vas2Nets gives a status line for each receiver when it reports on
+        # them separately. Otherwise, its status applies to every receiver.
+        lines = content.splitlines()
+
+        if n > 1 and len(lines) == n:
+            return lines
+        else:
+            return [content] * n
+
+    def get_response_status(self, content, http_code):
+        status = self.instrumentation.measure(
+            'parse', self.get_send_status, content)
+        status['http_code'] = http_code
+
+        if http_code == http.OK and status['code'] is None:
+            status['type'] = None
+        else:
+            status['type'] = self.get_send_fail_type(status['code'])
+
+        return status
+
+    def get_timeout_status(self):
+        return {
+            'type': 'request_timeout',
+            'code': None,
+            'message': 'Request timeout',
+            'http_code': None,
+        }
+
+    def get_connection_error_status(self, error):
+        return {
+            'type': 'connection_error',
+            'code': None,
+            'message': 'Connection error: %s' % (error,),
+            'http_code': None,
+        }
+
     def respond(self, message_id, code, body=None):
         if body is None:
             body = {}
 
         self.finish_request(message_id, json.dumps(body), code=code)
 
-    def send_message(self, message):
-        return treq.get(
-            url=self.get_send_url(message),
-            params=self.get_send_params(message),
-            timeout=self.config.get('outbound_request_timeout'))
+    def get_bucket(self, url):
+        bucket = self.buckets.get(url)
+
+        if bucket is None:
+            config = self.get_static_config()
+            bucket = self.buckets[url] = TokenBucket(
+                self.clock,
+                config.outbound_rate_limit,
+                config.outbound_rate_burst)
+
+        return bucket
+
+    def wait_for_send_slot(self, url, n=1):
+        if self.get_static_config().outbound_rate_limit is None:
+            return
+        return self.get_bucket(url).acquire(n)
+
+    def send_message(self, message, url=None):
+        if url is None:
+            url = self.get_send_url(message)
+
+        return self.send_request(url, self.get_send_query(url, message))
+
+    def send_batch(self, messages, url):
+        return self.send_request(
+            url, self.get_send_batch_query(url, messages))
+
+    @inlineCallbacks
+    def send_request(self, url, query):
+        timeout = self.get_request_timeout()
+        started = self.clock.seconds()
+
+        # Requests that time out aren't recorded. Counting them at the
+        # timeout would make each timeout during an outage `multiple` times
+        # longer than the last.
+        resp = yield self.instrumentation.measure(
+            'send', treq.get, url=query, pool=self.pool, timeout=timeout)
+
+        self.record_request_latency(self.clock.seconds() - started)
+        returnValue(resp)
+
+    def get_request_timeout(self):
+        if self.latencies is None:
+            return self.config.get('outbound_request_timeout')
+        else:
+            return self.adaptive_request_timeout
+
+    def record_request_latency(self, latency):
+        if self.latencies is None:
+            return
+
+        config = self.get_static_config()
+        self.latencies.record(latency)
+
+        if len(self.latencies) < config.outbound_adaptive_timeout_min_samples:
+            return
+
+        p99 = self.latencies.percentile(99)
+        self.adaptive_request_timeout = min(
+            config.outbound_adaptive_timeout_max,
+            max(config.outbound_adaptive_timeout_min,
+                config.outbound_adaptive_timeout_multiple * p99))
+
+        self.latency_p99_metric.set(p99)
+        self.request_timeout_metric.set(self.adaptive_request_timeout)
 
     @inlineCallbacks
     def handle_raw_inbound_message(self, message_id, request):
         try:
-            vals, errors = self.get_field_values(request, self.EXPECTED_FIELDS)
+            vals, errors = self.get_inbound_field_values(request)
         except UnicodeDecodeError:
             yield self.handle_decode_error(message_id, request)
             return
@@ -198,6 +1522,32 @@ class Vas2NetsSmsTransport(HttpRpcTransport):
         else:
             yield self.handle_inbound_message(message_id, request, vals)
 
+    def get_inbound_field_values(self, request):
+        """
+        Equivalent to `get_field_values(request, EXPECTED_FIELDS)`, but
+        quicker for the usual case of a request that has exactly the
+        expected fields.
+        """
+        args = request.args
+        fields = self.EXPECTED_FIELD_ORDER
+
+        if len(args) == len(fields):
+            try:
+                raw = [args[field][0] for field in fields]
+            except KeyError:
+                raw = None
+
+            # Decoding the values together is quicker than decoding each of
+            # them. If a value contains the separator, we can't split them
+            # apart again and use the generic path instead.
+            if raw is not None:
+                values = '\0'.join(raw).decode(self.ENCODING).split(u'\0')
+
+                if len(values) == len(fields):
+                    return dict(zip(fields, values)), {}
+
+        return self.get_field_values(request, self.EXPECTED_FIELDS)
+
     @inlineCallbacks
     def handle_decode_error(self, message_id, request):
         req = self.get_request_dict(request)
@@ -233,8 +1583,27 @@ class Vas2NetsSmsTransport(HttpRpcTransport):
 
     @inlineCallbacks
     def handle_inbound_message(self, message_id, request, vals):
-        yield self.publish_message(
-            **self.get_message_dict(message_id, vals))
+        if self.inbound_dedup is not None:
+            is_new = yield self.inbound_dedup.add(
+                vals['msgid'], {'message_id': message_id})
+
+            if not is_new:
+                self.handle_inbound_duplicate(message_id, vals)
+                return
+
+        message = self.get_message_dict(message_id, vals)
+
+        try:
+            if self.inbound_journal is None:
+                yield self.publish_message(**message)
+            else:
+                yield self.inbound_journal.add(message_id, message)
+                self.publish_journaled_message(message_id, message)
+        except Exception:
+            # Let Vas2Nets' retry through, since this attempt wasn't published
+            if self.inbound_dedup is not None:
+                yield self.inbound_dedup.delete(vals['msgid'])
+            raise
 
         self.respond(message_id, http.OK, {})
 
@@ -244,39 +1613,480 @@ class Vas2NetsSmsTransport(HttpRpcTransport):
             type='request_success',
             message='Request successful')
 
-    @inlineCallbacks
+    def publish_journaled_message(self, message_id, message):
+        self.inbound_publish_retries.pop(message_id, None)
+        d = self.publish_message(**message)
+        d.addCallback(lambda _: self.inbound_journal.done(message_id))
+        d.addErrback(self.journaled_message_failed, message_id, message)
+        self.inbound_publishing.add(d)
+        d.addBoth(self.journaled_message_published, d)
+
+    def journaled_message_failed(self, failure, message_id, message):
+        delay = self.get_static_config().inbound_journal_retry_delay
+        self.log.err(
+            failure,
+            'Error publishing journaled inbound message %s, retrying in '
+            '%ss' % (message_id, delay))
+
+        # The message stays in the journal until it is published
+        self.inbound_publish_retries[message_id] = self.clock.callLater(
+            delay, self.publish_journaled_message, message_id, message)
+
+    def journaled_message_published(self, result, d):
+        self.inbound_publishing.discard(d)
+        return result
+
+    def replay_inbound_journal(self):
+        pending = self.inbound_journal.pending()
+
+        if pending:
+            self.log.info(
+                'Publishing %d journaled inbound messages' % (len(pending),))
+
+        for message_id, message in pending:
+            self.publish_journaled_message(message_id, message)
+
+    def handle_inbound_duplicate(self, message_id, vals):
+        self.emit(
+            'Inbound duplicate, not publishing msgid %s', vals['msgid'])
+
+        self.inbound_duplicate_count.inc()
+        self.respond(message_id, http.OK, {})
+
+    def pause_connectors(self):
+        # Once something else has paused us (for example, the worker shutting
+        # down), it is responsible for unpausing us again.
+        self.outbound_paused = False
+        return super(Vas2NetsSmsTransport, self).pause_connectors()
+
+    def pause_outbound(self):
+        self.emit('Pausing outbound, %d sends in flight', len(self.in_flight))
+        self.outbound_paused = True
+        self.connectors[self.transport_name].pause()
+
+    def unpause_outbound(self):
+        self.emit(
+            'Unpausing outbound, %d sends in flight', len(self.in_flight))
+        self.outbound_paused = False
+        self.connectors[self.transport_name].unpause()
+
     def handle_outbound_message(self, message):
-        missing_fields = self.ensure_message_values(
+        if self.max_in_flight is None:
+            return self.process_outbound_message(message)
+
+        if self.lanes is None:
+            self.start_outbound_message(message)
+        else:
+            self.queue_outbound_message(message)
+
+        if self.is_outbound_full():
+            self.pause_outbound()
+
+    def start_outbound_message(self, message):
+        d = self.process_outbound_message(message)
+        self.in_flight.add(d)
+        d.addErrback(self._send_failure_eb, message)
+        d.addBoth(self.outbound_message_done, d)
+
+    def queue_outbound_message(self, message):
+        lane = self.get_outbound_lane(message)
+        self.lanes.put(lane, message)
+        self.lane_metrics[lane]['depth'].set(self.lanes.depth(lane))
+        self.start_queued_messages()
+
+    def start_queued_messages(self):
+        while self.lanes and len(self.in_flight) < self.max_in_flight:
+            lane, message, wait_time = self.lanes.get()
+            self.lane_metrics[lane]['wait_time'].set(wait_time)
+            self.lane_metrics[lane]['depth'].set(self.lanes.depth(lane))
+            self.start_outbound_message(message)
+
+    def get_outbound_lane(self, message):
+        if self.is_mo_response(message):
+            return PriorityLanes.REPLY
+        else:
+            return PriorityLanes.BULK
+
+    def is_outbound_full(self):
+        if len(self.in_flight) < self.max_in_flight:
+            return False
+
+        return self.lanes is None or len(self.lanes) >= self.queue_size
+
+    def outbound_message_done(self, result, d):
+        self.in_flight.discard(d)
+
+        if self.lanes is not None:
+            self.start_queued_messages()
+
+        if self.outbound_paused and not self.is_outbound_full():
+            self.unpause_outbound()
+
+        return result
+
+    @inlineCallbacks
+    def process_outbound_message(self, message):
+        missing_fields = self.instrumentation.measure(
+            'validate', self.ensure_message_values,
             message, self.EXPECTED_MESSAGE_FIELDS)
 
         if missing_fields:
             yield self.reject_message(message, missing_fields)
             return
 
-        try:
-            resp = yield self.send_message(message)
-        except (ResponseNeverReceived, ConnectingCancelledError,
-                CancelledError):
-            yield self.handle_send_timeout(message)
+        if self.dedup is not None:
+            outcome = yield self.dedup.get(message['message_id'])
+
+            if outcome is not None:
+                yield self.handle_outbound_duplicate(message, outcome)
+                return
+
+        if self.spool is not None and message['message_id'] in self.spool:
+            # The message will be acked or nacked once it leaves the spool
+            self.emit_for(message, 'Already spooled: %s', message)
+            return
+
+        attempt = 1
+        status = yield self.attempt_send(message)
+
+        while self.should_retry(status, attempt):
+            yield self.wait_for_retry(message, status, attempt)
+            attempt += 1
+            status = yield self.attempt_send(message)
+
+        if self.should_spool(status):
+            yield self.spool_message(message, status)
+        else:
+            yield self.handle_send_status(message, status)
+
+    def handle_send_status(self, message, status):
+        if status['type'] is None:
+            return self.handle_outbound_success(message)
+        elif status['type'] == 'circuit_open':
+            return self.handle_circuit_open(message)
+        elif status['type'] == 'request_timeout':
+            return self.handle_send_timeout(message)
+        elif status['type'] == 'connection_error':
+            return self.handle_send_connection_error(message, status)
+        else:
+            return self.handle_outbound_fail(message, status)
+
+    def should_spool(self, status):
+        return (
+            self.spool is not None and
+            status['type'] in self.get_static_config().outbound_spool_types)
+
+    @inlineCallbacks
+    def spool_message(self, message, status):
+        config = self.get_static_config()
+
+        if len(self.spool) >= config.outbound_spool_max_size:
+            if config.outbound_spool_overflow == 'reject_new':
+                self.emit_for(message, 'Spool full, not spooling: %s', message)
+                yield self.handle_send_status(message, status)
+                return
+
+            # The message being sent from the spool is left for the drain to
+            # ack or nack
+            oldest = self.get_oldest_spooled(exclude=self.spool_sending)
+
+            if oldest is None:
+                self.emit_for(message, 'Spool full, not spooling: %s', message)
+                yield self.handle_send_status(message, status)
+                return
+
+            message_id, data = oldest
+            self.spool.done(message_id)
+            oldest = TransportUserMessage.from_json(data['message'])
+            self.emit_for(oldest, 'Spool full, dropping: %s', oldest)
+            yield self.handle_send_status(oldest, data['status'])
+
+        self.emit_for(message, 'Spooling: %s', message)
+        yield self.spool.add(message['message_id'], {
+            'message': message.to_json(),
+            'status': status,
+            'spooled_at': self.clock.seconds(),
+        })
+
+    def drain_spool(self):
+        self.publish_spool_metrics()
+
+        if self.spool_draining is None and len(self.spool) > 0:
+            self.spool_draining = self.send_spooled_message()
+            self.spool_draining.addErrback(
+                self.log.err, 'Error sending spooled message')
+            self.spool_draining.addBoth(self.spooled_message_sent)
+
+    def spooled_message_sent(self, _):
+        self.spool_draining = None
+        self.spool_sending = None
+
+    @inlineCallbacks
+    def send_spooled_message(self):
+        message_id, data = self.spool.first()
+        message = TransportUserMessage.from_json(data['message'])
+        self.spool_sending = message_id
+        status = yield self.attempt_send(message)
+
+        if message_id not in self.spool:
+            self.emit_for(
+                message, 'Spooled message no longer spooled: %s', message)
             return
 
-        content = yield resp.content()
-        status = self.get_send_status(content)
-        self.emit('Vas2Nets response for %s: %s, status: %s' % (
-            message['message_id'], content, status))
+        if self.should_spool(status) and not self.is_spool_expired(data):
+            self.emit_for(
+                message, 'Sending spooled message failed, keeping: %s',
+                message)
+
+            # Moving the message to the back of the spool lets the messages
+            # behind it be sent, if it is the message that is the problem
+            self.spool.done(message_id)
+            yield self.spool.add(message_id, dict(data, status=status))
+            return
+
+        yield self.spool.done(message_id)
+        yield self.handle_send_status(message, status)
+
+    def is_spool_expired(self, data):
+        max_age = self.get_static_config().outbound_spool_max_age
+
+        if max_age is None:
+            return False
+
+        return self.clock.seconds() - data['spooled_at'] >= max_age
+
+    def get_oldest_spooled(self, exclude=None):
+        # Messages that fail to send again are moved to the back of the
+        # spool, so the first message isn't necessarily the oldest
+        pending = [
+            (message_id, data) for (message_id, data) in self.spool.pending()
+            if message_id != exclude]
+
+        if not pending:
+            return None
+
+        return min(pending, key=lambda item: item[1]['spooled_at'])
+
+    def publish_spool_metrics(self):
+        if len(self.spool) > 0:
+            _, data = self.get_oldest_spooled()
+            age = self.clock.seconds() - data['spooled_at']
+        else:
+            age = 0
+
+        self.spool_metrics['depth'].set(len(self.spool))
+        self.spool_metrics['age'].set(age)
+        self.spool_metrics['disk_usage'].set(self.spool.disk_usage())
+
+    @inlineCallbacks
+    def attempt_send(self, message):
+        if self.breaker is None:
+            status = yield self.request_send(message)
+            returnValue(status)
+
+        token = yield self.wait_for_breaker()
+
+        if token is None:
+            returnValue({
+                'type': 'circuit_open',
+                'code': None,
+                'message': 'Circuit breaker open',
+            })
+
+        try:
+            status = yield self.request_send(message)
+        except Exception:
+            self.breaker.record(False, token)
+            raise
+
+        self.breaker.record(not self.is_provider_failure(status), token)
+        returnValue(status)
 
-        if resp.code == http.OK and status['code'] is None:
-            yield self.handle_outbound_success(message)
+    def wait_for_breaker(self):
+        if self.get_static_config().outbound_breaker_hold:
+            return self.breaker.wait()
         else:
-            yield self.handle_outbound_fail(message, status)
+            return succeed(self.breaker.allow())
+
+    def is_provider_failure(self, status):
+        return (
+            status['type'] in (
+                'request_timeout', 'connection_error', 'system_error') or
+            status['http_code'] >= 500)
+
+    def request_send(self, message):
+        if self.batcher is not None and self.is_batchable(message):
+            return self.batcher.add(self.get_batch_key(message), message)
+
+        return self.request_send_balanced(
+            self.get_send_url(message),
+            lambda url: self.request_send_to(message, url),
+            lambda status: not self.is_provider_failure(status))
+
+    def request_send_batch(self, messages):
+        return self.request_send_balanced(
+            self.get_send_url(messages[0]),
+            lambda url: self.request_send_batch_to(messages, url),
+            lambda statuses: not any(
+                self.is_provider_failure(s) for s in statuses),
+            n=len(messages))
 
-    def emit(self, log):
-        if self.get_static_config().noisy:
-            self.log.info(log)
+    @inlineCallbacks
+    def request_send_balanced(self, url, request, is_success, n=1):
+        # The rate limit applies to `url` as a whole, however many urls its
+        # sends are spread across, and to each of the `n` messages sent. The
+        # endpoint is only chosen once the send can go ahead, so that the
+        # wait isn't counted against it.
+        yield self.wait_for_send_slot(url, n)
+
+        balancer = self.balancers[url]
+        endpoint = balancer.choose()
+        started = balancer.start(endpoint)
+
+        try:
+            result = yield request(endpoint.url)
+        except Exception:
+            balancer.finish(endpoint, started, False)
+            raise
+
+        balancer.finish(endpoint, started, is_success(result))
+        returnValue(result)
+
+    @inlineCallbacks
+    def request_send_to(self, message, url):
+        try:
+            resp = yield self.send_message(message, url)
+        except TIMEOUT_ERRORS:
+            status = self.get_timeout_status()
+            self.count_send_status(status)
+            returnValue(status)
+        except CONNECTION_ERRORS as e:
+            status = self.get_connection_error_status(e)
+            self.count_send_status(status)
+            returnValue(status)
+
+        content = yield self.instrumentation.measure('content', resp.content)
+        status = self.get_response_status(content, resp.code)
+        self.count_send_status(status)
+        self.emit_for(
+            message, 'Vas2Nets response for %s: %s, status: %s',
+            message['message_id'], content, status)
+
+        returnValue(status)
+
+    @inlineCallbacks
+    def request_send_batch_to(self, messages, url):
+        try:
+            resp = yield self.send_batch(messages, url)
+        except TIMEOUT_ERRORS:
+            statuses = [self.get_timeout_status() for _ in messages]
+
+            for status in statuses:
+                self.count_send_status(status)
+
+            returnValue(statuses)
+        except CONNECTION_ERRORS as e:
+            statuses = [self.get_connection_error_status(e) for _ in messages]
+
+            for status in statuses:
+                self.count_send_status(status)
+
+            returnValue(statuses)
+
+        content = yield self.instrumentation.measure('content', resp.content)
+        contents = self.get_batch_send_contents(content, len(messages))
+        statuses = []
+
+        for message, content in zip(messages, contents):
+            status = self.get_response_status(content, resp.code)
+            self.count_send_status(status)
+            self.emit_for(
+                message, 'Vas2Nets response for %s: %s, status: %s',
+                message['message_id'], content, status)
+            statuses.append(status)
+
+        returnValue(statuses)
+
+    def should_retry(self, status, attempt):
+        config = self.get_static_config()
+
+        if status['type'] not in config.outbound_retry_types:
+            return False
+
+        if attempt >= config.outbound_retry_max_attempts:
+            if config.outbound_retry_max_attempts > 1:
+                self.retry_exhausted_count.inc()
+            return False
+
+        return True
+
+    def get_retry_delay(self, attempt):
+        config = self.get_static_config()
+        delay = min(
+            config.outbound_retry_max_delay,
+            config.outbound_retry_delay * 2 ** (attempt - 1))
+        return delay * (1 - config.outbound_retry_jitter * random.random())
+
+    def wait_for_retry(self, message, status, attempt):
+        delay = self.get_retry_delay(attempt)
+        self.emit_for(
+            message, 'Retrying %s in %fs after attempt %d failed: %s',
+            message['message_id'], delay, attempt, status['type'])
+        self.retry_count.inc()
+        return deferLater(self.clock, delay, lambda: None)
+
+    def emit(self, log, *args):
+        if self.noisy:
+            self.log_emitted(log, args)
+
+    def emit_for(self, message, log, *args):
+        if self.noisy or self.is_log_sampled(message):
+            self.log_emitted(log, args)
+
+    def log_emitted(self, log, args):
+        self.log.info(log % args if args else log)
+
+    def is_log_sampled(self, message):
+        n = self.log_sample_every
+
+        if n is None:
+            return False
+
+        return zlib.crc32(message['message_id']) % n == 0
+
+    def record_outcome(self, message, outcome):
+        if self.dedup is None:
+            return succeed(None)
+
+        return self.dedup.set(message['message_id'], outcome)
+
+    def handle_outbound_duplicate(self, message, outcome):
+        self.emit_for(
+            message, 'Outbound duplicate, replaying %s: %s',
+            outcome['event_type'], message)
+
+        self.duplicate_count.inc()
+
+        if outcome['event_type'] == 'ack':
+            return self.publish_ack(
+                user_message_id=message['message_id'],
+                sent_message_id=message['message_id'])
+        else:
+            return self.publish_nack(
+                user_message_id=message['message_id'],
+                sent_message_id=message['message_id'],
+                reason=outcome['reason'])
 
     @inlineCallbacks
     def handle_send_timeout(self, message):
-        self.emit('Timing out: %s' % (message,))
+        self.emit_for(message, 'Timing out: %s', message)
+        # The request may have reached Vas2Nets before it timed out, so we
+        # don't send the message again if it is delivered again.
+        yield self.record_outcome(message, {
+            'event_type': 'nack',
+            'reason': 'Request timeout',
+        })
+
         yield self.publish_nack(
             user_message_id=message['message_id'],
             sent_message_id=message['message_id'],
@@ -288,9 +2098,60 @@ class Vas2NetsSmsTransport(HttpRpcTransport):
             type='request_timeout',
             message='Request timeout')
 
+    @inlineCallbacks
+    def handle_send_connection_error(self, message, status):
+        self.emit_for(
+            message, 'Could not connect to Vas2Nets for %s: %s',
+            message['message_id'], status['message'])
+        # The request never reached Vas2Nets, so unlike a timeout, there's
+        # no outcome to record. The message can be sent if it is delivered
+        # again.
+        yield self.publish_nack(
+            user_message_id=message['message_id'],
+            sent_message_id=message['message_id'],
+            reason='Connection error')
+
+        yield self.add_status(
+            component='outbound',
+            status='down',
+            type='connection_error',
+            message=status['message'])
+
+    def on_breaker_state_change(self, state):
+        self.log.info('Outbound circuit breaker %s' % (state,))
+
+        status = {
+            CircuitBreaker.CLOSED: {
+                'status': 'ok',
+                'type': 'circuit_closed',
+                'message': 'Circuit breaker closed',
+            },
+            CircuitBreaker.HALF_OPEN: {
+                'status': 'degraded',
+                'type': 'circuit_half_open',
+                'message': 'Circuit breaker half-open',
+            },
+            CircuitBreaker.OPEN: {
+                'status': 'down',
+                'type': 'circuit_open',
+                'message': 'Circuit breaker open',
+            },
+        }[state]
+
+        self.add_status(component='outbound_circuit', **status)
+
+    def handle_circuit_open(self, message):
+        self.emit_for(
+            message, 'Circuit breaker open, not sending: %s', message)
+        return self.publish_nack(
+            user_message_id=message['message_id'],
+            sent_message_id=message['message_id'],
+            reason='Circuit breaker open')
+
     @inlineCallbacks
     def handle_outbound_success(self, message):
-        self.emit('Outbound success: %s' % (message,))
+        self.emit_for(message, 'Outbound success: %s', message)
+        yield self.record_outcome(message, {'event_type': 'ack'})
         yield self.publish_ack(
             user_message_id=message['message_id'],
             sent_message_id=message['message_id'])
@@ -303,7 +2164,12 @@ class Vas2NetsSmsTransport(HttpRpcTransport):
 
     @inlineCallbacks
     def handle_outbound_fail(self, message, status):
-        self.emit('Outbound fail: %s' % (message,))
+        self.emit_for(message, 'Outbound fail: %s', message)
+        yield self.record_outcome(message, {
+            'event_type': 'nack',
+            'reason': status['message'],
+        })
+
         yield self.publish_nack(
             user_message_id=message['message_id'],
             sent_message_id=message['message_id'],
@@ -1,13 +1,24 @@
 import json
-from twisted.internet.defer import inlineCallbacks, returnValue
+from heapq import heappush, heappop, heapify
+from twisted.internet.defer import inlineCallbacks, returnValue, succeed
+from twisted.internet.task import LoopingCall
 from twisted.web import http
-from vumi.components.session import SessionManager
+from vumi.blinkenlights.metrics import Count
 from vumi.config import ConfigDict, ConfigInt, ConfigText
 from vumi.message import TransportUserMessage
 from vumi.transports.httprpc import HttpRpcTransport
 
+from vxvas2nets.instrumentation import (
+    InstrumentationConfig, InstrumentationMixin, LatencyHistogram,
+    LatencyHistogramWindow)
+from vxvas2nets.session import (
+    UssdSessionManager, MemorySessionManager, SessionCache)
+from vxvas2nets.status import StatusAggregatorConfig, StatusAggregatorMixin
 
-class Vas2NetsUssdTransportConfig(HttpRpcTransport.CONFIG_CLASS):
+
+class Vas2NetsUssdTransportConfig(
+        HttpRpcTransport.CONFIG_CLASS, StatusAggregatorConfig,
+        InstrumentationConfig):
     """Config for Dmark USSD transport."""
 
     ussd_session_timeout = ConfigInt(
@@ -15,6 +26,33 @@ class Vas2NetsUssdTransportConfig(HttpRpcTransport.CONFIG_CLASS):
         " expires.",
         default=60, static=True)
 
+    ussd_session_backend = ConfigText(
+        "Where to keep USSD sessions. 'redis' keeps them in Redis, using "
+        "`redis_manager`, and 'memory' keeps them in this worker's memory, "
+        "for transports that run on a single node",
+        default='redis', static=True)
+
+    ussd_session_cache_size = ConfigInt(
+        "If set, the number of sessions to remember in memory, so that "
+        "requests for sessions this worker has seen recently don't need to "
+        "wait for Redis. Sessions expire from the cache after "
+        "`ussd_session_timeout`, and expiry times in Redis are updated "
+        "without waiting. This is only safe if each session's requests are "
+        "all routed to the same worker",
+        default=None, static=True)
+
+    response_time_window = ConfigInt(
+        "Number of seconds of responses to base response status events on. "
+        "The status is 'down' if the 95th percentile response time over the "
+        "window is longer than `response_time_down`, 'degraded' if it is "
+        "longer than `response_time_degraded` and 'ok' otherwise",
+        default=60, static=True)
+
+    response_time_status_interval = ConfigInt(
+        "Number of seconds between response status events. No event is "
+        "published if there were no responses in the window",
+        default=5, static=True)
+
     redis_manager = ConfigDict(
         "Redis client configuration.", default={}, static=True)
 
@@ -22,8 +60,16 @@ class Vas2NetsUssdTransportConfig(HttpRpcTransport.CONFIG_CLASS):
         "The number to dial to access the USSD line. Sets the `from_addr`"
         "attribute on inbound messages.", required=True, static=True)
 
+    def post_validate(self):
+        super(Vas2NetsUssdTransportConfig, self).post_validate()
+
+        if self.ussd_session_backend not in ('redis', 'memory'):
+            self.raise_config_error(
+                'Invalid session backend: %s' % (self.ussd_session_backend,))
+
 
-class Vas2NetsUssdTransport(HttpRpcTransport):
+class Vas2NetsUssdTransport(
+        InstrumentationMixin, StatusAggregatorMixin, HttpRpcTransport):
     CONFIG_CLASS = Vas2NetsUssdTransportConfig
     EXPECTED_FIELDS = frozenset([
         'userdata', 'msisdn', 'sessionid',
@@ -33,13 +79,105 @@ class Vas2NetsUssdTransport(HttpRpcTransport):
 
     @inlineCallbacks
     def setup_transport(self):
+        # Pending requests ordered by when they were received, so that timed
+        # out requests can be found without looking at every pending request.
+        # This is needed before the request cleanup task is started.
+        self.request_timestamps = []
+
+        yield self.setup_instrumentation('vas2nets_ussd')
+
         yield super(Vas2NetsUssdTransport, self).setup_transport()
         config = self.get_static_config()
+        self.session_manager = yield self.get_session_manager(config)
+        self.ussd_number = config.ussd_number
+
+        self.session_cache = None
+
+        if config.ussd_session_cache_size is not None:
+            self.session_cache = SessionCache(
+                self.clock,
+                config.ussd_session_timeout,
+                config.ussd_session_cache_size)
+
+            self.session_cache_hits = self.metrics.register(
+                Count('session_cache.hits'))
+            self.session_cache_misses = self.metrics.register(
+                Count('session_cache.misses'))
+
+        self.setup_status_aggregator()
+
+        # The thresholds are bucket bounds, so that comparing the window's
+        # 95th percentile to them is exact
+        self.response_times = LatencyHistogramWindow(
+            self.clock, config.response_time_window,
+            buckets=tuple(sorted(set(LatencyHistogram.BUCKETS) | set([
+                self.response_time_degraded, self.response_time_down]))))
+
+        self.response_time_task = LoopingCall(
+            self.publish_response_time_status)
+        self.response_time_task.clock = self.clock
+        self.response_time_task.start(
+            config.response_time_status_interval, now=False)
+
+    @inlineCallbacks
+    def teardown_transport(self):
+        if self.response_time_task.running:
+            self.response_time_task.stop()
+
+        self.teardown_status_aggregator()
+        self.teardown_instrumentation()
+        yield self.session_manager.stop()
+        yield super(Vas2NetsUssdTransport, self).teardown_transport()
+
+    def get_session_manager(self, config):
+        if config.ussd_session_backend == 'memory':
+            manager = MemorySessionManager(
+                self.clock, max_session_length=config.ussd_session_timeout)
+            manager.start()
+            return succeed(manager)
+
         r_prefix = "vumi.transports.vas2nets_ussd:%s" % self.transport_name
-        self.session_manager = yield SessionManager.from_redis_config(
+        return UssdSessionManager.from_redis_config(
             config.redis_manager, r_prefix,
             max_session_length=config.ussd_session_timeout)
-        self.ussd_number = config.ussd_number
+
+    def set_request(self, request_id, request_object, timestamp=None):
+        super(Vas2NetsUssdTransport, self).set_request(
+            request_id, request_object, timestamp)
+
+        timestamp = self._requests[request_id]['timestamp']
+        heappush(self.request_timestamps, (timestamp, request_id))
+
+    def remove_request(self, request_id):
+        super(Vas2NetsUssdTransport, self).remove_request(request_id)
+
+        # Finished requests are left in the index until they would have
+        # timed out, unless they start to outnumber pending requests
+        if len(self.request_timestamps) > 2 * len(self._requests) + 1024:
+            self.request_timestamps = [
+                (request['timestamp'], pending_id)
+                for pending_id, request in self._requests.iteritems()]
+            heapify(self.request_timestamps)
+
+    def is_request_pending(self, request_id, timestamp):
+        request = self._requests.get(request_id)
+        return request is not None and request['timestamp'] == timestamp
+
+    def manually_close_requests(self):
+        now = self.clock.seconds()
+
+        while self.request_timestamps:
+            timestamp, request_id = self.request_timestamps[0]
+            response_time = now - timestamp
+
+            if response_time <= self.request_timeout:
+                break
+
+            heappop(self.request_timestamps)
+
+            if self.is_request_pending(request_id, timestamp):
+                self.on_timeout(request_id, response_time)
+                self.close_request(request_id)
 
     def get_request_dict(self, request):
         return {
@@ -52,14 +190,44 @@ class Vas2NetsUssdTransport(HttpRpcTransport):
 
     @inlineCallbacks
     def session_event_for_transaction(self, session_id):
-        session = yield self.session_manager.load_session(session_id)
-        if session:
-            yield self.session_manager.save_session(session_id, session)
-            returnValue(TransportUserMessage.SESSION_RESUME)
-        else:
-            yield self.session_manager.create_session(
-                session_id, transaction_id=session_id)
+        if self.session_cache is not None:
+            if self.session_cache.touch(session_id):
+                self.session_cache_hits.inc()
+                self.touch_cached_session(session_id)
+                returnValue(TransportUserMessage.SESSION_RESUME)
+
+            self.session_cache_misses.inc()
+
+        created = yield self.session_manager.touch_or_create(
+            session_id,
+            created_at=self.clock.seconds(),
+            transaction_id=session_id)
+
+        if self.session_cache is not None:
+            self.session_cache.add(session_id)
+
+        if created:
             returnValue(TransportUserMessage.SESSION_NEW)
+        else:
+            returnValue(TransportUserMessage.SESSION_RESUME)
+
+    def touch_cached_session(self, session_id):
+        d = self.session_manager.schedule_session_expiry(
+            session_id, self.get_static_config().ussd_session_timeout)
+        d.addCallback(self.cached_session_touched, session_id)
+        d.addErrback(self.log.err, 'Error updating session expiry time')
+
+    def cached_session_touched(self, updated, session_id):
+        # The session is no longer in Redis, so the next request for it
+        # needs to recreate it there
+        if not updated:
+            self.session_cache.delete(session_id)
+
+    def clear_session(self, session_id):
+        if self.session_cache is not None:
+            self.session_cache.delete(session_id)
+
+        return self.session_manager.clear_session(session_id)
 
     @inlineCallbacks
     def handle_raw_inbound_message(self, message_id, request):
@@ -92,10 +260,11 @@ class Vas2NetsUssdTransport(HttpRpcTransport):
             component='request', status='ok', type='request_parsed',
             message='Request parsed',)
 
-        session_event = yield self.session_event_for_transaction(
-            values['sessionid'])
+        session_event = yield self.instrumentation.measure(
+            'session', self.session_event_for_transaction, values['sessionid'])
 
-        yield self.publish_message(
+        yield self.instrumentation.measure(
+            'publish', self.publish_message,
             message_id=message_id,
             content=values['userdata'],
             from_addr=values['msisdn'],
@@ -123,7 +292,8 @@ class Vas2NetsUssdTransport(HttpRpcTransport):
         endofsession = (
             message["session_event"] == TransportUserMessage.SESSION_CLOSE)
         if endofsession is True:
-            yield self.session_manager.clear_session(
+            yield self.instrumentation.measure(
+                'session', self.clear_session,
                 message['transport_metadata']['vas2nets_ussd']['sessionid'])
 
         response_data = {
@@ -152,50 +322,66 @@ class Vas2NetsUssdTransport(HttpRpcTransport):
         # We send different status events for error responses
         if request.code < 200 or request.code >= 300:
             return
-        return self.add_status(
-            component='response',
-            status='down',
-            type='very_slow_response',
-            message='Very slow response',
-            reasons=[
-                'Response took longer than %fs' % (
-                    self.response_time_down,)
-            ],
-            details={
-                'response_time': time,
-            })
+        self.response_times.observe(time)
 
     def on_degraded_response_time(self, message_id, time):
         request = self.get_request(message_id)
         # We send different status events for error responses
         if request.code < 200 or request.code >= 300:
             return
-        return self.add_status(
-            component='response',
-            status='degraded',
-            type='slow_response',
-            message='Slow response',
-            reasons=[
-                'Response took longer than %fs' % (
-                    self.response_time_degraded,)
-            ],
-            details={
-                'response_time': time,
-            })
+        self.response_times.observe(time)
 
     def on_good_response_time(self, message_id, time):
         request = self.get_request(message_id)
         # We send different status events for error responses
         if request.code < 200 or request.code >= 400:
             return
-        return self.add_status(
-            component='response',
-            status='ok',
-            type='response_sent',
-            message='Response sent',
-            details={
-                'response_time': time,
-            })
+        self.response_times.observe(time)
+
+    def publish_response_time_status(self):
+        histogram = self.response_times.histogram()
+
+        if histogram.count == 0:
+            return
+
+        p95 = histogram.percentile(95)
+        window = self.get_static_config().response_time_window
+        details = {
+            'window': window,
+            'responses': histogram.count,
+            # The upper bound of the bucket the percentile falls in
+            'response_time_p95': p95 if p95 != float('inf') else None,
+        }
+
+        if p95 > self.response_time_down:
+            return self.add_status(
+                component='response',
+                status='down',
+                type='very_slow_response',
+                message='Very slow response',
+                reasons=[
+                    '95th percentile response time over %ds was longer '
+                    'than %fs' % (window, self.response_time_down)
+                ],
+                details=details)
+        elif p95 > self.response_time_degraded:
+            return self.add_status(
+                component='response',
+                status='degraded',
+                type='slow_response',
+                message='Slow response',
+                reasons=[
+                    '95th percentile response time over %ds was longer '
+                    'than %fs' % (window, self.response_time_degraded)
+                ],
+                details=details)
+        else:
+            return self.add_status(
+                component='response',
+                status='ok',
+                type='response_sent',
+                message='Response sent',
+                details=details)
 
     def on_timeout(self, message_id, time):
         return self.add_status(